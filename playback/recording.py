@@ -9,6 +9,10 @@ class Recording(object):
 
     __metaclass__ = ABCMeta
 
+    # Whether the buffered reader representation of this recording also carries its metadata, in which case it can be
+    # restored from the full recording data alone without fetching the metadata separately
+    EMBEDS_METADATA = False
+
     def __init__(self, _id=None):
         self.id = _id or uuid.uuid1().hex
         self._closed = False
@@ -36,7 +40,7 @@ class Recording(object):
         :param buffered_reader: A buffered reader instance to read the compressed recording data.
         :type buffered_reader: BufferedReader
         :param recording_metadata: Metadata that could optionally override or append to the extracted
-            metadata from the recording.
+            metadata from the recording. None is only allowed for recording types that embed their metadata.
         :type recording_metadata: dict
         :return: A new MemoryRecording instance containing the fetched recording and its metadata.
         :rtype: MemoryRecording
@@ -75,6 +79,25 @@ class Recording(object):
         assert not self._closed
         self._set_data(key, value)
 
+    def set_many(self, items):
+        """
+        Sets several data items in the recording at once
+        :param items: Data keys and values (serializable)
+        :type items: list[(basestring, Any)]
+        """
+        assert not self._closed
+        self._set_many(items)
+
+    def _set_many(self, items):
+        """
+        Sets several data items in the recording, recordings that can store several items more efficiently than one by
+        one should override this
+        :param items: Data keys and values (serializable)
+        :type items: list[(basestring, Any)]
+        """
+        for key, value in items:
+            self._set_data(key, value)
+
     @abstractmethod
     def get_data(self, key):
         """
@@ -139,6 +162,15 @@ class Recording(object):
     def __getitem__(self, item):
         return self.get_data(item)
 
+    def estimate_size(self):
+        """
+        Cheap estimate of the recording size, meant for decisions that do not require the exact size of the recording
+        in its stored form
+        :return: Estimated recording size in bytes, None if it cannot be estimated cheaply
+        :rtype: int
+        """
+        return None
+
     @abstractmethod
     def get_metadata(self):
         """
@@ -1,9 +1,12 @@
-from typing import Type
+from typing import Type, TYPE_CHECKING
 
 from playback.recording import Recording
 from playback.recordings.memory.memory_recording import MemoryRecording
 from playback.recordings.sqlite.sqlite_recording import SqliteRecording
 
+if TYPE_CHECKING:
+    from io import BufferedReader  # noqa: F401
+
 
 def get_recording_class(metadata):
     # type: (dict) -> Type[Recording]
@@ -20,3 +23,16 @@ def get_recording_class(metadata):
         raise Exception('Unsupported recording type {}'.format(recording_type))
 
     return recording_class
+
+
+def detect_recording_class(buffered_reader):
+    # type: (BufferedReader) -> Type[Recording]
+    """
+    Returns the appropriate recording class based on the header of the recording raw data, without consuming the
+    given reader.
+    """
+    header = buffered_reader.peek(len(SqliteRecording.FILE_HEADER))[:len(SqliteRecording.FILE_HEADER)]
+    if header == SqliteRecording.FILE_HEADER:
+        return SqliteRecording
+
+    return MemoryRecording
@@ -11,6 +11,7 @@ from jsonpickle import decode, encode
 from playback.exceptions import RecordingKeyError
 from playback.recording import Recording
 from playback.utils.pickle_copy import pickle_copy
+from playback.utils.size_estimation import estimate_size
 
 from playback.utils.timing_utils import Timed
 
@@ -18,6 +19,9 @@ _logger = logging.getLogger(__name__)
 
 
 class MemoryRecording(Recording):
+    # The full recording data is saved along with its metadata (see as_buffered_reader)
+    EMBEDS_METADATA = True
+
     @staticmethod
     def new(_id=None):
         return MemoryRecording(_id=_id)
@@ -33,8 +37,12 @@ class MemoryRecording(Recording):
         _logger.info(u'Decoding recording of key {}'.format(recording_id))
         full_data = decode(serialized_data)
 
-        # remove metadata from the main recording
-        full_data.pop('_metadata', {})
+        # remove metadata from the main recording, it is only used when no external metadata was given
+        embedded_metadata = full_data.pop('_metadata', None)
+        if recording_metadata is None:
+            if embedded_metadata is None:
+                _logger.warning(u'Recording of key {} has no embedded metadata'.format(recording_id))
+            recording_metadata = embedded_metadata
 
         _logger.info(u'Returning recording of key {}'.format(recording_id))
         return MemoryRecording(recording_id, recording_data=full_data, recording_metadata=recording_metadata)
@@ -126,6 +134,13 @@ class MemoryRecording(Recording):
         """
         self.recording_metadata.update(metadata)
 
+    def estimate_size(self):
+        """
+        :return: Estimated size of the recording data and metadata before compression
+        :rtype: int
+        """
+        return estimate_size(self.recording_data) + estimate_size(self.recording_metadata)
+
     def get_metadata(self):
         """
         :return: Recorded metadata
@@ -15,6 +15,9 @@ class SqliteRecording(Recording):
     Recording implementation using SQLite as a storage backend. It's more memory-efficient than the in-memory
     implementation but equally easy to use.
     """
+    # Every SQLite database file starts with this header, used to identify this recording type from its raw data
+    FILE_HEADER = b"SQLite format 3\x00"
+
     @staticmethod
     def new(_id=None):
         with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as db_file:
@@ -57,6 +60,18 @@ class SqliteRecording(Recording):
         with self._connection() as connection:
             connection.execute("INSERT OR REPLACE INTO data VALUES (?, ?)", (key, encode(value, unpicklable=True)))
 
+    def _set_many(self, items):
+        with self._connection() as connection:
+            # A single transaction, in autocommit mode every insert would be committed to the file on its own
+            connection.execute("BEGIN")
+            try:
+                connection.executemany("INSERT OR REPLACE INTO data VALUES (?, ?)",
+                                       ((key, encode(value, unpicklable=True)) for key, value in items))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
     def get_data(self, key):
         return self.get_data_direct(key)
 
@@ -80,3 +95,6 @@ class SqliteRecording(Recording):
 
     def get_metadata(self):
         return self.recording_metadata
+
+    def estimate_size(self):
+        return os.path.getsize(self._db_file_name)
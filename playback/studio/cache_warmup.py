@@ -0,0 +1,187 @@
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from time import time
+
+from playback.studio.recordings_lookup import find_matching_recording_ids, RecordingLookupProperties
+from playback.tape_cassettes.cached.cached_facade import CachedReadOnlyS3TapeCassette
+from playback.tape_recorder import TapeRecorder
+
+_logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class WarmUpProgress(object):
+    """
+    Progress of a cache warm up
+    """
+    def __init__(self, total):
+        """
+        :param total: Total number of recordings to warm up
+        :type total: int
+        """
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.cached_bytes = 0
+        self.cached_files = 0
+        self.budget_reached = False
+        self.start_time = time()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        """
+        :return: Duration of the warm up in seconds so far
+        :rtype: float
+        """
+        return (self.end_time or time()) - self.start_time
+
+    @property
+    def recordings_per_second(self):
+        """
+        :return: Throughput of warmed up recordings
+        :rtype: float
+        """
+        return self.completed / self.duration if self.duration else 0.0
+
+    @property
+    def bytes_per_second(self):
+        """
+        :return: Throughput of cached bytes
+        :rtype: float
+        """
+        return self.cached_bytes / self.duration if self.duration else 0.0
+
+    def __str__(self):
+        return u'{}/{} recordings cached ({} failed), {:.1f} MB in {:.1f} seconds, {:.1f} recordings/s, ' \
+               u'{:.2f} MB/s{}'.format(self.completed, self.total, self.failed, self.cached_bytes / 1024.0 ** 2,
+                                       self.duration, self.recordings_per_second, self.bytes_per_second / 1024.0 ** 2,
+                                       ', cache budget reached' if self.budget_reached else '')
+
+
+def warm_up_cache(tape_cassette, category, lookup_properties, concurrency=8, progress_callback=None):
+    """
+    Fetches every recording matching the given lookup into the local cache of the given cassette concurrently, so
+    later playback runs entirely from local disk. Stops when the local cache budget is reached, as caching further
+    recordings would evict the ones that were just cached
+    :param tape_cassette: Cassette with the local cache to warm up
+    :type tape_cassette: playback.tape_cassettes.cached.cached_facade.CachedReadOnlyS3TapeCassette
+    :param category: Recording category
+    :type category: basestring
+    :param lookup_properties: Recording lookup properties
+    :type lookup_properties: RecordingLookupProperties
+    :param concurrency: Number of recordings to fetch concurrently
+    :type concurrency: int
+    :param progress_callback: Optional function that is called with the progress after each warmed up recording
+    :type progress_callback: function
+    :return: Final progress of the warm up
+    :rtype: WarmUpProgress
+    """
+    recording_ids = list(find_matching_recording_ids(TapeRecorder(tape_cassette), category, lookup_properties))
+    _logger.info(u'Warming up local cache with {} recordings of category {}'.format(len(recording_ids), category))
+
+    progress = WarmUpProgress(len(recording_ids))
+    max_bytes, max_entries = tape_cassette.cache_budget
+    pending_ids = iter(recording_ids)
+    lock = Lock()
+
+    def next_recording_id():
+        with lock:
+            if progress.budget_reached:
+                return None
+            return next(pending_ids, None)
+
+    def warm_up_recordings():
+        recording_id = next_recording_id()
+        while recording_id is not None:
+            try:
+                cached_bytes, cached_files = tape_cassette.warm_up_recording(recording_id)
+            except Exception as ex:  # pylint: disable=broad-except
+                _logger.warning(u'Failed warming up recording {} - {}'.format(recording_id, ex))
+                with lock:
+                    progress.failed += 1
+            else:
+                with lock:
+                    progress.completed += 1
+                    progress.cached_bytes += cached_bytes
+                    progress.cached_files += cached_files
+                    progress.budget_reached = \
+                        (max_bytes is not None and progress.cached_bytes >= max_bytes) or \
+                        (max_entries is not None and progress.cached_files >= max_entries)
+            if progress_callback is not None:
+                with lock:
+                    progress_callback(progress)
+            recording_id = next_recording_id()
+
+    threads = [Thread(target=warm_up_recordings, name='Cache warm up Thread') for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    progress.end_time = time()
+    _logger.info(u'Local cache warm up completed - {}'.format(progress))
+    return progress
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Fetch the recordings matching a lookup into the local cache ahead of a playback run')
+    parser.add_argument('bucket', help='S3 bucket of the recordings')
+    parser.add_argument('category', help='Category of the recordings')
+    parser.add_argument('--key-prefix', default='', help='Key prefix of the recordings')
+    parser.add_argument('--region', default=None, help='AWS region of the bucket')
+    parser.add_argument('--cache-path', default=None, help='Local cache path')
+    parser.add_argument('--start-date', default=None,
+                        help='Earliest recording date (YYYY-MM-DD, UTC), one week ago by default')
+    parser.add_argument('--end-date', default=None, help='Latest recording date (YYYY-MM-DD, UTC)')
+    parser.add_argument('--metadata', default=None, type=json.loads, help='Metadata to filter by, as a JSON object')
+    parser.add_argument('--limit', default=None, type=int, help='Maximal number of recordings')
+    parser.add_argument('--include-incomplete', action='store_true', help='Include incomplete recordings')
+    parser.add_argument('--concurrency', default=8, type=int, help='Number of recordings to fetch concurrently')
+    parser.add_argument('--max-cache-bytes', default=None, type=int, help='Size budget of the local cache')
+    parser.add_argument('--max-cache-entries', default=None, type=int, help='Files budget of the local cache')
+    parser.add_argument('--decoded-cache', action='store_true', help='Also cache recordings in decoded form')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Console entry point of the cache warm up
+    :param argv: Command line arguments, None means sys.argv
+    :type argv: list of str
+    :return: Exit code
+    :rtype: int
+    """
+    args = _parse_args(argv)
+    start_date = datetime.strptime(args.start_date, DATE_FORMAT) if args.start_date else \
+        datetime.utcnow() - timedelta(days=7)
+    end_date = datetime.strptime(args.end_date, DATE_FORMAT) + timedelta(days=1) if args.end_date else None
+
+    tape_cassette = CachedReadOnlyS3TapeCassette(
+        args.bucket, key_prefix=args.key_prefix, region=args.region, local_path=args.cache_path,
+        max_pool_connections=max(10, args.concurrency), max_cache_bytes=args.max_cache_bytes,
+        max_cache_entries=args.max_cache_entries, decoded_cache=args.decoded_cache)
+    lookup_properties = RecordingLookupProperties(start_date, end_date=end_date, metadata=args.metadata,
+                                                  limit=args.limit, skip_incomplete=not args.include_incomplete)
+
+    def print_progress(progress):
+        print(u'\r{}'.format(progress), end='')
+        sys.stdout.flush()
+
+    progress = warm_up_cache(tape_cassette, args.category, lookup_properties, concurrency=args.concurrency,
+                             progress_callback=print_progress)
+    print(u'\rDone: {}'.format(progress))
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
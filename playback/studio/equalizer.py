@@ -3,8 +3,9 @@ import os
 import signal
 import sys
 import traceback
-from collections import Counter, namedtuple
-from time import time
+from collections import Counter, deque, namedtuple
+from itertools import islice
+from time import sleep, time
 
 from enum import Enum
 
@@ -13,10 +14,18 @@ try:
 except ImportError:
     from io import StringIO  # for Python 3
 
+try:
+    from multiprocessing.connection import wait as _wait_for_ready  # Python 3
+except ImportError:
+    _wait_for_ready = None  # Python 2 has no way to wait on connections and processes together
+
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Interval in seconds of polling the playback processes when they cannot be waited on
+_POLL_INTERVAL = 0.01
+
 
 """
 Equal               - The recorded and playback compared outputs are considered equal
@@ -97,8 +106,9 @@ class Comparison(object):
 
 
 class CompareExecutionConfig(object):
-    def __init__(self, keep_results_in_comparison=False, compare_in_dedicated_process=False,
-                 compare_process_recycle_rate=5, compare_process_timeout=10 * 60):
+    def __init__(self, keep_results_in_comparison=False,  # pylint: disable=too-many-arguments
+                 compare_in_dedicated_process=False, compare_process_recycle_rate=5, compare_process_timeout=10 * 60,
+                 compare_processes=1, compare_chunk_size=1, compare_results_in_order=True):
         """
         :param keep_results_in_comparison: Whether to keep results in the comparison result object
         :type keep_results_in_comparison: bool
@@ -110,11 +120,85 @@ class CompareExecutionConfig(object):
         :type compare_process_recycle_rate: int
         :param compare_process_timeout: Time in seconds to wait for compare process to end before aborting it
         :type compare_process_timeout: float
+        :param compare_processes: If comparing in a dedicated process, how many such processes compare recordings in
+        parallel, each one is recycled and aborted on timeout independently
+        :type compare_processes: int
+        :param compare_chunk_size: If comparing in more than one dedicated process, how many recordings are dispatched
+        to a process at once
+        :type compare_chunk_size: int
+        :param compare_results_in_order: If comparing in more than one dedicated process, whether comparisons are
+        yielded in the order of the recording ids or in the order they are completed
+        :type compare_results_in_order: bool
         """
         self.keep_results_in_comparison = keep_results_in_comparison
         self.compare_in_dedicated_process = compare_in_dedicated_process
         self.compare_process_recycle_rate = compare_process_recycle_rate
         self.compare_process_timeout = compare_process_timeout
+        self.compare_processes = compare_processes
+        self.compare_chunk_size = compare_chunk_size
+        self.compare_results_in_order = compare_results_in_order
+
+
+def _wait_for_processes(connections, processes, timeout):
+    """
+    Waits until one of the playback processes has sent a message or has ended
+    :param connections: Connections to the playback processes
+    :type connections: list[multiprocessing.connection.Connection]
+    :param processes: The playback processes, matching the connections
+    :type processes: list[multiprocessing.Process]
+    :param timeout: Maximal time in seconds to wait
+    :type timeout: float
+    :return: Indices of the processes that have sent a message or have ended, empty if timed out
+    :rtype: list[int]
+    """
+    if _wait_for_ready is not None:
+        ready = set(_wait_for_ready(list(connections) + [process.sentinel for process in processes], timeout))
+        return [i for i, (connection, process) in enumerate(zip(connections, processes))
+                if connection in ready or process.sentinel in ready]
+
+    deadline = time() + timeout
+    while True:
+        ready = [i for i, (connection, process) in enumerate(zip(connections, processes))
+                 if connection.poll() or not process.is_alive()]
+        if ready or time() >= deadline:
+            return ready
+        sleep(min(_POLL_INTERVAL, max(0, deadline - time())))
+
+
+def _receive_from_process(connection):
+    """
+    :param connection: Connection to a playback process that was reported ready
+    :type connection: multiprocessing.connection.Connection
+    :return: Message sent by the process, None if the process has ended without sending one
+    :rtype: Any
+    """
+    try:
+        if connection.poll():
+            return connection.recv()
+    except (EOFError, IOError, OSError):
+        pass
+    return None
+
+
+class _PlaybackWorker(object):
+    """
+    A playback process of the pool and the chunk of recordings it was dispatched
+    """
+    def __init__(self, process, connection):
+        """
+        :param process: The playback process
+        :type process: multiprocessing.Process
+        :param connection: Connection to the process, used to dispatch chunks and receive their results
+        :type connection: multiprocessing.connection.Connection
+        """
+        self.process = process
+        self.connection = connection
+        # Number of recordings dispatched to the process since it was created
+        self.age = 0
+        # Dispatched tasks (index and recording id) without a result yet, the first one is being played
+        self.tasks = deque()
+        # Time by which the result of the task that is being played is expected
+        self.deadline = None
 
 
 PlayAndCompareResult = namedtuple(
@@ -149,11 +233,10 @@ class Equalizer(object):
         self.comparator = comparator
         self.compare_execution_config = compare_execution_config or CompareExecutionConfig()
         # Init multiprocess related properties
-        self._compare_tasks = mp.Queue()
-        self._compare_results = mp.Queue()
-        self._terminate_process = mp.Event()
         self._compare_process = None
+        self._compare_connection = None
         self._compare_process_age = 0
+        self._pool_workers = []
 
     def run_comparison(self):
         """
@@ -165,9 +248,11 @@ class Equalizer(object):
         iteration = 0
         completed = False
         try:
-            for iteration, recording_id in enumerate(self.recording_ids, start=1):
+            for iteration, (recording_id, play_and_compare_result, error) in enumerate(
+                    self._iter_play_and_compare_results(), start=1):
                 try:
-                    play_and_compare_result = self._play_and_compare_recording_within_worker(recording_id)
+                    if error is not None:
+                        raise error
                     playback = play_and_compare_result.playback
 
                     # Since comparison was done in another process and result may not be serializable accross processes,
@@ -214,13 +299,202 @@ class Equalizer(object):
             completed = True
 
         finally:
-            self._terminate_process.set()
-            self._compare_tasks.close()
-            self._compare_results.close()
+            self._terminate_player_process()
+            self._terminate_pool_workers()
             log_prefix = u'Completed all' if completed else u'Error during playback, executed'
             _logger.info(u'{} {} iterations, {}'.format(
                 log_prefix, iteration, Equalizer._comparison_stats_repr(counter)))
 
+    def _iter_play_and_compare_results(self):
+        """
+        Plays and compares the recordings, in a pool of dedicated processes if configured to use more than one
+        :return: Iterator of recording id, its play and compare result and the error that prevented getting the result
+        :rtype: collections.Iterator[(str, PlayAndCompareResult, builtins.Exception)]
+        """
+        config = self.compare_execution_config
+        if config.compare_in_dedicated_process and config.compare_processes > 1:
+            for result in self._iter_pooled_play_and_compare_results():
+                yield result
+            return
+
+        for recording_id in self.recording_ids:
+            try:
+                play_and_compare_result = self._play_and_compare_recording_within_worker(recording_id)
+            except Exception as ex:  # pylint: disable=broad-except
+                yield recording_id, None, ex
+                continue
+            yield recording_id, play_and_compare_result, None
+
+    def _iter_pooled_play_and_compare_results(self):
+        """
+        Plays and compares the recordings in a pool of dedicated processes, each process is dispatched a chunk of
+        recordings at a time and plays them one after the other
+        :return: Iterator of recording id, its play and compare result and the error that prevented getting the result
+        :rtype: collections.Iterator[(str, PlayAndCompareResult, builtins.Exception)]
+        """
+        config = self.compare_execution_config
+        indexed_recording_ids = enumerate(self.recording_ids)
+        # Tasks of a process that was aborted which are dispatched again to the other processes
+        redispatched_tasks = deque()
+        self._pool_workers = [None] * config.compare_processes
+        buffered_results = {}
+        next_index = 0
+        while True:
+            for slot in range(len(self._pool_workers)):
+                self._dispatch_chunk_to_pool_worker(slot, indexed_recording_ids, redispatched_tasks)
+
+            running_workers = [worker for worker in self._pool_workers if worker is not None and worker.tasks]
+            if not running_workers:
+                return
+
+            for index, result in self._collect_pool_results(running_workers, redispatched_tasks):
+                if not config.compare_results_in_order:
+                    yield result
+                    continue
+                buffered_results[index] = result
+                while next_index in buffered_results:
+                    yield buffered_results.pop(next_index)
+                    next_index += 1
+
+    def _dispatch_chunk_to_pool_worker(self, slot, indexed_recording_ids, redispatched_tasks):
+        """
+        Dispatches a chunk of recordings to the process of the given pool slot if it is idle, the process is created
+        or recycled if needed
+        :param slot: Slot of the process in the pool
+        :type slot: int
+        :param indexed_recording_ids: Iterator of the recording ids that are not dispatched yet and their index
+        :type indexed_recording_ids: collections.Iterator[(int, str)]
+        :param redispatched_tasks: Tasks that should be dispatched before the rest of the recording ids
+        :type redispatched_tasks: collections.deque
+        """
+        worker = self._pool_workers[slot]
+        if worker is not None and worker.tasks:
+            return
+
+        config = self.compare_execution_config
+        recycle = worker is not None and worker.age >= config.compare_process_recycle_rate
+        age = 0 if worker is None or recycle else worker.age
+        chunk_size = max(1, min(config.compare_chunk_size, config.compare_process_recycle_rate - age))
+        chunk = []
+        while redispatched_tasks and len(chunk) < chunk_size:
+            chunk.append(redispatched_tasks.popleft())
+        chunk.extend(islice(indexed_recording_ids, chunk_size - len(chunk)))
+        if not chunk:
+            return
+
+        if recycle:
+            self._stop_pool_worker(worker)
+            worker = None
+        if worker is None:
+            worker = self._create_pool_worker()
+            self._pool_workers[slot] = worker
+
+        worker.connection.send([recording_id for _, recording_id in chunk])
+        worker.tasks.extend(chunk)
+        worker.age += len(chunk)
+        worker.deadline = time() + config.compare_process_timeout
+
+    def _collect_pool_results(self, running_workers, redispatched_tasks):
+        """
+        Waits for the results of the running pool processes, aborting processes that died or timed out
+        :param running_workers: Pool processes that have dispatched tasks
+        :type running_workers: list[_PlaybackWorker]
+        :param redispatched_tasks: Tasks of an aborted process that were not played yet are added here
+        :type redispatched_tasks: collections.deque
+        :return: Index of the played recording and its result (recording id, play and compare result, error)
+        :rtype: list[(int, (str, PlayAndCompareResult, builtins.Exception))]
+        """
+        results = []
+        wait_time = max(0, min(worker.deadline for worker in running_workers) - time())
+        ready = _wait_for_processes([worker.connection for worker in running_workers],
+                                    [worker.process for worker in running_workers], wait_time)
+        for i in ready:
+            worker = running_workers[i]
+            message = _receive_from_process(worker.connection)
+            if message is None:
+                self._abort_pool_worker(worker, Exception("playback process have died"), results, redispatched_tasks)
+                continue
+            succeeded, result = message
+            index, recording_id = worker.tasks.popleft()
+            worker.deadline = time() + self.compare_execution_config.compare_process_timeout
+            if succeeded:
+                results.append((index, (recording_id, result, None)))
+            else:
+                results.append((index, (recording_id, None, Exception(result))))
+
+        for worker in running_workers:
+            if worker.tasks and time() > worker.deadline:
+                _logger.warning(u'Waiting for comparison result of process {} timed out'.format(worker.process.pid))
+                self._kill_pool_worker(worker)
+                self._abort_pool_worker(worker, Exception("timeout while running recording playback and comparison"),
+                                        results, redispatched_tasks)
+        return results
+
+    def _abort_pool_worker(self, worker, error, results, redispatched_tasks):
+        """
+        Removes a pool process that died or was killed, failing the task it was playing
+        :param worker: The aborted pool process
+        :type worker: _PlaybackWorker
+        :param error: Error to fail the task that was being played with
+        :type error: builtins.Exception
+        :param results: The failed task is added to these results
+        :type results: list[(int, (str, PlayAndCompareResult, builtins.Exception))]
+        :param redispatched_tasks: The rest of the tasks of the process are added here
+        :type redispatched_tasks: collections.deque
+        """
+        index, recording_id = worker.tasks.popleft()
+        results.append((index, (recording_id, None, error)))
+        redispatched_tasks.extendleft(reversed(worker.tasks))
+        worker.tasks.clear()
+        worker.connection.close()
+        self._pool_workers[self._pool_workers.index(worker)] = None
+
+    def _create_pool_worker(self):
+        """
+        Creates and starts a new pool process, ready to take chunks of playback tasks
+        :return: The new pool process
+        :rtype: _PlaybackWorker
+        """
+        process, connection = self._start_playback_process()
+        return _PlaybackWorker(process, connection)
+
+    @staticmethod
+    def _stop_pool_worker(worker):
+        """
+        Signals an idle pool process to terminate and waits for it to do so
+        :param worker: Pool process to stop
+        :type worker: _PlaybackWorker
+        """
+        Equalizer._stop_playback_process(worker.process, worker.connection)
+
+    @staticmethod
+    def _kill_pool_worker(worker):
+        """
+        Kills a pool process
+        :param worker: Pool process to kill
+        :type worker: _PlaybackWorker
+        """
+        try:
+            os.kill(worker.process.pid, signal.SIGKILL)
+        except OSError as ex:
+            # Don't fail when could not kill
+            _logger.warning(u'Error while killing worker, {}'.format(str(ex)))
+        worker.process.join()
+
+    def _terminate_pool_workers(self):
+        """
+        Terminates all the pool processes, processes that are still playing are killed
+        """
+        for worker in self._pool_workers:
+            if worker is None:
+                continue
+            if worker.tasks:
+                self._kill_pool_worker(worker)
+                worker.connection.close()
+            else:
+                self._stop_pool_worker(worker)
+        self._pool_workers = []
+
     def _play_and_compare_recording_within_worker(self, recording_id):
         """
         Play the given recording id and compare the outputs in a worker, the worker process is determined by the
@@ -237,27 +511,20 @@ class Equalizer(object):
 
         self._create_or_recycle_player_process_if_needed()
 
-        # Queue the task for the playback process and wait for its result
-        self._compare_tasks.put(recording_id)
-        start_time = time()
-        timed_out = True
-        while time() - start_time <= self.compare_execution_config.compare_process_timeout:
-            try:
-                succeeded, result = self._compare_results.get(True, 1)
-                timed_out = False
-
-                if not succeeded:
-                    raise Exception(result)
-
-                break
-            except mp.queues.Empty:
-                if not self._compare_process.is_alive():
-                    self._compare_process = None
-                    raise Exception("playback process have died")
-
-        if timed_out:
+        # Send the task to the playback process and wait for its result
+        self._compare_connection.send([recording_id])
+        if not _wait_for_processes([self._compare_connection], [self._compare_process],
+                                   self.compare_execution_config.compare_process_timeout):
             self._handle_compare_execution_timeout()
 
+        message = _receive_from_process(self._compare_connection)
+        if message is None:
+            self._discard_player_process()
+            raise Exception("playback process have died")
+
+        succeeded, result = message
+        if not succeeded:
+            raise Exception(result)
         return result
 
     def _handle_compare_execution_timeout(self):
@@ -271,7 +538,7 @@ class Equalizer(object):
             except OSError as ex:
                 # Don't fail when could not kill
                 _logger.warning(u'Error while killing worker, {}'.format(str(ex)))
-        self._compare_process = None
+        self._discard_player_process()
         raise Exception("timeout while running recording playback and comparison")
 
     def _kill_compare_process(self):
@@ -281,6 +548,23 @@ class Equalizer(object):
         """
         os.kill(self._compare_process.pid, signal.SIGKILL)
 
+    def _discard_player_process(self):
+        """
+        Discards the player process after it died or was killed
+        """
+        self._compare_connection.close()
+        self._compare_connection = None
+        self._compare_process = None
+
+    def _terminate_player_process(self):
+        """
+        Signals the player process to terminate, if there is one, and waits for it to do so
+        """
+        if self._compare_process is not None:
+            self._stop_playback_process(self._compare_process, self._compare_connection)
+            self._compare_process = None
+            self._compare_connection = None
+
     def _create_or_recycle_player_process_if_needed(self):
         """
         Creates a new player resources if one of the following conditions is met:
@@ -290,12 +574,7 @@ class Equalizer(object):
         # Process too old, recycle
         if self._compare_process is not None and \
                 self._compare_process_age >= self.compare_execution_config.compare_process_recycle_rate:
-            # Signal process to terminate and wait for it to do so
-            self._terminate_process.set()
-            self._compare_process.join()
-            self._compare_process = None
-            # Reset terminate state
-            self._terminate_process.clear()
+            self._terminate_player_process()
 
         if self._compare_process is None:
             self._create_new_player_process()
@@ -307,29 +586,56 @@ class Equalizer(object):
         """
         Creates and start new player process, ready to take playback tasks
         """
-        self._compare_process = mp.Process(
-            target=self._playback_process_target, name='Playback runner')
-        self._compare_process.start()
+        self._compare_process, self._compare_connection = self._start_playback_process()
         self._compare_process_age = 0
 
-    def _playback_process_target(self):
+    def _start_playback_process(self):
         """
-        Entry point for the playback process (target function),
+        Creates and starts a new playback process
+        :return: The playback process and the connection to it
+        :rtype: (multiprocessing.Process, multiprocessing.connection.Connection)
         """
-        while not self._terminate_process.is_set():
-            try:
-                recording_id = self._compare_tasks.get(True, 0.05)
+        connection, process_connection = mp.Pipe()
+        process = mp.Process(
+            target=self._playback_process_target, args=(process_connection,), name='Playback runner')
+        process.start()
+        # Only the playback process should hold its end of the pipe
+        process_connection.close()
+        return process, connection
+
+    @staticmethod
+    def _stop_playback_process(process, connection):
+        """
+        Signals an idle playback process to terminate and waits for it to do so
+        :param process: The playback process
+        :type process: multiprocessing.Process
+        :param connection: Connection to the process
+        :type connection: multiprocessing.connection.Connection
+        """
+        try:
+            connection.send(None)
+        except (IOError, OSError):
+            # The process has already ended
+            pass
+        connection.close()
+        process.join()
+
+    def _playback_process_target(self, connection):
+        """
+        Entry point for the playback process (target function), plays the chunks of recording ids it receives and sends
+        back the result of each recording, until it receives None
+        :param connection: Connection to the comparing process
+        :type connection: multiprocessing.connection.Connection
+        """
+        for recording_ids in iter(connection.recv, None):
+            for recording_id in recording_ids:
                 try:
                     execution_result = self._play_and_compare_recording(recording_id)
-                    self._compare_results.put((True, execution_result))
+                    connection.send((True, execution_result))
                 except Exception as ex:  # pylint: disable=broad-except
                     logging.info(u'Failure during play and compare in playback process of id {} - {}'.format(
                         recording_id, ex))
-                    self._compare_results.put((False, str(ex)))
-            except mp.queues.Empty:
-                # Every 0.05 second the process will get this as we poll with 0.05 second timeout
-                # (in order to listen to termination event)
-                pass
+                    connection.send((False, str(ex)))
 
     def _play_and_compare_recording(self, recording_id):
         """
@@ -1,5 +1,9 @@
+import base64
+import binascii
+import json
 from abc import ABCMeta, abstractmethod
 from fnmatch import fnmatch
+from itertools import islice
 
 
 class TapeCassette(object):
@@ -60,12 +64,29 @@ class TapeCassette(object):
 
     def save_recording(self, recording):
         """
-        Saves given recording
+        Saves given recording, the id of the recording is set to its final id before it is saved
         :param recording: Recording to save
         :type recording: playback.recording.Recording
+        :return: Id the recording is saved with
+        :rtype: str
         """
+        recording.id = self.get_final_recording_id(recording)
         self._save_recording(recording)
         recording.close()
+        return recording.id
+
+    def get_final_recording_id(self, recording):
+        # pylint: disable=no-self-use
+        """
+        Cassettes whose recording ids depend on the recording metadata, which is only complete when the recording is
+        saved, override this to derive the final id. Must return the same id when called again with a recording whose
+        id is already final
+        :param recording: Recording that is about to be saved
+        :type recording: playback.recording.Recording
+        :return: Id the given recording is saved with, by default the id it was created with
+        :rtype: str
+        """
+        return recording.id
 
     @abstractmethod
     def _save_recording(self, recording):
@@ -98,6 +119,59 @@ class TapeCassette(object):
         """
         pass
 
+    def get_recording_ids_page(self, category, start_date=None, end_date=None, metadata=None, page_size=100,
+                               cursor=None):
+        """
+        Fetches a page of recording ids matching the given search parameters, the search can be continued (also by
+        another process) using the returned opaque cursor
+        :param category: Recordings category
+        :type category: str
+        :param start_date: Optional recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :param page_size: Maximal number of ids in the page
+        :type page_size: int
+        :param cursor: Cursor returned by the previous page of the same search, None to start the search
+        :type cursor: str
+        :return: Page of recording ids and the cursor of the next page, None if there are no more results
+        :rtype: (list of str, str)
+        """
+        # Generic implementation that skips the already returned results, cassettes that can resume their underlying
+        # listing should override this
+        offset = self._decode_cursor(cursor)['offset'] if cursor else 0
+        recording_ids = list(islice(
+            self.iter_recording_ids(category, start_date, end_date, metadata, limit=offset + page_size), offset, None))
+        next_cursor = self._encode_cursor({'offset': offset + page_size}) \
+            if recording_ids and len(recording_ids) == page_size else None
+        return recording_ids, next_cursor
+
+    @staticmethod
+    def _encode_cursor(state):
+        """
+        :param state: Json serializable search state
+        :type state: dict
+        :return: Opaque cursor representing the given state
+        :rtype: str
+        """
+        return base64.urlsafe_b64encode(json.dumps(state, sort_keys=True).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """
+        :param cursor: Opaque cursor created by _encode_cursor
+        :type cursor: str
+        :return: Search state held by the cursor
+        :rtype: dict
+        :raises: ValueError
+        """
+        try:
+            return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise ValueError(u'Invalid search cursor {}'.format(cursor))
+
     def iter_recordings_metadata(self, category, start_date=None, end_date=None, metadata=None, limit=None):
         """
         Creates an iterator of recordings metadata matching the given search parameters
@@ -1,58 +1,189 @@
 import logging
-import queue
-from threading import Event, Thread
+import os
+import weakref
+from functools import partial
+from threading import Lock, Thread
+from time import time
 
 from playback.recordings.memory.memory_recording import MemoryRecording
 from playback.tape_cassette import TapeCassette
+from playback.tape_cassettes.asynchronous.operations_queue import OperationsQueue, QueueFullPolicy
+from playback.tape_cassettes.asynchronous.recording_spool import RecordingSpool
+from playback.utils.size_estimation import estimate_size
 
 _logger = logging.getLogger(__name__)
 
 
+def _reinit_after_fork(tape_cassette_ref):
+    """
+    Called in a child process after a fork, a weak reference is used since fork handlers cannot be unregistered
+    :param tape_cassette_ref: Weak reference to the cassette
+    :type tape_cassette_ref: weakref.ref
+    """
+    tape_cassette = tape_cassette_ref()
+    if tape_cassette is not None:
+        tape_cassette._reinit_after_fork()  # pylint: disable=protected-access
+
+
 class AsyncRecordOnlyTapeCassette(TapeCassette):
     # pylint: disable=too-many-instance-attributes
     """
     Wraps TapeCassette with asynchronous execution of the operation that change the state of the recording, this
     cassette can only be used for recording and for playback
     """
-    def __init__(self, tape_cassette, flush_interval=0.1, timeout_on_close=10):
+    def __init__(self, tape_cassette, flush_interval=0.1, timeout_on_close=10,  # pylint: disable=too-many-arguments
+                 max_queue_items=None, max_queue_bytes=None, queue_full_policy=QueueFullPolicy.BLOCK,
+                 queue_block_timeout=None, flush_workers=1, batch_max_items=1, batch_max_bytes=None,
+                 batch_max_age=None, spool_path=None,
+                 spool_segment_max_bytes=RecordingSpool.DEFAULT_SEGMENT_MAX_BYTES, lazy_start=False):
         """
         :param tape_cassette: The storage driver to hold the recording in and wrap with asynchronous behaviour
         :type tape_cassette: playback.tape_cassette.TapeCassette
-        :param flush_interval: Interval to flush recording to the underlying storage (tape cassette)
+        :param flush_interval: Deprecated and ignored, recording operations are flushed to the underlying storage (tape
+        cassette) as soon as they are added
         :type flush_interval: float
         :param timeout_on_close: How much time to wait for joining recording thread on close
         :type timeout_on_close: float
+        :param max_queue_items: Optional maximal number of pending recording operations
+        :type max_queue_items: int
+        :param max_queue_bytes: Optional maximal estimated size in bytes of the data held by pending recording
+        operations
+        :type max_queue_bytes: int
+        :param queue_full_policy: What to do when the pending operations exceed their bounds, block the recording
+        caller ('block'), drop the recording being recorded ('drop_newest') or drop the oldest pending recording that
+        none of its operations started yet ('drop_oldest'). Dropped recordings are aborted and never saved
+        :type queue_full_policy: str
+        :param queue_block_timeout: When blocking, maximal time in seconds to block the caller before dropping the
+        recording being recorded, None means blocking until there is room
+        :type queue_block_timeout: float
+        :param flush_workers: Number of threads that flush recordings to the underlying storage, different recordings
+        are flushed in parallel while the operations of each recording are flushed in order
+        :type flush_workers: int
+        :param batch_max_items: Maximal number of data and metadata changes of a recording that are buffered and added
+        as one operation, applying data changes with a single Recording.set_many call. Buffered changes are added when
+        the recording is saved, when one of the batch thresholds is reached or when the recording data is read. The
+        default of 1 adds each change as its own operation
+        :type batch_max_items: int
+        :param batch_max_bytes: Optional maximal estimated size in bytes of the buffered changes of a recording
+        :type batch_max_bytes: int
+        :param batch_max_age: Optional maximal time in seconds since the first buffered change of a recording, checked
+        whenever a change is made
+        :type batch_max_age: float
+        :param spool_path: Optional directory of a durable local spool, when given saved recordings are appended to
+        the spool and a spool uploader saves them to the underlying storage with retries. Recordings that are not
+        saved when the cassette closes or the process dies are kept in the spool and saved when a cassette with the
+        same spool path starts
+        :type spool_path: str
+        :param spool_segment_max_bytes: Size in bytes of the spool segment files
+        :type spool_segment_max_bytes: int
+        :param lazy_start: Whether the recording threads are started when the first recording is created, rather than
+        by calling start
+        :type lazy_start: bool
+
+        The cassette is fork safe, a child process that is forked from a process holding the cassette (e.g. a pre-fork
+        server worker) gets its own operations queue and recording threads, started when it creates its first
+        recording if the cassette was started in the parent. Operations that were pending in the parent are left for
+        the parent to flush. When a spool is used, each child spools to a worker-<pid> sub directory of the spool path,
+        recordings left there by a child that died are saved by the next cassette or child that starts with the spool
         """
         self.wrapped_tape_cassette = tape_cassette
         self._flush_interval = flush_interval
         self._timeout_on_close = timeout_on_close
-        self._stop_event = Event()
-        self._operations_queue = queue.Queue()
-        self._update_recording_thread = Thread(target=self._recording_loop, name="AsyncTapeCassette Thread")
-        self._update_recording_thread.setDaemon(True)
+        self._batch_max_items = batch_max_items
+        self._batch_max_bytes = batch_max_bytes
+        self._batch_max_age = batch_max_age
+        self._max_queue_items = max_queue_items
+        self._max_queue_bytes = max_queue_bytes
+        self._queue_full_policy = queue_full_policy
+        self._queue_block_timeout = queue_block_timeout
+        self._flush_workers = flush_workers
+        self._spool_path = spool_path
+        self._spool_segment_max_bytes = spool_segment_max_bytes
+        self._lazy_start = lazy_start
+        self._closed = False
+        self._init_recording_state(spool_path)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=partial(_reinit_after_fork, weakref.ref(self)))
+
+    def _init_recording_state(self, spool_path):
+        """
+        Creates the operations queue, the spool and the recording threads, which are not started yet
+        :param spool_path: Optional directory of the spool
+        :type spool_path: str
+        """
+        self._operations_queue = OperationsQueue(self._abort_dropped_recording, max_items=self._max_queue_items,
+                                                 max_bytes=self._max_queue_bytes, full_policy=self._queue_full_policy,
+                                                 block_timeout=self._queue_block_timeout)
+        self._spool = RecordingSpool(spool_path, self.wrapped_tape_cassette,
+                                     segment_max_bytes=self._spool_segment_max_bytes, workers_path=self._spool_path) \
+            if spool_path is not None else None
+        self._update_recording_threads = []
+        for i in range(max(1, self._flush_workers)):
+            thread = Thread(target=self._recording_loop,
+                            name="AsyncTapeCassette Thread" + (" {}".format(i) if i else ""))
+            thread.setDaemon(True)
+            self._update_recording_threads.append(thread)
+        self._start_lock = Lock()
         self._started = False
 
+    def _reinit_after_fork(self):
+        """
+        Replaces the state that was copied from the parent process, whose recording threads do not exist in this
+        process and whose queue and locks may have been copied in the middle of an operation
+        """
+        if self._closed:
+            return
+        started_in_parent = self._started
+        spool_path = os.path.join(self._spool_path, RecordingSpool.WORKER_DIR_PREFIX + str(os.getpid())) \
+            if self._spool_path is not None else None
+        self._init_recording_state(spool_path)
+        self._lazy_start = self._lazy_start or started_in_parent
+
+    @property
+    def dropped_recordings(self):
+        """
+        :return: Number of recordings that were dropped because the pending operations exceeded their bounds
+        :rtype: int
+        """
+        return self._operations_queue.dropped_recordings
+
+    @property
+    def dropped_operations(self):
+        """
+        :return: Number of recording operations that were dropped because the pending operations exceeded their bounds
+        :rtype: int
+        """
+        return self._operations_queue.dropped_operations
+
     def start(self):
         """
-        Starts the recording thread
+        Starts the recording threads
         """
         _logger.info("Starting AsyncTapeCassette")
         self._started = True
-        self._update_recording_thread.start()
+        if self._spool is not None:
+            self._spool.start()
+        for thread in self._update_recording_threads:
+            thread.start()
 
     def close(self):
         """
-        Signal the cassette to close, this will signal the underlying thread to stop waiting for more recording and
-        will join it until its completed sending remaining recordings using the given timeout
+        Signal the cassette to close, this will signal the underlying threads to stop waiting for more recording and
+        will join them until they completed sending remaining recordings using the given timeout
         """
         _logger.info("Shutting down AsyncTapeCassette (joining for {}s)".format(self._timeout_on_close))
+        self._closed = True
         self._started = False
-        self._stop_event.set()
-        try:
-            self._update_recording_thread.join(self._timeout_on_close)
-        except RuntimeError:
-            # If thread was not started
-            pass
+        self._operations_queue.stop()
+        deadline = time() + self._timeout_on_close
+        for thread in self._update_recording_threads:
+            try:
+                thread.join(max(0, deadline - time()))
+            except RuntimeError:
+                # If thread was not started
+                pass
+        if self._spool is not None:
+            self._spool.close(max(0, deadline - time()))
         self.wrapped_tape_cassette.close()
         _logger.info("AsyncTapeCassette has shutdown")
 
@@ -73,31 +204,81 @@ class AsyncRecordOnlyTapeCassette(TapeCassette):
         :return: Creates a new recording object
         :rtype: playback.recording.Recording
         """
+        if not self._started and self._lazy_start and not self._closed:
+            with self._start_lock:
+                if not self._started:
+                    self.start()
         assert self._started, "Recording thread is not running"
         # The assumption is that create new recording is not a long running task and hence we can do it synchronously,
         # if that will not be the case the creation it self needs to become async as well
         return AsyncRecording(
             self.wrapped_tape_cassette.create_new_recording(category),
             self._add_async_operation,
-            self._wait_for_flush
+            self._wait_for_flush,
+            batch_max_items=self._batch_max_items,
+            batch_max_bytes=self._batch_max_bytes,
+            batch_max_age=self._batch_max_age,
+            measure_size=self._max_queue_bytes is not None
         )
 
-    def _add_async_operation(self, func):
+    def get_final_recording_id(self, recording):
+        """
+        :param recording: Recording that is about to be saved
+        :type recording: AsyncRecording
+        :return: Id the given recording is saved with by the underlying cassette
+        :rtype: str
+        """
+        return self.wrapped_tape_cassette.get_final_recording_id(recording)
+
+    def abort_recording(self, recording=None):
+        """
+        Aborts given recording without saving it
+        :param recording: Recording to abort
+        :type recording: AsyncRecording
+        """
+        recording.discard_batch()
+        self._add_async_operation(lambda: self.wrapped_tape_cassette.abort_recording(recording.wrapped_recording),
+                                  recording=recording, last=True)
+        recording.close()
+
+    def _add_async_operation(self, func, recording=None, size=0, last=False):
         """
         Adds operation to be executed asynchronously
         :param func: Operation to execute
         :type func: function
+        :param recording: Recording the operation belongs to
+        :type recording: AsyncRecording
+        :param size: Estimated size in bytes of the data the operation holds
+        :type size: int
+        :param last: Whether this is the last operation of the recording
+        :type last: bool
         """
-        self._operations_queue.put(func)
+        self._operations_queue.put(func, recording=recording, size=size, last=last)
 
-    def _wait_for_flush(self):
+    def _abort_dropped_recording(self, recording):
+        """
+        Aborts a recording that was dropped because the pending operations exceeded their bounds
+        :param recording: Dropped recording
+        :type recording: AsyncRecording
         """
-        Waits for the completion of all operations in the operations queue.
+        _logger.warning(u'Dropped recording {} as pending recording operations exceeded their bounds ({} recordings '
+                        u'dropped so far)'.format(recording.id, self.dropped_recordings))
+        self.wrapped_tape_cassette.abort_recording(recording.wrapped_recording)
 
-        This method blocks the execution until all tasks in the operations queue
+    def _wait_for_flush(self, recording=None):
+        """
+        Waits for the completion of the operations of the given recording, or of all operations in the operations
+        queue if no recording is given.
+
+        This method blocks the execution until the relevant tasks in the operations queue
         have been processed and marked as complete.
+        :param recording: Optional recording to wait for its operations only
+        :type recording: AsyncRecording
         """
-        self._operations_queue.join()
+        if recording is None:
+            self._operations_queue.join()
+        else:
+            self._operations_queue.join_recording(recording)
 
     def _save_recording(self, recording):
         """
@@ -105,43 +286,42 @@ class AsyncRecordOnlyTapeCassette(TapeCassette):
         :param recording: Recording to save
         :type recording: AsyncRecording
         """
-        self._add_async_operation(lambda: self.wrapped_tape_cassette.save_recording(recording.wrapped_recording))
+        recording.flush_batch()
+        if self._spool is not None:
+            self._add_async_operation(lambda: self._spool_recording(recording.wrapped_recording),
+                                      recording=recording, last=True)
+        else:
+            self._add_async_operation(lambda: self.wrapped_tape_cassette.save_recording(recording.wrapped_recording),
+                                      recording=recording, last=True)
 
-    def _recording_loop(self):
+    def _spool_recording(self, recording):
         """
-        Runs the recording loop in a dedicated thread
+        Appends a recording to the spool to be saved by the spool uploader
+        :param recording: Recording to spool
+        :type recording: playback.recording.Recording
         """
-        _logger.info('Async recording thread started')
-        while not self._stop_event.is_set():
-            self._flush_recording()
-            self._stop_event.wait(self._flush_interval)
-
-        _logger.info('Async recording thread signaled to stop thread, flushing any pending recording')
+        self._spool.append(recording)
+        recording.close()
 
-        # Flush any pending recording
-        self._flush_recording()
-        _logger.info('Async recording thread stopped')
-
-    def _flush_recording(self):
+    def _recording_loop(self):
         """
-        Flush current pending operations to the underlying storage. This method is blocking till all pending operations
-        are executed.
+        Runs the recording loop in a dedicated thread
         """
-        _logger.debug('Flushing pending recording operations')
-        while True:
+        _logger.info('Async recording thread started')
+        # Blocks until an operation is added, once the queue is stopped the pending operations are still flushed and
+        # None is returned when there are no more operations
+        operation = self._operations_queue.get()
+        while operation is not None:
             try:
-                operation = self._operations_queue.get_nowait()
-
-                try:
-                    operation()
-                except Exception as ex:  # pylint: disable=broad-except
-                    _logger.exception(u"Error running recording operation - {}".format(ex))
+                operation()
+            except Exception as ex:  # pylint: disable=broad-except
+                _logger.exception(u"Error running recording operation - {}".format(ex))
 
-                # Mark the task as done. Once all tasks have been marked as completed,
-                # the join() method will return.
-                self._operations_queue.task_done()
-            except queue.Empty:
-                break
+            # Mark the task as done, which allows the next operation of its recording to be executed. Once all
+            # tasks have been marked as completed, the join() method will return.
+            self._operations_queue.task_done(operation)
+            operation = self._operations_queue.get()
+        _logger.info('Async recording thread stopped')
 
 
 class AsyncRecording(MemoryRecording):
@@ -150,18 +330,44 @@ class AsyncRecording(MemoryRecording):
     being able to fetch data from the recording or the metadata if needed
     """
 
-    def __init__(self, wrapped_recording, add_async_operation_callback, wait_for_flush):
+    # Kinds of buffered changes
+    _DATA = 'data'
+    _METADATA = 'metadata'
+
+    def __init__(self, wrapped_recording, add_async_operation_callback,  # pylint: disable=too-many-arguments
+                 wait_for_flush, batch_max_items=1, batch_max_bytes=None, batch_max_age=None, measure_size=False):
         """
         :param wrapped_recording: Recording to wrap with asynchronous set data
         :type wrapped_recording: Recording
-        :param add_async_operation_callback: A callback to add operations to be executed asynchronously
+        :param add_async_operation_callback: A callback to add operations to be executed asynchronously, called with
+        the operation, this recording and the estimated size of the data the operation holds
         :type add_async_operation_callback: function
+        :param wait_for_flush: A callback that waits for the completion of the operations of a recording, called with
+        this recording
+        :type wait_for_flush: function
+        :param batch_max_items: Maximal number of buffered changes that are added as one operation
+        :type batch_max_items: int
+        :param batch_max_bytes: Optional maximal estimated size in bytes of the buffered changes
+        :type batch_max_bytes: int
+        :param batch_max_age: Optional maximal time in seconds since the first buffered change
+        :type batch_max_age: float
+        :param measure_size: True to estimate the size of the changes even without batch_max_bytes, e.g. when pending
+        operations are bounded by their size
+        :type measure_size: bool
         """
         # This cassette is only used for recording, hence it has no use of keeping the playback factory
         super(AsyncRecording, self).__init__(wrapped_recording.id)
         self.wrapped_recording = wrapped_recording
         self._add_async_operation_callback = add_async_operation_callback
         self._wait_for_flush = wait_for_flush
+        self._batch_max_items = batch_max_items
+        self._batch_max_bytes = batch_max_bytes
+        self._batch_max_age = batch_max_age
+        # Estimating the size walks the intercepted values, hence it is done only when it is bounded
+        self._measure_size = measure_size or batch_max_bytes is not None
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
 
     def _set_data(self, key, value):
         """
@@ -175,7 +381,7 @@ class AsyncRecording(MemoryRecording):
         # If needed, the data can be acquired from the wrapped "real" recording. But we are setting en empty value
         # so that the call to `get_all_keys` can still be done without the need of flushing the wrapped recording.
         super(AsyncRecording, self)._set_data(key, None)
-        self._add_async_operation_callback(lambda: self.wrapped_recording.set_data(key, value))
+        self._add_change((self._DATA, key, value), estimate_size(value) if self._measure_size else 0)
 
     def _add_metadata(self, metadata):
         """
@@ -183,16 +389,77 @@ class AsyncRecording(MemoryRecording):
         :type metadata: dict
         """
         super(AsyncRecording, self)._add_metadata(metadata)
-        self._add_async_operation_callback(lambda: self.wrapped_recording.add_metadata(metadata))
+        self._add_change((self._METADATA, metadata), estimate_size(metadata) if self._measure_size else 0)
+
+    def _add_change(self, change, size):
+        """
+        Buffers a change of the recording, adding the buffered changes as an operation once a batch threshold is reached
+        :param change: Kind of the change followed by its arguments
+        :type change: tuple
+        :param size: Estimated size in bytes of the change
+        :type size: int
+        """
+        if not self._batch:
+            self._batch_start = time()
+        self._batch.append(change)
+        self._batch_bytes += size
+        if len(self._batch) >= self._batch_max_items or \
+                (self._batch_max_bytes is not None and self._batch_bytes >= self._batch_max_bytes) or \
+                (self._batch_max_age is not None and time() - self._batch_start >= self._batch_max_age):
+            self.flush_batch()
+
+    def flush_batch(self):
+        """
+        Adds the buffered changes as one operation to be executed asynchronously
+        """
+        if not self._batch:
+            return
+        batch, size = self._batch, self._batch_bytes
+        self.discard_batch()
+        self._add_async_operation_callback(lambda: self._apply_changes(batch), self, size)
+
+    def discard_batch(self):
+        """
+        Discards the buffered changes, e.g. when the recording is aborted
+        """
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start = None
+
+    def _apply_changes(self, changes):
+        """
+        Applies buffered changes to the wrapped recording in order, consecutive data changes are set at once
+        :param changes: Buffered changes
+        :type changes: list[tuple]
+        """
+        items = []
+        for change in changes:
+            if change[0] == self._DATA:
+                items.append(change[1:])
+                continue
+            if items:
+                self._set_wrapped_data(items)
+                items = []
+            self.wrapped_recording.add_metadata(change[1])
+        if items:
+            self._set_wrapped_data(items)
+
+    def _set_wrapped_data(self, items):
+        if len(items) == 1:
+            self.wrapped_recording.set_data(*items[0])
+        else:
+            self.wrapped_recording.set_many(items)
 
     def get_data(self, key):
         # The operation setting the data was scheduled for execution asynchronously, hence we need to wait for it to
-        # complete before fetching the data from the recording.
-        self._wait_for_flush()
+        # complete before fetching the data from the recording. Only the operations of this recording are waited for.
+        self.flush_batch()
+        self._wait_for_flush(self)
         return self.wrapped_recording.get_data(key)
 
     def get_data_direct(self, key):
         # The operation setting the data was scheduled for execution asynchronously, hence we need to wait for it to
-        # complete before fetching the data from the recording.
-        self._wait_for_flush()
+        # complete before fetching the data from the recording. Only the operations of this recording are waited for.
+        self.flush_batch()
+        self._wait_for_flush(self)
         return self.wrapped_recording.get_data_direct(key)
@@ -0,0 +1,153 @@
+# Uses async syntax, hence it is only available on Python 3
+import asyncio
+import logging
+
+from playback.tape_cassette import TapeCassette
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncioRecordOnlyTapeCassette(TapeCassette):
+    # pylint: disable=too-many-instance-attributes
+    """
+    Wraps TapeCassette for asyncio services, saving a recording returns immediately and the recording is saved by a
+    task on the event loop. The blocking parts of saving (encoding, compression and storage calls) run in an executor,
+    with a bounded number of recordings saved concurrently. This cassette can only be used for recording and must be
+    used from the event loop thread, call aclose to wait for the pending saves
+    """
+    def __init__(self, tape_cassette, max_concurrency=8, executor=None, max_pending_recordings=None):
+        """
+        :param tape_cassette: The storage driver to hold the recording in
+        :type tape_cassette: playback.tape_cassette.TapeCassette
+        :param max_concurrency: Maximal number of recordings that are saved concurrently
+        :type max_concurrency: int
+        :param executor: Executor to run the blocking parts of saving in, None means the default executor of the loop
+        :type executor: concurrent.futures.Executor
+        :param max_pending_recordings: Optional maximal number of recordings pending to be saved, further recordings
+        are dropped until pending recordings are saved
+        :type max_pending_recordings: int
+        """
+        self.wrapped_tape_cassette = tape_cassette
+        self._max_concurrency = max_concurrency
+        self._executor = executor
+        self._max_pending_recordings = max_pending_recordings
+        # Created on first use so it is bound to the loop the cassette is used from
+        self._semaphore = None
+        self._pending_tasks = set()
+        self.saved_recordings = 0
+        self.failed_recordings = 0
+        self.dropped_recordings = 0
+
+    @property
+    def pending_recordings(self):
+        """
+        :return: Number of recordings that are pending to be saved
+        :rtype: int
+        """
+        return len(self._pending_tasks)
+
+    def get_recording(self, recording_id):
+        raise TypeError("AsyncioRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def iter_recording_ids(self, category, start_date=None, end_date=None, metadata=None, limit=None,
+                           random_results=False):
+        raise TypeError("AsyncioRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def extract_recording_category(self, recording_id):
+        raise TypeError("AsyncioRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def create_new_recording(self, category):
+        """
+        :param category: A category to classify the recording in (e.g operation class) (serializable)
+        :type category: Any
+        :return: Creates a new recording object
+        :rtype: playback.recording.Recording
+        """
+        return self.wrapped_tape_cassette.create_new_recording(category)
+
+    def save_recording(self, recording):
+        """
+        Schedules given recording to be saved and returns immediately, the recording is closed once it is saved
+        :param recording: Recording to save
+        :type recording: playback.recording.Recording
+        :return: Id the recording is saved with
+        :rtype: str
+        """
+        recording.id = self.get_final_recording_id(recording)
+        self._save_recording(recording)
+        return recording.id
+
+    def get_final_recording_id(self, recording):
+        """
+        :param recording: Recording that is about to be saved
+        :type recording: playback.recording.Recording
+        :return: Id the given recording is saved with by the underlying cassette
+        :rtype: str
+        """
+        return self.wrapped_tape_cassette.get_final_recording_id(recording)
+
+    def _save_recording(self, recording):
+        """
+        Schedules given recording to be saved
+        :param recording: Recording to save
+        :type recording: playback.recording.Recording
+        """
+        if self._max_pending_recordings is not None and len(self._pending_tasks) >= self._max_pending_recordings:
+            self.dropped_recordings += 1
+            _logger.warning(u'Dropped recording {} as {} recordings are pending to be saved'.format(
+                recording.id, len(self._pending_tasks)))
+            self.wrapped_tape_cassette.abort_recording(recording)
+            return
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        task = asyncio.ensure_future(self._save_in_executor(recording))
+        self._pending_tasks.add(task)
+        task.add_done_callback(self._pending_tasks.discard)
+
+    async def _save_in_executor(self, recording):
+        """
+        Saves given recording in the executor, waiting for a free concurrency slot first
+        :param recording: Recording to save
+        :type recording: playback.recording.Recording
+        """
+        async with self._semaphore:
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    self._executor, self.wrapped_tape_cassette.save_recording, recording)
+                self.saved_recordings += 1
+            except Exception as ex:  # pylint: disable=broad-except
+                self.failed_recordings += 1
+                _logger.exception(u'Error saving recording {} - {}'.format(recording.id, ex))
+
+    async def aclose(self, timeout=None):
+        """
+        Waits for the pending saves and closes the underlying cassette
+        :param timeout: Optional maximal time in seconds to wait for the pending saves, saves that are not completed by
+        then are cancelled
+        :type timeout: float
+        """
+        pending_tasks = list(self._pending_tasks)
+        if pending_tasks:
+            _logger.info(u'Waiting for {} pending recordings to be saved'.format(len(pending_tasks)))
+            _, not_done = await asyncio.wait(pending_tasks, timeout=timeout)
+            if not_done:
+                _logger.warning(u'Cancelling {} recordings that were not saved in time'.format(len(not_done)))
+                for task in not_done:
+                    task.cancel()
+        await asyncio.get_event_loop().run_in_executor(self._executor, self.wrapped_tape_cassette.close)
+
+    def close(self):
+        """
+        Closes the underlying cassette without waiting for the pending saves, use aclose to wait for them
+        """
+        if self._pending_tasks:
+            _logger.warning(u'Closing with {} recordings pending to be saved, use aclose to wait for them'.format(
+                len(self._pending_tasks)))
+        self.wrapped_tape_cassette.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
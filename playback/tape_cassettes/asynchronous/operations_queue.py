@@ -0,0 +1,317 @@
+from collections import deque
+from threading import Condition, Lock
+from time import time
+
+from six.moves import queue
+
+
+class QueueFullPolicy(object):
+    BLOCK = 'block'
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+
+
+class _Operation(object):
+    """
+    A queued operation of a recording
+    """
+    __slots__ = ('func', 'recording', 'size', 'last', 'bounded')
+
+    def __init__(self, func, recording, size, last, bounded):
+        self.func = func
+        self.recording = recording
+        self.size = size
+        self.last = last
+        self.bounded = bounded
+
+    def __call__(self):
+        return self.func()
+
+
+class OperationsQueue(object):
+    # pylint: disable=too-many-instance-attributes
+    """
+    Queue of the pending operations of recordings, bounded by the number of operations and by their estimated size.
+    When the queue is full, according to its policy, the caller is blocked until there is room, the recording of the
+    new operation is dropped, or the oldest recording that none of its operations started yet is dropped. The queued
+    operations of a dropped recording are removed, its later operations are discarded and an abort operation of the
+    recording is queued instead, so a partial recording is never saved.
+    Operations can be taken by several workers concurrently, an operation is only given when no other operation of
+    its recording is in progress, so the operations of each recording are executed in order
+    """
+    def __init__(self, abort_callback, max_items=None, max_bytes=None, full_policy=QueueFullPolicy.BLOCK,
+                 block_timeout=None):
+        """
+        :param abort_callback: Function that aborts a dropped recording, called with the recording
+        :type abort_callback: function
+        :param max_items: Optional maximal number of queued operations
+        :type max_items: int
+        :param max_bytes: Optional maximal estimated size in bytes of the queued operations
+        :type max_bytes: int
+        :param full_policy: What to do when the queue is full, block the caller ('block'), drop the recording of the new
+        operation ('drop_newest') or drop the oldest recording that did not start yet ('drop_oldest')
+        :type full_policy: str
+        :param block_timeout: When blocking, maximal time in seconds to wait for room before dropping the recording of
+        the new operation, None means waiting until there is room
+        :type block_timeout: float
+        """
+        if full_policy not in (QueueFullPolicy.BLOCK, QueueFullPolicy.DROP_NEWEST, QueueFullPolicy.DROP_OLDEST):
+            raise ValueError(u'Unknown queue full policy {}'.format(full_policy))
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.dropped_recordings = 0
+        self.dropped_operations = 0
+        self._abort_callback = abort_callback
+        self._operations = deque()
+        self._bounded_items = 0
+        self._total_bytes = 0
+        self._unfinished = 0
+        # Recordings are tracked by identity rather than by id, since a cassette may finalize the id of a recording
+        # when it is saved. Recordings that some of their operations were taken from the queue
+        self._started_recordings = set()
+        # Dropped recordings that their later operations are discarded
+        self._dropped_recordings = set()
+        # Recordings that one of their operations is being executed
+        self._in_progress_recordings = set()
+        # Recording -> number of its queued and in progress operations
+        self._pending_by_recording = {}
+        self._stopped = False
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self._not_empty = Condition(self._lock)
+        self._all_done = Condition(self._lock)
+        self._recording_done = Condition(self._lock)
+
+    @property
+    def total_bytes(self):
+        """
+        :return: Estimated size in bytes of the queued operations
+        :rtype: int
+        """
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._operations)
+
+    def put(self, func, recording=None, size=0, last=False):
+        """
+        Queues an operation
+        :param func: Operation to execute
+        :type func: function
+        :param recording: Recording the operation belongs to, operations without a recording are never dropped in
+        favor of other operations
+        :type recording: playback.recording.Recording
+        :param size: Estimated size in bytes of the data the operation holds
+        :type size: int
+        :param last: Whether this is the last operation of the recording (e.g. saving it)
+        :type last: bool
+        :return: Whether the operation was queued
+        :rtype: bool
+        """
+        with self._lock:
+            if recording is not None and recording in self._dropped_recordings:
+                self.dropped_operations += 1
+                if last:
+                    self._dropped_recordings.discard(recording)
+                return False
+
+            if not self._make_room(recording, size):
+                self.dropped_operations += 1
+                if recording is not None:
+                    self._drop_recording(recording, include_later=not last)
+                return False
+
+            self._append(_Operation(func, recording, size, last, bounded=True))
+            return True
+
+    def get(self):
+        """
+        Waits for the next queued operation that no other operation of its recording is in progress, it should be
+        marked as completed with task_done once executed. Once the queue is stopped, the remaining operations are still
+        given and None is returned when there are no more operations to give
+        :return: The next operation, None if the queue is stopped
+        :rtype: function
+        """
+        with self._lock:
+            while True:
+                operation = self._pop_ready_operation()
+                if operation is not None:
+                    return operation
+                if self._stopped:
+                    return None
+                self._not_empty.wait()
+
+    def get_nowait(self):
+        """
+        :return: The next queued operation that no other operation of its recording is in progress, it should be
+        marked as completed with task_done once executed
+        :rtype: function
+        :raises: queue.Empty
+        """
+        with self._lock:
+            operation = self._pop_ready_operation()
+            if operation is None:
+                raise queue.Empty()
+            return operation
+
+    def stop(self):
+        """
+        Signals the workers waiting for operations to stop once the queued operations are given
+        """
+        with self._lock:
+            self._stopped = True
+            self._not_empty.notify_all()
+
+    def task_done(self, operation=None):
+        """
+        Marks an operation that was taken from the queue as completed
+        :param operation: The completed operation, required for the next operations of its recording to be given
+        :type operation: function
+        """
+        with self._lock:
+            if operation is not None and operation.recording is not None:
+                self._in_progress_recordings.discard(operation.recording)
+                self._decrease_pending(operation.recording)
+                if self._operations:
+                    # Following operations of the recording can be given now
+                    self._not_empty.notify()
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._unfinished = 0
+                self._all_done.notify_all()
+
+    def join(self):
+        """
+        Waits until all the queued operations are completed
+        """
+        with self._lock:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def join_recording(self, recording):
+        """
+        Waits until the queued operations of the given recording are completed, regardless of the operations of other
+        recordings
+        :param recording: The recording to wait for
+        :type recording: playback.recording.Recording
+        """
+        with self._lock:
+            while self._pending_by_recording.get(recording):
+                self._recording_done.wait()
+
+    def _append(self, operation):
+        self._operations.append(operation)
+        self._unfinished += 1
+        if operation.recording is not None:
+            recording = operation.recording
+            self._pending_by_recording[recording] = self._pending_by_recording.get(recording, 0) + 1
+        if operation.bounded:
+            self._bounded_items += 1
+            self._total_bytes += operation.size
+        self._not_empty.notify()
+
+    def _decrease_pending(self, recording):
+        count = self._pending_by_recording.get(recording, 0) - 1
+        if count > 0:
+            self._pending_by_recording[recording] = count
+        else:
+            self._pending_by_recording.pop(recording, None)
+            self._recording_done.notify_all()
+
+    def _pop_ready_operation(self):
+        """
+        Removes from the queue the first operation that no other operation of its recording is in progress, must be
+        called while holding the lock
+        :return: The removed operation, None if there is no such operation
+        :rtype: _Operation
+        """
+        for index, operation in enumerate(self._operations):
+            if operation.recording is None or operation.recording not in self._in_progress_recordings:
+                break
+        else:
+            return None
+        del self._operations[index]  # pylint: disable=undefined-loop-variable
+        if operation.bounded:
+            self._bounded_items -= 1
+            self._total_bytes -= operation.size
+            self._not_full.notify()
+        if operation.recording is not None:
+            self._in_progress_recordings.add(operation.recording)
+            if operation.last:
+                self._started_recordings.discard(operation.recording)
+            else:
+                self._started_recordings.add(operation.recording)
+        return operation
+
+    def _has_room(self, size):
+        # An operation that is larger than the whole budget is still queued when the queue is empty
+        if not self._bounded_items:
+            return True
+        return (self.max_items is None or self._bounded_items < self.max_items) and \
+            (self.max_bytes is None or self._total_bytes + size <= self.max_bytes)
+
+    def _make_room(self, recording, size):
+        """
+        Makes room for a new operation according to the queue policy, must be called while holding the lock
+        :param recording: Recording of the new operation
+        :type recording: playback.recording.Recording
+        :param size: Estimated size in bytes of the new operation
+        :type size: int
+        :return: Whether there is room for the new operation
+        :rtype: bool
+        """
+        if self.full_policy == QueueFullPolicy.BLOCK:
+            deadline = time() + self.block_timeout if self.block_timeout is not None else None
+            while not self._has_room(size):
+                remaining = deadline - time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._not_full.wait(remaining)
+            # The recording may have been dropped while waiting
+            return recording not in self._dropped_recordings
+
+        if self.full_policy == QueueFullPolicy.DROP_OLDEST:
+            while not self._has_room(size):
+                oldest = self._find_oldest_unstarted_recording(excluded=recording)
+                if oldest is None:
+                    return False
+                self._drop_recording(oldest, include_later=True)
+
+        return self._has_room(size)
+
+    def _find_oldest_unstarted_recording(self, excluded):
+        for operation in self._operations:
+            recording = operation.recording
+            if operation.bounded and recording is not None and recording is not excluded and \
+                    recording not in self._started_recordings:
+                return recording
+        return None
+
+    def _drop_recording(self, recording, include_later):
+        """
+        Removes the queued operations of a recording and queues its abort, must be called while holding the lock
+        :param recording: Recording to drop
+        :type recording: playback.recording.Recording
+        :param include_later: Whether the later operations of the recording should be discarded as well, ignored when
+        its last operation is removed, as no later operations will follow
+        :type include_later: bool
+        """
+        remaining = deque()
+        for operation in self._operations:
+            if operation.bounded and operation.recording is recording:
+                include_later = include_later and not operation.last
+                self._bounded_items -= 1
+                self._total_bytes -= operation.size
+                self._unfinished -= 1
+                self._decrease_pending(recording)
+                self.dropped_operations += 1
+            else:
+                remaining.append(operation)
+        self._operations = remaining
+        self.dropped_recordings += 1
+        if include_later:
+            self._dropped_recordings.add(recording)
+        self._append(_Operation(lambda: self._abort_callback(recording), recording, 0, last=True, bounded=False))
+        self._not_full.notify_all()
@@ -0,0 +1,301 @@
+import logging
+import multiprocessing
+from functools import partial
+from threading import Condition, Lock, Thread
+from time import time
+
+import six
+from jsonpickle import decode, encode
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+from playback.tape_cassette import TapeCassette
+
+_logger = logging.getLogger(__name__)
+
+# Formats of a recording handed off to a serializer process
+_PICKLE_FORMAT = 'pickle'
+_JSONPICKLE_FORMAT = 'jsonpickle'
+
+# State of the serializer process, the cassette is created once when the process starts
+_WORKER_STATE = {}
+
+
+def _init_worker(tape_cassette_factory):
+    """
+    Initializes a serializer process
+    :param tape_cassette_factory: Function that creates the cassette to save recordings with
+    :type tape_cassette_factory: function
+    """
+    _WORKER_STATE['tape_cassette'] = tape_cassette_factory()
+
+
+def _save_in_worker(payload_format, payload):
+    """
+    Saves a recording that was handed off to a serializer process
+    :param payload_format: Format of the handed off recording
+    :type payload_format: str
+    :param payload: Serialized recording
+    :type payload: bytes | str
+    :return: Error message if saving failed, None otherwise
+    :rtype: str
+    """
+    try:
+        recording = pickle.loads(payload) if payload_format == _PICKLE_FORMAT else decode(payload)
+        _WORKER_STATE['tape_cassette'].save_recording(recording)
+        return None
+    # Errors are reported back to the recording process rather than raised, a failed recording should not fail the pool
+    except Exception as ex:  # pylint: disable=broad-except
+        _logger.exception(u'Error saving recording - {}'.format(ex))
+        return u'{}: {}'.format(type(ex).__name__, ex)
+
+
+def _get_multiprocessing_context(start_method):
+    """
+    :param start_method: Start method of the serializer processes, None means 'forkserver' where it is available and
+    'spawn' otherwise
+    :type start_method: str
+    :return: Multiprocessing context to create the serializer processes with
+    """
+    # Start methods are not supported in python 2, where processes are always forked
+    if six.PY2:
+        return multiprocessing
+    if start_method is None:
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+
+class ProcessPoolRecordOnlyTapeCassette(TapeCassette):
+    # pylint: disable=too-many-instance-attributes
+    """
+    Hands finished recordings off to a pool of serializer processes that encode, compress and save them using their
+    own instance of the underlying cassette, so the encoding and compression do not compete for the GIL with the
+    recording process. Recordings are handed off pickled with the highest pickle protocol, which is cheap compared to
+    encoding them, recordings that cannot be pickled are encoded with jsonpickle by a background thread instead. The
+    serializer processes are not forked from the recording process, which may hold locks of other threads, but
+    started with the 'forkserver' or 'spawn' start method. This cassette can only be used for recording
+    """
+    def __init__(self, tape_cassette_factory, processes=2,  # pylint: disable=too-many-arguments
+                 max_pending_recordings=None, timeout_on_close=10, save_timeout=120, start_method=None):
+        """
+        :param tape_cassette_factory: Function that creates the underlying cassette, it is called once in this process
+        to create new recordings and once in every serializer process to save them, hence it must be picklable (e.g a
+        module level function or a functools.partial of a cassette class)
+        :type tape_cassette_factory: function
+        :param processes: Number of serializer processes
+        :type processes: int
+        :param max_pending_recordings: Optional maximal number of recordings that are handed off and not saved yet,
+        further recordings are dropped until pending recordings are saved
+        :type max_pending_recordings: int
+        :param timeout_on_close: How much time to wait on close for the pending recordings to be saved
+        :type timeout_on_close: float
+        :param save_timeout: Time in seconds after which a recording that was handed off and not reported saved (e.g.
+        as its serializer process died) is counted as failed and no longer pending
+        :type save_timeout: float
+        :param start_method: Start method of the serializer processes ('forkserver' or 'spawn'), None means
+        'forkserver' where it is available and 'spawn' otherwise, ignored in python 2 where processes are forked
+        :type start_method: str
+        """
+        self.wrapped_tape_cassette = tape_cassette_factory()
+        self._tape_cassette_factory = tape_cassette_factory
+        self._processes = processes
+        self._max_pending_recordings = max_pending_recordings
+        self._timeout_on_close = timeout_on_close
+        self._save_timeout = save_timeout
+        self._context = _get_multiprocessing_context(start_method)
+        self._pool = None
+        self._encoder = None
+        self._encode_queue = queue.Queue()
+        # Token of a handed off recording -> time it was handed off
+        self._pending_recordings = {}
+        self._next_token = 0
+        self._abandoned_recordings = False
+        self._lock = Lock()
+        self._all_saved = Condition(self._lock)
+        self.saved_recordings = 0
+        self.failed_recordings = 0
+        self.dropped_recordings = 0
+
+    def start(self):
+        """
+        Starts the serializer processes
+        """
+        _logger.info(u'Starting ProcessPoolRecordOnlyTapeCassette with {} processes'.format(self._processes))
+        self._pool = self._context.Pool(self._processes, initializer=_init_worker,
+                                        initargs=(self._tape_cassette_factory,))
+        self._encoder = Thread(target=self._run_encoder, name='ProcessPoolRecordOnlyTapeCassette encoder Thread')
+        self._encoder.daemon = True
+        self._encoder.start()
+
+    def close(self):
+        """
+        Waits up to the given timeout for the pending recordings to be saved and stops the serializer processes,
+        recordings that are not saved by then are lost
+        """
+        if self._pool is not None:
+            _logger.info(u'Shutting down ProcessPoolRecordOnlyTapeCassette (waiting up to {}s)'.format(
+                self._timeout_on_close))
+            self._encode_queue.put(None)
+            deadline = time() + self._timeout_on_close
+            with self._lock:
+                while self._pending_recordings and time() < deadline:
+                    self._all_saved.wait(deadline - time())
+                    self._expire_pending_recordings()
+                pending_recordings = len(self._pending_recordings)
+                # A pool that lost a task (e.g. as its serializer process died) waits for it forever when joined
+                abandoned_recordings = self._abandoned_recordings
+            if pending_recordings:
+                _logger.warning(u'Terminating serializer processes with {} recordings that are not saved'.format(
+                    pending_recordings))
+            if pending_recordings or abandoned_recordings:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._encoder = None
+        self.wrapped_tape_cassette.close()
+        _logger.info('ProcessPoolRecordOnlyTapeCassette has shutdown')
+
+    def get_recording(self, recording_id):
+        raise TypeError("ProcessPoolRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def iter_recording_ids(self, category, start_date=None, end_date=None, metadata=None, limit=None,
+                           random_results=False):
+        raise TypeError("ProcessPoolRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def extract_recording_category(self, recording_id):
+        raise TypeError("ProcessPoolRecordOnlyTapeCassette should only be used for recording, not playback")
+
+    def create_new_recording(self, category):
+        """
+        :param category: A category to classify the recording in (e.g operation class) (serializable)
+        :type category: Any
+        :return: Creates a new recording object
+        :rtype: playback.recording.Recording
+        """
+        assert self._pool is not None, "Serializer processes are not running"
+        return self.wrapped_tape_cassette.create_new_recording(category)
+
+    def get_final_recording_id(self, recording):
+        """
+        :param recording: Recording that is about to be saved
+        :type recording: playback.recording.Recording
+        :return: Id the given recording is saved with by the underlying cassette
+        :rtype: str
+        """
+        return self.wrapped_tape_cassette.get_final_recording_id(recording)
+
+    def _save_recording(self, recording):
+        """
+        Hands given recording off to the serializer processes
+        :param recording: Recording to save
+        :type recording: playback.recording.Recording
+        """
+        with self._lock:
+            self._expire_pending_recordings()
+            if self._max_pending_recordings is not None and \
+                    len(self._pending_recordings) >= self._max_pending_recordings:
+                self.dropped_recordings += 1
+                _logger.warning(u'Dropped recording {} as {} recordings are pending to be saved'.format(
+                    recording.id, len(self._pending_recordings)))
+                return
+            token = self._next_token
+            self._next_token += 1
+            self._pending_recordings[token] = time()
+
+        try:
+            payload = pickle.dumps(recording, pickle.HIGHEST_PROTOCOL)
+        # Recorded values are only required to be serializable by jsonpickle, which is too slow to run on the recording
+        # thread
+        except Exception as ex:  # pylint: disable=broad-except
+            _logger.debug(u'Recording {} cannot be pickled, handing it off encoded - {}'.format(recording.id, ex))
+            self._encode_queue.put((token, recording))
+            return
+
+        try:
+            self._hand_off(token, _PICKLE_FORMAT, payload)
+        except Exception:
+            self._on_recording_saved(token, u'Failed handing off recording')
+            raise
+
+    def _hand_off(self, token, payload_format, payload):
+        """
+        Hands a serialized recording off to the serializer processes
+        :param token: Token of the handed off recording
+        :type token: int
+        :param payload_format: Format of the handed off recording
+        :type payload_format: str
+        :param payload: Serialized recording
+        :type payload: bytes | str
+        """
+        kwargs = dict(callback=partial(self._on_recording_saved, token))
+        # Not supported in python 2, where a recording that failed to be handed off is expired after the save timeout
+        if not six.PY2:
+            kwargs['error_callback'] = partial(self._on_hand_off_error, token)
+        self._pool.apply_async(_save_in_worker, (payload_format, payload), **kwargs)
+
+    def _run_encoder(self):
+        """
+        Encodes the recordings that cannot be pickled with jsonpickle and hands them off, until close
+        """
+        while True:
+            item = self._encode_queue.get()
+            if item is None:
+                return
+            token, recording = item
+            try:
+                self._hand_off(token, _JSONPICKLE_FORMAT, encode(recording, unpicklable=True))
+            except Exception as ex:  # pylint: disable=broad-except
+                _logger.exception(u'Failed handing off recording {} - {}'.format(recording.id, ex))
+                self._on_recording_saved(token, u'Failed handing off recording')
+
+    def _on_hand_off_error(self, token, error):
+        """
+        Called when a handed off recording could not be saved by the pool
+        :param token: Token of the handed off recording
+        :type token: int
+        :param error: The error of the pool
+        :type error: Exception
+        """
+        _logger.error(u'Failed handing off recording - {}'.format(error))
+        self._on_recording_saved(token, u'{}: {}'.format(type(error).__name__, error))
+
+    def _on_recording_saved(self, token, error):
+        """
+        Called when a handed off recording is done saving
+        :param token: Token of the handed off recording
+        :type token: int
+        :param error: Error message if saving failed, None otherwise
+        :type error: str
+        """
+        with self._lock:
+            # The recording may have already been counted as failed when it expired
+            if self._pending_recordings.pop(token, None) is None:
+                return
+            if error is None:
+                self.saved_recordings += 1
+            else:
+                self.failed_recordings += 1
+            if not self._pending_recordings:
+                self._all_saved.notify_all()
+
+    def _expire_pending_recordings(self):
+        """
+        Counts the handed off recordings that were not reported saved within the save timeout as failed, must be
+        called under the lock
+        """
+        if self._save_timeout is None:
+            return
+        expired_before = time() - self._save_timeout
+        expired_tokens = [token for token, handed_off_at in self._pending_recordings.items()
+                          if handed_off_at < expired_before]
+        for token in expired_tokens:
+            del self._pending_recordings[token]
+            self.failed_recordings += 1
+            self._abandoned_recordings = True
+        if expired_tokens:
+            _logger.error(u'{} recordings were not saved within {}s and are counted as failed'.format(
+                len(expired_tokens), self._save_timeout))
+            if not self._pending_recordings:
+                self._all_saved.notify_all()
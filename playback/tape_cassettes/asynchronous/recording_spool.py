@@ -0,0 +1,353 @@
+import errno
+import io
+import logging
+import os
+import random
+import struct
+from collections import deque
+from threading import Event, Lock, Thread
+from time import time
+from zlib import compress, decompress
+
+from jsonpickle import decode, encode
+
+_logger = logging.getLogger(__name__)
+
+
+def _is_process_alive(pid):
+    """
+    :param pid: Process id
+    :type pid: int
+    :return: Whether a process with the given id exists
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        # The process exists but belongs to another user
+        return ex.errno == errno.EPERM
+    return True
+
+
+class RecordingSpool(object):
+    # pylint: disable=too-many-instance-attributes
+    """
+    Durable local write ahead spool of recordings pending to be saved. Recordings are encoded and appended to segment
+    files on local disk, an uploader thread saves them in order to the wrapped cassette, retrying failures with
+    exponential backoff, and removes each segment once all of its recordings are saved. Segments that were left by a
+    previous run (e.g. the process died or timed out on close) are recovered and saved when the spool starts.
+    A recording may be saved more than once if the process dies while a segment is being saved, hence the spool path
+    should not be shared between processes that run concurrently. Worker processes spool to worker-<pid> sub
+    directories of a shared workers path instead, and the segments left there by workers that died are adopted by the
+    next spool that starts with the same workers path
+    """
+    SEGMENT_PREFIX = 'segment-'
+    WORKER_DIR_PREFIX = 'worker-'
+    SEGMENT_SUFFIX = '.spool'
+    DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+    # Length prefix of every record in a segment
+    _RECORD_HEADER = struct.Struct('>I')
+
+    def __init__(self, spool_path, tape_cassette,  # pylint: disable=too-many-arguments
+                 segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES, fsync=False, retry_base_delay=1.0,
+                 retry_max_delay=60.0, max_save_attempts=None, workers_path=None):
+        """
+        :param spool_path: Directory of the spool segment files
+        :type spool_path: str
+        :param tape_cassette: Cassette to save the spooled recordings with
+        :type tape_cassette: playback.tape_cassette.TapeCassette
+        :param segment_max_bytes: Size in bytes after which a segment is sealed and a new one is started
+        :type segment_max_bytes: int
+        :param fsync: Whether every appended recording is synced to disk, protecting it from an operating system crash
+        and not only from a process crash, at the cost of slower appends
+        :type fsync: bool
+        :param retry_base_delay: Base delay in seconds of the exponential backoff between attempts to save a recording
+        :type retry_base_delay: float
+        :param retry_max_delay: Maximal delay in seconds between attempts to save a recording
+        :type retry_max_delay: float
+        :param max_save_attempts: Optional maximal number of attempts to save a recording after which it is discarded,
+        None means retrying until it is saved (e.g. during a storage outage)
+        :type max_save_attempts: int
+        :param workers_path: Optional directory of the worker-<pid> spools of worker processes, segments left in the
+        spools of workers that are no longer running are moved to this spool and saved by it
+        :type workers_path: str
+        """
+        if not os.path.isdir(spool_path):
+            os.makedirs(spool_path)
+        self.spool_path = spool_path
+        self.tape_cassette = tape_cassette
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_save_attempts = max_save_attempts
+        self.workers_path = workers_path
+        self.spooled_recordings = 0
+        self.saved_recordings = 0
+        self.failed_recordings = 0
+        self.corrupted_recordings = 0
+        self._lock = Lock()
+        self._active_file = None
+        self._active_path = None
+        self._active_size = 0
+        self._sealed_segments = deque()
+        self._next_sequence = 0
+        self._wake_event = Event()
+        self._stop_event = Event()
+        self._abort_event = Event()
+        self._uploader = None
+        self._recover_segments()
+        self._adopt_orphaned_segments()
+
+    @property
+    def pending_segments(self):
+        """
+        :return: Number of segments that are not saved yet, including the active one
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._sealed_segments) + (1 if self._active_file is not None else 0)
+
+    def start(self):
+        """
+        Starts the uploader thread
+        """
+        self._uploader = Thread(target=self._upload_loop, name='RecordingSpool Uploader Thread')
+        self._uploader.daemon = True
+        self._uploader.start()
+
+    def append(self, recording):
+        """
+        Encodes and appends a recording to the spool
+        :param recording: Recording to spool
+        :type recording: playback.recording.Recording
+        """
+        record = compress(encode(recording, unpicklable=True).encode('utf-8'))
+        with self._lock:
+            if self._active_file is None:
+                self._open_segment()
+            self._active_file.write(self._RECORD_HEADER.pack(len(record)) + record)
+            self._active_file.flush()
+            if self.fsync:
+                os.fsync(self._active_file.fileno())
+            self._active_size += self._RECORD_HEADER.size + len(record)
+            self.spooled_recordings += 1
+            if self._active_size >= self.segment_max_bytes:
+                self._seal_active_segment()
+        self._wake_event.set()
+
+    def close(self, timeout):
+        """
+        Waits up to the given timeout for the spooled recordings to be saved and stops the uploader. Recordings that
+        are not saved by then are kept in the spool and recovered when a spool of the same path starts
+        :param timeout: Maximal time in seconds to wait
+        :type timeout: float
+        """
+        with self._lock:
+            self._seal_active_segment()
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._uploader is not None:
+            self._uploader.join(timeout)
+            if self._uploader.is_alive():
+                _logger.warning(u'Timed out saving spooled recordings, {} segments are kept in {}'.format(
+                    self.pending_segments, self.spool_path))
+                self._abort_event.set()
+
+    def _recover_segments(self):
+        """
+        Queues segments that were left in the spool path by a previous run to be saved
+        """
+        sequences = []
+        for name in os.listdir(self.spool_path):
+            if self._is_segment_name(name):
+                try:
+                    sequences.append(int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        for sequence in sorted(sequences):
+            self._sealed_segments.append(self._get_segment_path(sequence))
+        if sequences:
+            self._next_sequence = max(sequences) + 1
+            _logger.info(u'Recovered {} spool segments from {}'.format(len(sequences), self.spool_path))
+
+    def _adopt_orphaned_segments(self):
+        """
+        Moves the segments that were left in the spools of worker processes that are no longer running to this spool,
+        to be saved after the recovered segments. A segment that is moved concurrently by another spool is skipped
+        """
+        if self.workers_path is None or not os.path.isdir(self.workers_path):
+            return
+        adopted_segments = 0
+        for worker_name in os.listdir(self.workers_path):
+            worker_path = os.path.join(self.workers_path, worker_name)
+            if not self._is_orphaned_worker_spool(worker_name, worker_path):
+                continue
+            try:
+                segment_names = sorted(name for name in os.listdir(worker_path) if self._is_segment_name(name))
+            except OSError:
+                continue
+            for segment_name in segment_names:
+                segment_path = self._get_segment_path(self._next_sequence)
+                try:
+                    os.rename(os.path.join(worker_path, segment_name), segment_path)
+                except OSError:
+                    continue
+                self._next_sequence += 1
+                self._sealed_segments.append(segment_path)
+                adopted_segments += 1
+            try:
+                os.rmdir(worker_path)
+            except OSError:
+                pass
+        if adopted_segments:
+            _logger.info(u'Adopted {} spool segments of worker processes that are no longer running from {}'.format(
+                adopted_segments, self.workers_path))
+
+    def _is_orphaned_worker_spool(self, worker_name, worker_path):
+        """
+        :param worker_name: Name of a directory in the workers path
+        :type worker_name: str
+        :param worker_path: Path of the directory
+        :type worker_path: str
+        :return: Whether the directory is the spool of a worker process that is no longer running
+        :rtype: bool
+        """
+        if not worker_name.startswith(self.WORKER_DIR_PREFIX) or not os.path.isdir(worker_path) or \
+                os.path.abspath(worker_path) == os.path.abspath(self.spool_path):
+            return False
+        try:
+            pid = int(worker_name[len(self.WORKER_DIR_PREFIX):])
+        except ValueError:
+            return False
+        return pid != os.getpid() and not _is_process_alive(pid)
+
+    def _is_segment_name(self, name):
+        return name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)
+
+    def _get_segment_path(self, sequence):
+        return os.path.join(self.spool_path, u'{}{:012d}{}'.format(self.SEGMENT_PREFIX, sequence, self.SEGMENT_SUFFIX))
+
+    def _open_segment(self):
+        """
+        Starts a new active segment, must be called while holding the lock
+        """
+        self._active_path = self._get_segment_path(self._next_sequence)
+        self._next_sequence += 1
+        self._active_file = io.open(self._active_path, 'ab')
+        self._active_size = 0
+
+    def _seal_active_segment(self):
+        """
+        Closes the active segment and queues it to be saved, must be called while holding the lock
+        """
+        if self._active_file is None:
+            return
+        self._active_file.close()
+        self._sealed_segments.append(self._active_path)
+        self._active_file = None
+        self._active_path = None
+
+    def _next_segment(self):
+        """
+        :return: Path of the next segment to save, the active segment is sealed when there are no sealed segments so
+        recordings are saved without waiting for the segment to fill up
+        :rtype: str
+        """
+        with self._lock:
+            if not self._sealed_segments:
+                self._seal_active_segment()
+            return self._sealed_segments[0] if self._sealed_segments else None
+
+    def _upload_loop(self):
+        """
+        Saves the spooled segments in order until the spool is closed and all segments are saved, or it is aborted
+        """
+        while not self._abort_event.is_set():
+            self._wake_event.clear()
+            segment_path = self._next_segment()
+            if segment_path is None:
+                if self._stop_event.is_set():
+                    return
+                self._wake_event.wait()
+                continue
+
+            if not self._upload_segment(segment_path):
+                return
+            with self._lock:
+                self._sealed_segments.popleft()
+            try:
+                os.remove(segment_path)
+            except OSError as ex:
+                _logger.warning(u'Failed removing saved spool segment {} - {}'.format(segment_path, ex))
+
+    def _upload_segment(self, segment_path):
+        """
+        Saves the recordings of a segment
+        :param segment_path: Path of the segment
+        :type segment_path: str
+        :return: Whether all the recordings of the segment were handled, False if the spool was aborted
+        :rtype: bool
+        """
+        for record in self._iter_records(segment_path):
+            try:
+                recording = decode(decompress(record).decode('utf-8'))
+            except Exception as ex:  # pylint: disable=broad-except
+                _logger.error(u'Discarding corrupted spooled recording in {} - {}'.format(segment_path, ex))
+                self.corrupted_recordings += 1
+                continue
+            if not self._save_with_retry(recording):
+                return False
+        return True
+
+    def _iter_records(self, segment_path):
+        """
+        :param segment_path: Path of the segment
+        :type segment_path: str
+        :return: Iterator of the records of the segment, a record that was partially written is ignored
+        :rtype: Iterator[bytes]
+        """
+        try:
+            with io.open(segment_path, 'rb') as fid:
+                while True:
+                    header = fid.read(self._RECORD_HEADER.size)
+                    if not header:
+                        return
+                    if len(header) == self._RECORD_HEADER.size:
+                        length = self._RECORD_HEADER.unpack(header)[0]
+                        record = fid.read(length)
+                        if len(record) == length:
+                            yield record
+                            continue
+                    _logger.warning(u'Ignoring partially written record at the end of {}'.format(segment_path))
+                    self.corrupted_recordings += 1
+                    return
+        except (IOError, OSError) as ex:
+            _logger.error(u'Failed reading spool segment {} - {}'.format(segment_path, ex))
+
+    def _save_with_retry(self, recording):
+        """
+        :param recording: Recording to save
+        :type recording: playback.recording.Recording
+        :return: Whether the recording was handled (saved or discarded), False if the spool was aborted
+        :rtype: bool
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time()
+            try:
+                self.tape_cassette.save_recording(recording)
+                self.saved_recordings += 1
+                return True
+            except Exception as ex:  # pylint: disable=broad-except
+                if self.max_save_attempts is not None and attempt >= self.max_save_attempts:
+                    _logger.error(u'Discarding spooled recording {} after {} attempts - {}'.format(
+                        recording.id, attempt, ex))
+                    self.failed_recordings += 1
+                    return True
+                delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))
+                _logger.warning(u'Failed saving spooled recording {} (attempt {}, took {:.2f}s), retrying in {:.2f}s '
+                                u'- {}'.format(recording.id, attempt, time() - start, delay, ex))
+            if self._abort_event.wait(delay):
+                return False
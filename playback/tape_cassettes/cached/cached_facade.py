@@ -1,20 +1,87 @@
+import hashlib
+import json
 import os
 import logging
+import re
+import sys
 import tempfile
+from calendar import timegm
+from datetime import datetime, timedelta
 from tempfile import gettempdir
 from io import open
+from copy import deepcopy
+from threading import Lock, Thread
+from time import time
 
+import pytz
+from six.moves import cPickle as pickle, queue
+
+from playback.recordings.memory.memory_recording import MemoryRecording
+from playback.tape_cassettes.cached.disk_cache_index import DiskCacheIndex, EvictionPolicy, PinnedFileReader
+from playback.tape_cassettes.cached.file_lock import FileLock
 from playback.tape_cassettes.s3.s3_basic_facade import S3BasicFacade
 from playback.tape_cassettes.s3.s3_tape_cassette import S3TapeCassette
+from playback.utils.lru_cache import SizeBoundedLRUCache
 
 logger = logging.getLogger(__name__)
 
 
-class CachedS3BasicFacade(S3BasicFacade):
+class CachedS3BasicFacade(S3BasicFacade):  # pylint: disable=too-many-instance-attributes
     DEFAULT_CACHE_PATH = os.path.join(gettempdir(), "recordings_cache")
+    METADATA_DIR = 'metadata'
+    LISTINGS_DIR = 'listings'
+    DECODED_DIR = 'decoded'
+    LOCKS_DIR = 'locks'
+    DEFAULT_LISTING_CACHE_TTL = None
+    DEFAULT_CACHE_LOCK_TIMEOUT = 60
+    CACHE_WRITE_CHUNK_SIZE = 1024 * 1024
+    # Day segment of recording keys (e.g. 'category/20261017/...'), see S3TapeCassette.DAY_FORMAT
+    DAY_SEGMENT_PATTERN = re.compile(r'(?:^|/)(\d{8})(?=/)')
 
-    def __init__(self, bucket, region=None, cache_path=None, use_cache=True):
-        super(CachedS3BasicFacade, self).__init__(bucket, region)
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+            self, bucket, region=None, cache_path=None, use_cache=True,
+            retry_policy=None, hedging_policy=None, max_pool_connections=None, max_cache_bytes=None,
+            max_cache_entries=None, cache_eviction_policy=EvictionPolicy.LRU,
+            listing_cache_ttl=DEFAULT_LISTING_CACHE_TTL, cache_lock_timeout=DEFAULT_CACHE_LOCK_TIMEOUT,
+            write_through=False, async_upload=False):
+        """
+        :param bucket: S3 bucket
+        :type bucket: str
+        :param region: Optional aws region
+        :type region: str
+        :param cache_path: Optional local cache path, None means DEFAULT_CACHE_PATH
+        :type cache_path: str
+        :param use_cache: False to ignore the cache and always fetch from S3
+        :type use_cache: bool
+        :param retry_policy: Optional retry policy of S3 requests
+        :type retry_policy: playback.tape_cassettes.s3.s3_request_policies.RetryPolicy
+        :param hedging_policy: Optional hedging policy of S3 get requests
+        :type hedging_policy: playback.tape_cassettes.s3.s3_request_policies.HedgingPolicy
+        :param max_pool_connections: Optional maximal number of connections kept in the S3 client connection pool
+        :type max_pool_connections: int
+        :param max_cache_bytes: Optional maximal total size in bytes of the cached files, None means unbounded
+        :type max_cache_bytes: int
+        :param max_cache_entries: Optional maximal number of cached files, None means unbounded
+        :type max_cache_entries: int
+        :param cache_eviction_policy: Which cached files are evicted first when the cache exceeds its budget, least
+        recently used ('lru') or least frequently used ('lfu')
+        :type cache_eviction_policy: str
+        :param listing_cache_ttl: How long in seconds a listing of keys that may still change (e.g. of the current day)
+        is cached, listings of past days never change and are cached until evicted, None (default) means listings are
+        not cached
+        :type listing_cache_ttl: float
+        :param cache_lock_timeout: How long in seconds to wait for another process that shares the cache path and
+        fetches the same file, before fetching it independently
+        :type cache_lock_timeout: float
+        :param write_through: True to also write the objects put in S3 to the local cache
+        :type write_through: bool
+        :param async_upload: When writing through, True to upload objects to S3 in the background after they are
+        written to the local cache, False to upload them before put returns
+        :type async_upload: bool
+        """
+        super(CachedS3BasicFacade, self).__init__(bucket, region, retry_policy=retry_policy,
+                                                  hedging_policy=hedging_policy,
+                                                  max_pool_connections=max_pool_connections)
         self.use_cache = use_cache
         if cache_path is None:
             cache_path = self.DEFAULT_CACHE_PATH
@@ -22,9 +89,34 @@ class CachedS3BasicFacade(S3BasicFacade):
         if not os.path.exists(self.cache_path):
             os.makedirs(self.cache_path)
 
-        metadata_cache_path = os.path.join(self.cache_path, 'metadata')
-        if not os.path.exists(metadata_cache_path):
-            os.makedirs(metadata_cache_path)
+        for sub_dir in (self.METADATA_DIR, self.DECODED_DIR):
+            sub_dir_path = os.path.join(self.cache_path, sub_dir)
+            if not os.path.exists(sub_dir_path):
+                os.makedirs(sub_dir_path)
+
+        self.cache_lock_timeout = cache_lock_timeout
+        self.locks_path = os.path.join(self.cache_path, self.LOCKS_DIR)
+        if not os.path.exists(self.locks_path):
+            os.makedirs(self.locks_path)
+
+        self.write_through = write_through
+        self.async_upload = async_upload
+        self.failed_uploads = 0
+        self._uploads = queue.Queue()
+        self._uploader = None
+        self._uploader_lock = Lock()
+
+        self.listing_cache_ttl = listing_cache_ttl
+        self.listings_cache_path = os.path.join(self.cache_path, self.LISTINGS_DIR)
+        if listing_cache_ttl is not None and not os.path.exists(self.listings_cache_path):
+            os.makedirs(self.listings_cache_path)
+
+        # Access to the cache is only tracked when it has a budget
+        self.cache_index = None
+        if max_cache_bytes is not None or max_cache_entries is not None:
+            self.cache_index = DiskCacheIndex(self.cache_path, sub_dirs=('', self.METADATA_DIR, self.DECODED_DIR),
+                                              max_bytes=max_cache_bytes, max_entries=max_cache_entries,
+                                              eviction_policy=cache_eviction_policy)
 
     def get_string(self, key):
         """
@@ -40,24 +132,27 @@ class CachedS3BasicFacade(S3BasicFacade):
             logger.info("use_cache is False ignoring all caching mechanisms")
             return super(CachedS3BasicFacade, self).get_string(key)
         local_key_path = self._get_cache_path(key)
-        found_locally = False
-        if os.path.exists(local_key_path):
-            with open(local_key_path, "rb") as fid:
-                raw_data = fid.read()
-                logger.info("File was found in local cache {}".format(local_key_path))
-                found_locally = True
-        else:
+        raw_data = self._read_cached_file(local_key_path)
+        if raw_data is not None:
+            return raw_data
+
+        with self._cache_population_lock(local_key_path):
+            # Another process may have cached the file while this one waited for the lock
+            raw_data = self._read_cached_file(local_key_path)
+            if raw_data is not None:
+                return raw_data
+
             logger.info(
                 "File does not exist locally at {}, trying to fetch from S3".format(local_key_path)
             )
             raw_data = super(CachedS3BasicFacade, self).get_string(key)
-        try:
-            if not found_locally:
+            try:
                 self.cache_data_in_local_path(local_key_path, raw_data)
-        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
-        except Exception as caching_error:   # pylint: disable=broad-except
-            logger.info("Caching mechanism failed caching_error: {}".format(caching_error))
-        return raw_data
+                self._track_cached_file(local_key_path)
+            # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+            except Exception as caching_error:   # pylint: disable=broad-except
+                logger.info("Caching mechanism failed caching_error: {}".format(caching_error))
+            return raw_data
 
     def get_buffered_reader(self, key):
         """
@@ -68,70 +163,690 @@ class CachedS3BasicFacade(S3BasicFacade):
             logger.info("use_cache is False ignoring all caching mechanisms")
             return super(CachedS3BasicFacade, self).get_buffered_reader(key)
         local_key_path = self._get_cache_path(key)
-        found_locally = False
-        if os.path.exists(local_key_path):
-            raw_data = open(local_key_path, "rb")
-            logger.info("File was found in local cache {}".format(local_key_path))
-            found_locally = True
-        else:
+        cached_file = self._read_cached_file(local_key_path, as_reader=True)
+        if cached_file is not None:
+            return cached_file
+
+        with self._cache_population_lock(local_key_path):
+            # Another process may have cached the file while this one waited for the lock
+            cached_file = self._read_cached_file(local_key_path, as_reader=True)
+            if cached_file is not None:
+                return cached_file
+
             logger.info(
                 "File does not exist locally at {}, trying to fetch from S3".format(local_key_path)
             )
             raw_data = super(CachedS3BasicFacade, self).get_buffered_reader(key)
-        try:
-            if not found_locally:
+            try:
                 self.cache_data_in_local_path(local_key_path, raw_data)
                 # we need to open the file again, since the original stream has been consumed
-                return open(local_key_path, "rb")
+                cached_file = self._open_cached_file(local_key_path)
+                self._track_cached_file(local_key_path)
+                return cached_file
+            # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+            except Exception as caching_error:   # pylint: disable=broad-except
+                # at this point we don't know if the stream was consumed or not, so we need to get the data again
+                raw_data = super(CachedS3BasicFacade, self).get_buffered_reader(key)
+                logger.info("Caching mechanism failed caching_error: {}".format(caching_error))
+
+            return raw_data
+
+    def _read_cached_file(self, local_key_path, as_reader=False):
+        """
+        :param local_key_path: Path of the cached file
+        :type local_key_path: str
+        :param as_reader: True to return a reader of the cached file instead of its content
+        :type as_reader: bool
+        :return: Content (or reader) of the cached file, None if it is not cached
+        :rtype: bytes | io.BufferedReader
+        """
+        if not os.path.exists(local_key_path):
+            return None
+        try:
+            if as_reader:
+                cached_data = self._open_cached_file(local_key_path)
+            else:
+                with open(local_key_path, "rb") as fid:
+                    cached_data = fid.read()
+        except (IOError, OSError) as ex:
+            # The file may have been evicted in the meantime
+            logger.info("Failed reading cached file {} - {}".format(local_key_path, ex))
+            return None
+        logger.info("File was found in local cache {}".format(local_key_path))
+        self._track_cache_access(local_key_path)
+        return cached_data
+
+    def _cache_population_lock(self, local_key_path):
+        """
+        :param local_key_path: Path of the cached file
+        :type local_key_path: str
+        :return: Lock between processes sharing the cache path, held while the given file is fetched and cached so
+        only one of them fetches it
+        :rtype: FileLock
+        """
+        relative_path = os.path.relpath(local_key_path, self.cache_path)
+        lock_name = hashlib.sha1(relative_path.encode('utf-8')).hexdigest() + '.lock'
+        return FileLock(os.path.join(self.locks_path, lock_name), timeout=self.cache_lock_timeout)
+
+    def put_string(self, key, string, **kwargs):
+        """
+        Put a string in S3, when writing through it is also written to the local cache
+
+        :param key: S3 key
+        :type key: str
+        :param string: string to store in S3
+        :type string: str
+        :param kwargs: kwargs
+        :type kwargs: dict
+        """
+        if not self._is_writing_through():
+            return super(CachedS3BasicFacade, self).put_string(key, string, **kwargs)
+
+        try:
+            local_key_path = self._get_cache_path(key)
+            data = string if isinstance(string, bytes) else string.encode('utf-8')
+            self.cache_data_in_local_path(local_key_path, data)
+            self._track_cached_file(local_key_path)
         # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
-        except Exception as caching_error:   # pylint: disable=broad-except
-            # at this point we don't know if the stream was consumed or not, so we need to get the data again
-            raw_data = super(CachedS3BasicFacade, self).get_buffered_reader(key)
+        except Exception as caching_error:  # pylint: disable=broad-except
             logger.info("Caching mechanism failed caching_error: {}".format(caching_error))
+        self._invalidate_listings(key)
+
+        return self._upload(key, lambda: super(CachedS3BasicFacade, self).put_string(key, string, **kwargs))
+
+    def put_buffered_reader(self, key, buffered_reader, **kwargs):
+        """
+        Put a buffered reader in S3 at the given key, when writing through it is written to the local cache first and
+        uploaded from there
+
+        :param key: S3 key
+        :type key: str
+        :param buffered_reader: buffered reader to store in S3
+        :type buffered_reader: io.BufferedReader
+        :param kwargs: Additional params for the AWS API call
+        :type kwargs: dict
+        """
+        if not self._is_writing_through():
+            return super(CachedS3BasicFacade, self).put_buffered_reader(key, buffered_reader, **kwargs)
+
+        local_key_path = self._get_cache_path(key)
+        start_position = buffered_reader.tell() if self._is_seekable(buffered_reader) else None
+        try:
+            self.cache_data_in_local_path(local_key_path, buffered_reader)
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as caching_error:  # pylint: disable=broad-except
+            if start_position is None:
+                raise
+            logger.info("Caching mechanism failed caching_error: {}".format(caching_error))
+            buffered_reader.seek(start_position)
+            return super(CachedS3BasicFacade, self).put_buffered_reader(key, buffered_reader, **kwargs)
+
+        # The cached file is the source of the upload, so it must not be evicted until it is uploaded
+        relative_path = os.path.relpath(local_key_path, self.cache_path)
+        if self.cache_index is not None:
+            self.cache_index.pin(relative_path)
+        self._track_cached_file(local_key_path)
+        self._invalidate_listings(key)
+
+        def upload():
+            try:
+                with open(local_key_path, "rb") as cached_file:
+                    return super(CachedS3BasicFacade, self).put_buffered_reader(key, cached_file, **kwargs)
+            finally:
+                if self.cache_index is not None:
+                    self.cache_index.unpin(relative_path)
+
+        return self._upload(key, upload)
+
+    def flush_uploads(self):
+        """
+        Waits until all the background uploads are completed
+        """
+        if self._uploader is not None:
+            self._uploads.join()
+
+    def _is_writing_through(self):
+        return self.write_through and self.use_cache
+
+    def _upload(self, key, upload_func):
+        """
+        :param key: S3 key
+        :type key: str
+        :param upload_func: Function that uploads the object
+        :type upload_func: function
+        :return: The upload result when it is uploaded synchronously
+        :rtype: dict
+        """
+        if not self.async_upload:
+            return upload_func()
+
+        with self._uploader_lock:
+            if self._uploader is None:
+                self._uploader = Thread(target=self._run_uploads, name='CachedS3BasicFacade upload Thread')
+                self._uploader.daemon = True
+                self._uploader.start()
+        self._uploads.put((key, upload_func))
+        return None
+
+    def _run_uploads(self):
+        while True:
+            key, upload_func = self._uploads.get()
+            try:
+                upload_func()
+            except Exception as ex:  # pylint: disable=broad-except
+                # The object remains in the local cache, but is missing from S3
+                self.failed_uploads += 1
+                logger.error("Failed uploading {} to S3, it only exists in the local cache {} - {}".format(
+                    key, self.cache_path, ex))
+            finally:
+                self._uploads.task_done()
+
+    def _invalidate_listings(self, key):
+        """
+        Removes the cached listings of all the prefixes of the given key, as they do not contain it
+        :param key: S3 key that was written
+        :type key: str
+        """
+        if self.listing_cache_ttl is None:
+            return
+        prefixes = [''] + [key[:index + 1] for index, char in enumerate(key) if char == '/']
+        for prefix in prefixes:
+            try:
+                os.remove(self._get_listing_cache_path(prefix))
+            except OSError:
+                pass
+
+    def get_cached_size(self, key):
+        """
+        :param key: S3 key
+        :type key: str
+        :return: Size in bytes of the cached file of the given key, None if it is not cached
+        :rtype: int
+        """
+        return self._get_file_size(self._get_cache_path(key))
+
+    def get_decoded_size(self, name):
+        """
+        :param name: Name of a decoded object in the local cache
+        :type name: str
+        :return: Size in bytes of the cached decoded object, None if it is not cached
+        :rtype: int
+        """
+        return self._get_file_size(os.path.join(self.cache_path, self.DECODED_DIR, name))
+
+    @staticmethod
+    def _get_file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def get_decoded(self, name):
+        """
+        :param name: Name of a decoded object in the local cache
+        :type name: str
+        :return: Serialized form of the decoded object, None if it is not cached or the cache is not used
+        :rtype: bytes
+        """
+        if not self.use_cache:
+            return None
+        return self._read_cached_file(os.path.join(self.cache_path, self.DECODED_DIR, name))
+
+    def put_decoded(self, name, data):
+        """
+        Caches the serialized form of a decoded object, failures are reported and ignored
+        :param name: Name of the decoded object in the local cache
+        :type name: str
+        :param data: Serialized form of the decoded object
+        :type data: bytes
+        """
+        if not self.use_cache:
+            return
+        local_path = os.path.join(self.cache_path, self.DECODED_DIR, name)
+        try:
+            self.cache_data_in_local_path(local_path, data)
+            self._track_cached_file(local_path)
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as caching_error:  # pylint: disable=broad-except
+            logger.info("Caching decoded {} failed caching_error: {}".format(name, caching_error))
+
+    def remove_decoded(self, name):
+        """
+        :param name: Name of a decoded object to remove from the local cache
+        :type name: str
+        """
+        try:
+            os.remove(os.path.join(self.cache_path, self.DECODED_DIR, name))
+        except OSError:
+            pass
+
+    def _iter_objects(self, prefix=None, start_after=None, delimiter=None):
+        """
+        Lists the objects under the given prefix from the local listings cache if it is still valid, otherwise from
+        S3 and caches the complete listing
+        :param prefix: Optional prefix of listed keys
+        :type prefix: str
+        :param start_after: Optional key to start listing after (exclusive)
+        :type start_after: str
+        :param delimiter: Optional delimiter, when given only the objects directly under the prefix are listed
+        :type delimiter: str
+        :return: Iterator of listed objects description (containing 'Key' and 'LastModified')
+        :rtype: Iterator[dict]
+        """
+        # Listings by a delimiter are partial listings of the prefix, hence are not cached
+        if not self.use_cache or self.listing_cache_ttl is None or delimiter is not None:
+            return super(CachedS3BasicFacade, self)._iter_objects(prefix, start_after, delimiter)
 
-        return raw_data
+        cached_objects = self._load_cached_listing(prefix)
+        if cached_objects is not None:
+            logger.info("Listing of prefix {} was found in local cache".format(prefix))
+            return (o for o in cached_objects if start_after is None or o['Key'] > start_after)
+
+        if start_after is not None:
+            # Resuming a listing from S3 does not produce the complete listing of the prefix, hence is not cached
+            return super(CachedS3BasicFacade, self)._iter_objects(prefix, start_after)
+
+        return self._iter_and_cache_objects(prefix)
+
+    def _iter_and_cache_objects(self, prefix):
+        """
+        Lists the objects under the given prefix from S3, and caches the listing once it was completely consumed
+        :param prefix: Optional prefix of listed keys
+        :type prefix: str
+        :return: Iterator of listed objects description (containing 'Key' and 'LastModified')
+        :rtype: Iterator[dict]
+        """
+        listed_at = time()
+        s3_objects = []
+        for s3_object in super(CachedS3BasicFacade, self)._iter_objects(prefix):
+            s3_objects.append(s3_object)
+            yield s3_object
+
+        try:
+            self._cache_listing(prefix, s3_objects, listed_at)
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as caching_error:  # pylint: disable=broad-except
+            logger.info("Caching listing of prefix {} failed caching_error: {}".format(prefix, caching_error))
+
+    def _load_cached_listing(self, prefix):
+        """
+        :param prefix: Prefix of listed keys
+        :type prefix: str
+        :return: Cached listing of the given prefix, None if it is not cached or expired
+        :rtype: list[dict]
+        """
+        listing_path = self._get_listing_cache_path(prefix)
+        try:
+            with open(listing_path, "rb") as fid:
+                listing = json.loads(fid.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+        if listing.get('prefix') != (prefix or '') or \
+                (not listing['immutable'] and time() - listing['listed_at'] > self.listing_cache_ttl):
+            return None
+
+        return [{'Key': key, 'LastModified': datetime.fromtimestamp(last_modified, pytz.utc)}
+                for key, last_modified in listing['objects']]
+
+    def _cache_listing(self, prefix, s3_objects, listed_at):
+        """
+        :param prefix: Prefix of listed keys
+        :type prefix: str
+        :param s3_objects: Complete listing of the prefix
+        :type s3_objects: list[dict]
+        :param listed_at: Time the listing started
+        :type listed_at: float
+        """
+        listing = {
+            'prefix': prefix or '',
+            'listed_at': listed_at,
+            'immutable': self._is_immutable_prefix(prefix, listed_at),
+            'objects': [[o['Key'], timegm(o['LastModified'].utctimetuple())] for o in s3_objects],
+        }
+        self.cache_data_in_local_path(self._get_listing_cache_path(prefix), json.dumps(listing).encode('utf-8'))
+
+    def _get_listing_cache_path(self, prefix):
+        """
+        :param prefix: Prefix of listed keys
+        :type prefix: str
+        :return: Path of the cached listing of the given prefix
+        :rtype: str
+        """
+        # The cache path may be shared by facades of different buckets and regions. The key is built from the facade
+        # settings rather than the client, so serving a cached listing does not create a client
+        listing_key = u'\n'.join([self.region or '', self.bucket, prefix or ''])
+        return os.path.join(self.listings_cache_path, hashlib.sha1(listing_key.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def _is_immutable_prefix(cls, prefix, listed_at):
+        """
+        Recordings are saved under the day they were created in, so the listing of a day that ended before the listing
+        started can no longer change. Recordings may be saved with a local time day and uploaded asynchronously, hence
+        only days that ended more than a day before are considered past days
+        :param prefix: Prefix of listed keys
+        :type prefix: str
+        :param listed_at: Time the listing started
+        :type listed_at: float
+        :return: Whether the listing of the given prefix can no longer change
+        :rtype: bool
+        """
+        days = cls.DAY_SEGMENT_PATTERN.findall(prefix or '')
+        if not days:
+            return False
+        try:
+            day = datetime.strptime(days[-1], '%Y%m%d')
+        except ValueError:
+            return False
+        return day + timedelta(days=2) <= datetime.utcfromtimestamp(listed_at)
 
     @staticmethod
-    def cache_data_in_local_path(local_full_key_path, raw_data):
+    def cache_data_in_local_path(local_full_key_path, raw_data, expected_size=None):
         """
          Cache raw_data in local path local_full_key_path
 
         Uses atomic write (write to temp file, then rename) to prevent zero-size
-        cache files when the write fails partway through. Reads streams into memory
-        first to avoid compatibility issues with io.BufferedReader wrapping objects
-        that don't fully implement RawIOBase (e.g. boto3 StreamingBody on PyPy3
-        which lacks readinto()).
+        cache files when the write fails partway through. Streams are copied in
+        chunks of CACHE_WRITE_CHUNK_SIZE bytes using only read(amt), so large objects
+        are never held in memory and objects that don't fully implement RawIOBase
+        (e.g. boto3 StreamingBody on PyPy3 which lacks readinto()) are supported.
+        The size of the written data is verified against the expected size (given or
+        taken from the content_length of the stream) before the file is renamed.
 
         :param local_full_key_path: path for local cache
         :type local_full_key_path: str
         :param raw_data: raw data to be cached
         :type raw_data: bytes | BufferedReader
+        :param expected_size: Optional expected size of the data in bytes
+        :type expected_size: int
         """
-        data = raw_data.read() if hasattr(raw_data, 'read') else raw_data
+        if expected_size is None:
+            expected_size = getattr(raw_data, 'content_length', None)
         tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_full_key_path))
         try:
+            written_size = 0
             with os.fdopen(tmp_fd, 'wb') as fid:
-                fid.write(data)
+                if hasattr(raw_data, 'read'):
+                    chunk = raw_data.read(CachedS3BasicFacade.CACHE_WRITE_CHUNK_SIZE)
+                    while chunk:
+                        fid.write(chunk)
+                        written_size += len(chunk)
+                        chunk = raw_data.read(CachedS3BasicFacade.CACHE_WRITE_CHUNK_SIZE)
+                else:
+                    fid.write(raw_data)
+                    written_size = len(raw_data)
+            if expected_size is not None and written_size != expected_size:
+                raise IOError("Cached data of {} is {} bytes instead of {} bytes".format(
+                    local_full_key_path, written_size, expected_size))
             os.rename(tmp_path, local_full_key_path)
         except BaseException:
             os.unlink(tmp_path)
             raise
         logger.info("Caching in {} succeeded".format(local_full_key_path))
 
+    def _open_cached_file(self, local_key_path):
+        """
+        :param local_key_path: Path of the cached file
+        :type local_key_path: str
+        :return: Reader of the cached file, which is protected from eviction until the reader is closed
+        :rtype: io.BufferedReader
+        """
+        if self.cache_index is None:
+            return open(local_key_path, "rb")
+        return PinnedFileReader(local_key_path, self.cache_index, os.path.relpath(local_key_path, self.cache_path))
+
+    def _track_cache_access(self, local_key_path):
+        """
+        :param local_key_path: Path of the cached file that was accessed
+        :type local_key_path: str
+        """
+        if self.cache_index is None:
+            return
+        try:
+            self.cache_index.touch(os.path.relpath(local_key_path, self.cache_path))
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as index_error:  # pylint: disable=broad-except
+            logger.info("Cache index update failed index_error: {}".format(index_error))
+
+    def _track_cached_file(self, local_key_path):
+        """
+        Indexes a newly cached file, which may evict other cached files
+        :param local_key_path: Path of the newly cached file
+        :type local_key_path: str
+        """
+        if self.cache_index is None:
+            return
+        try:
+            self.cache_index.add(os.path.relpath(local_key_path, self.cache_path), os.path.getsize(local_key_path))
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as index_error:  # pylint: disable=broad-except
+            logger.info("Cache index update failed index_error: {}".format(index_error))
+
     def _get_cache_path(self, key):
         recording_id = os.path.basename(key)
         # metadata should be cached separately from the main recording, so we need to detect
         # it and prepare the cache path accordingly
         if 'metadata' in key:
-            path_suffix = "metadata/{}".format(recording_id)
+            path_suffix = os.path.join(self.METADATA_DIR, recording_id)
         else:
             path_suffix = recording_id
 
         return os.path.join(self.cache_path, path_suffix)
 
 
-class CachedReadOnlyS3TapeCassette(S3TapeCassette):
-    def __init__(  # pylint: disable=too-many-arguments
+class CachedS3TapeCassette(S3TapeCassette):
+    """
+    S3 cassette that keeps recordings in a local cache. Recordings are fetched from the local cache when they are
+    there, falling back to S3 otherwise. Recordings saved by a cassette that is not read only are written through the
+    local cache, so replaying them on the same host never downloads them
+    """
+    # Version of the format of decoded recordings in the local cache, should change when the format changes
+    DECODED_CODEC_VERSION = 1
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        bucket,
+        key_prefix="",
+        region=None,
+        transient=False,
+        read_only=False,
+        infrequent_access_kb_threshold=None,
+        sampling_calculator=None,
+        local_path=None,
+        use_cache=True,
+        retry_policy=None,
+        hedging_policy=None,
+        max_pool_connections=None,
+        max_cache_bytes=None,
+        max_cache_entries=None,
+        cache_eviction_policy=EvictionPolicy.LRU,
+        listing_cache_ttl=CachedS3BasicFacade.DEFAULT_LISTING_CACHE_TTL,
+        memory_cache_bytes=None,
+        cache_lock_timeout=CachedS3BasicFacade.DEFAULT_CACHE_LOCK_TIMEOUT,
+        decoded_cache=False,
+        async_upload=False,
+        recording_type=MemoryRecording,
+        estimate_sampling_size=False,
+        indexed_metadata_fields=None,
+        partition_by_hour=False,
+    ):
+        """
+        See S3TapeCassette and CachedS3BasicFacade for the rest of the params
+        :param local_path: Optional local cache path
+        :type local_path: str
+        :param memory_cache_bytes: Optional budget in bytes (estimated by Recording.estimate_size) of an in process
+        cache of decoded recordings, fetching a recording that is in this cache requires no reading and decoding.
+        None means recordings are decoded on every fetch
+        :type memory_cache_bytes: int
+        :param decoded_cache: True to also keep decoded recordings in the local cache in a format that is much faster
+        to load (pickle), so loading a cached recording skips decompressing and decoding it
+        :type decoded_cache: bool
+        :param async_upload: True to upload saved recordings to S3 in the background after they are written to the
+        local cache, False to upload them before save returns
+        :type async_upload: bool
+        """
+        super(CachedS3TapeCassette, self).__init__(
+            bucket, key_prefix, region, transient, read_only=read_only,
+            infrequent_access_kb_threshold=infrequent_access_kb_threshold,
+            sampling_calculator=sampling_calculator, recording_type=recording_type,
+            estimate_sampling_size=estimate_sampling_size, indexed_metadata_fields=indexed_metadata_fields,
+            partition_by_hour=partition_by_hour
+        )
+        self._s3_facade = CachedS3BasicFacade(self.bucket, region=region, cache_path=local_path, use_cache=use_cache,
+                                              retry_policy=retry_policy, hedging_policy=hedging_policy,
+                                              max_pool_connections=max_pool_connections,
+                                              max_cache_bytes=max_cache_bytes, max_cache_entries=max_cache_entries,
+                                              cache_eviction_policy=cache_eviction_policy,
+                                              listing_cache_ttl=listing_cache_ttl,
+                                              cache_lock_timeout=cache_lock_timeout,
+                                              write_through=not read_only, async_upload=async_upload)
+        self._recordings_cache = SizeBoundedLRUCache(memory_cache_bytes) if memory_cache_bytes else None
+        self.decoded_cache = decoded_cache
+
+    def flush(self):
+        """
+        Waits until all the recordings saved so far are uploaded to S3
+        """
+        self._s3_facade.flush_uploads()
+
+    def close(self):
+        """
+        Uploads the pending recordings and closes this cassette, if set to be transient it will delete all recordings
+        """
+        self.flush()
+        super(CachedS3TapeCassette, self).close()
+
+    def get_recording(self, recording_id):
+        """
+        :param recording_id: The id of the recording to fetch
+        :type recording_id: basestring
+        :return: Fetched recording, from the in process cache of decoded recordings if it is there
+        :rtype: playback.recording.Recording
+        """
+        if self._recordings_cache is None:
+            return self._get_decoded_recording(recording_id)
+
+        recording = self._recordings_cache.get(recording_id)
+        if recording is None:
+            recording = self._get_decoded_recording(recording_id)
+            # Only memory recordings are decoded on fetch, other recordings are backed by a local resource
+            if not isinstance(recording, MemoryRecording):
+                return recording
+            self._recordings_cache.put(recording_id, recording, recording.estimate_size())
+        else:
+            logger.info("Recording {} was found in the decoded recordings cache".format(recording_id))
+
+        return self._copy_cached_recording(recording)
+
+    @property
+    def cache_budget(self):
+        """
+        :return: Maximal total size in bytes and maximal number of files of the local cache (None means unbounded)
+        :rtype: (int, int)
+        """
+        cache_index = self._s3_facade.cache_index
+        if cache_index is None:
+            return None, None
+        return cache_index.max_bytes, cache_index.max_entries
+
+    def warm_up_recording(self, recording_id):
+        """
+        Fetches the given recording into the local cache (its metadata, full data and decoded form when
+        decoded_cache is on) without decoding it unless needed
+        :param recording_id: The id of the recording to fetch
+        :type recording_id: basestring
+        :return: Size in bytes and number of the files of the recording in the local cache
+        :rtype: (int, int)
+        """
+        metadata_key = self.METADATA_KEY.format(key_prefix=self.key_prefix, id=recording_id)
+        full_key = self.FULL_KEY.format(key_prefix=self.key_prefix, id=recording_id)
+        self._s3_facade.get_string(metadata_key)
+        if self.decoded_cache:
+            self._get_decoded_recording(recording_id)
+        else:
+            self._s3_facade.get_buffered_reader(full_key).close()
+
+        sizes = [self._s3_facade.get_cached_size(metadata_key), self._s3_facade.get_cached_size(full_key)]
+        if self.decoded_cache:
+            sizes.append(self._s3_facade.get_decoded_size(self._get_decoded_name(recording_id)))
+        return sum(size or 0 for size in sizes), len(sizes)
+
+    def _get_decoded_recording(self, recording_id):
+        """
+        :param recording_id: The id of the recording to fetch
+        :type recording_id: basestring
+        :return: Fetched recording, loaded from the local cache of decoded recordings if it is there
+        :rtype: playback.recording.Recording
+        """
+        if not self.decoded_cache:
+            return super(CachedS3TapeCassette, self).get_recording(recording_id)
+
+        decoded_name = self._get_decoded_name(recording_id)
+        recording = self._load_decoded_recording(recording_id, decoded_name)
+        if recording is not None:
+            return recording
+
+        recording = super(CachedS3TapeCassette, self).get_recording(recording_id)
+        if isinstance(recording, MemoryRecording):
+            try:
+                decoded = pickle.dumps((recording.recording_data, recording.recording_metadata),
+                                       pickle.HIGHEST_PROTOCOL)
+            # Not every decoded object can be pickled, such recordings are just not cached decoded
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.info("Recording {} cannot be cached decoded - {}".format(recording_id, ex))
+            else:
+                self._s3_facade.put_decoded(decoded_name, decoded)
+        return recording
+
+    def _load_decoded_recording(self, recording_id, decoded_name):
+        """
+        :param recording_id: The id of the recording to load
+        :type recording_id: basestring
+        :param decoded_name: Name of the decoded recording in the local cache
+        :type decoded_name: str
+        :return: The recording loaded from the local cache of decoded recordings, None if it is not there
+        :rtype: MemoryRecording
+        """
+        decoded = self._s3_facade.get_decoded(decoded_name)
+        if decoded is None:
+            return None
+        try:
+            # The local cache is written only by this cassette, hence it is trusted
+            recording_data, recording_metadata = pickle.loads(decoded)
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.info("Failed loading decoded recording {}, decoding it again - {}".format(recording_id, ex))
+            self._s3_facade.remove_decoded(decoded_name)
+            return None
+        return MemoryRecording(recording_id, recording_data=recording_data, recording_metadata=recording_metadata)
+
+    @classmethod
+    def _get_decoded_name(cls, recording_id):
+        """
+        :param recording_id: Recording id
+        :type recording_id: basestring
+        :return: Name of the decoded recording in the local cache, it changes with the codec version and python major
+        version as pickles are not compatible between them
+        :rtype: str
+        """
+        return '{}.v{}-py{}.pickle'.format(hashlib.sha1(recording_id.encode('utf-8')).hexdigest(),
+                                           cls.DECODED_CODEC_VERSION, sys.version_info[0])
+
+    @staticmethod
+    def _copy_cached_recording(recording):
+        """
+        The served recording gets its own copy of the data values and the metadata, so changing it (e.g. through
+        get_data_direct) keeps the cached recording intact
+        :param recording: Cached recording
+        :type recording: MemoryRecording
+        :return: Copy of the cached recording that can be served
+        :rtype: MemoryRecording
+        """
+        return MemoryRecording(recording.id, recording_data=deepcopy(recording.recording_data),
+                               recording_metadata=deepcopy(recording.recording_metadata))
+
+
+class CachedReadOnlyS3TapeCassette(CachedS3TapeCassette):
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
         self,
         bucket,
         key_prefix="",
@@ -142,12 +857,28 @@ class CachedReadOnlyS3TapeCassette(S3TapeCassette):
         sampling_calculator=None,
         local_path=None,
         use_cache=True,
+        retry_policy=None,
+        hedging_policy=None,
+        max_pool_connections=None,
+        max_cache_bytes=None,
+        max_cache_entries=None,
+        cache_eviction_policy=EvictionPolicy.LRU,
+        listing_cache_ttl=CachedS3BasicFacade.DEFAULT_LISTING_CACHE_TTL,
+        memory_cache_bytes=None,
+        cache_lock_timeout=CachedS3BasicFacade.DEFAULT_CACHE_LOCK_TIMEOUT,
+        decoded_cache=False,
     ):
+        """
+        See CachedS3TapeCassette for the params
+        """
         if read_only is not True:
             raise ValueError("CachedReadOnlyS3TapeCassette is designed to be in read_only state only")
         super(CachedReadOnlyS3TapeCassette, self).__init__(
             bucket, key_prefix, region, transient, read_only=read_only,
             infrequent_access_kb_threshold=infrequent_access_kb_threshold,
-            sampling_calculator=sampling_calculator
+            sampling_calculator=sampling_calculator, local_path=local_path, use_cache=use_cache,
+            retry_policy=retry_policy, hedging_policy=hedging_policy, max_pool_connections=max_pool_connections,
+            max_cache_bytes=max_cache_bytes, max_cache_entries=max_cache_entries,
+            cache_eviction_policy=cache_eviction_policy, listing_cache_ttl=listing_cache_ttl,
+            memory_cache_bytes=memory_cache_bytes, cache_lock_timeout=cache_lock_timeout, decoded_cache=decoded_cache
         )
-        self._s3_facade = CachedS3BasicFacade(self.bucket, region=region, cache_path=local_path, use_cache=use_cache)
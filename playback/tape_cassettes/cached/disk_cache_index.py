@@ -0,0 +1,425 @@
+import errno
+import io
+import json
+import logging
+import os
+import tempfile
+from threading import RLock
+from time import time
+
+from playback.tape_cassettes.cached.file_lock import FileLock
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows, pins are only respected within the process there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class EvictionPolicy(object):
+    LRU = 'lru'
+    LFU = 'lfu'
+
+
+class DiskCacheIndex(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Index of the files in a disk cache that tracks their size and access, and evicts files when the cache exceeds its
+    budget. The index is persisted in the cache directory, files that are not indexed yet (e.g. cached by an older
+    version) are discovered incrementally, a small batch on every index update, instead of walking the whole cache
+    directory on startup.
+    The cache directory may be shared by several processes, each of them merges the persisted index into its own
+    under a file lock before saving, so files cached or evicted by other processes are accounted for, and pinned
+    files hold a shared advisory lock that other processes respect when evicting
+    """
+    INDEX_FILE_NAME = 'cache_index.json'
+    # Maximal time in seconds to wait for other processes updating the index
+    LOCK_TIMEOUT = 5
+    # Number of directory entries to discover on each index update
+    SCAN_BATCH_SIZE = 200
+    # Minimal interval in seconds between saves of the index when only access times changed
+    SAVE_INTERVAL = 10
+
+    def __init__(self, cache_path, sub_dirs=('',), max_bytes=None, max_entries=None,
+                 eviction_policy=EvictionPolicy.LRU):
+        """
+        :param cache_path: Root path of the cache
+        :type cache_path: str
+        :param sub_dirs: Directories relative to the cache path that hold cached files
+        :type sub_dirs: tuple[str]
+        :param max_bytes: Optional maximal total size in bytes of the cached files
+        :type max_bytes: int
+        :param max_entries: Optional maximal number of cached files
+        :type max_entries: int
+        :param eviction_policy: Which files to evict first, least recently used ('lru') or least frequently used ('lfu')
+        :type eviction_policy: str
+        """
+        if eviction_policy not in (EvictionPolicy.LRU, EvictionPolicy.LFU):
+            raise ValueError(u'Unknown eviction policy {}'.format(eviction_policy))
+        self.cache_path = cache_path
+        self.sub_dirs = sub_dirs
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.eviction_policy = eviction_policy
+        self.index_path = os.path.join(cache_path, self.INDEX_FILE_NAME)
+        # Relative path -> [size, last access time, access count]
+        self._entries = {}
+        # Paths in the persisted index when it was last loaded or saved by this process, used to tell files that
+        # were evicted by other processes from files that were added by this one
+        self._saved_paths = set()
+        self._total_bytes = 0
+        # Relative path -> [pin count, descriptor holding the shared lock of the file]
+        self._pinned = {}
+        self._lock = RLock()
+        self._last_save = 0
+        self._dirty = False
+        self._scan = self._iter_unindexed_files()
+        self._load()
+
+    @property
+    def total_bytes(self):
+        """
+        :return: Total size in bytes of the indexed files
+        :rtype: int
+        """
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, relative_path):
+        return relative_path in self._entries
+
+    def touch(self, relative_path):
+        """
+        Marks an access to a cached file
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        """
+        with self._lock:
+            entry = self._entries.get(relative_path)
+            if entry is None:
+                self._add_existing_file(relative_path)
+            else:
+                entry[1] = time()
+                entry[2] += 1
+            self._dirty = True
+            self._continue_scan()
+            self._save(force=False)
+
+    def add(self, relative_path, size):
+        """
+        Indexes a newly cached file and evicts files if the cache exceeds its budget
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        :param size: Size in bytes of the cached file
+        :type size: int
+        """
+        with self._lock, FileLock(self.index_path + '.lock', timeout=self.LOCK_TIMEOUT):
+            self._merge_saved_index()
+            self._set_entry(relative_path, size, time(), 1)
+            self._continue_scan()
+            self._evict(excluded=relative_path)
+            self._write()
+
+    def pin(self, relative_path):
+        """
+        Protects a cached file from eviction, e.g. while it is being read
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        """
+        with self._lock:
+            pinned = self._pinned.get(relative_path)
+            if pinned is not None:
+                pinned[0] += 1
+                return
+            self._pinned[relative_path] = [1, self._lock_shared(relative_path)]
+
+    def unpin(self, relative_path):
+        """
+        Releases a protection of a cached file from eviction
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        """
+        with self._lock:
+            pinned = self._pinned.get(relative_path)
+            if pinned is None:
+                return
+            pinned[0] -= 1
+            if pinned[0] <= 0:
+                del self._pinned[relative_path]
+                if pinned[1] is not None:
+                    # Closing the file releases the lock
+                    os.close(pinned[1])
+
+    def flush(self):
+        """
+        Saves the index if it has unsaved changes
+        """
+        with self._lock:
+            if self._dirty:
+                self._save(force=True)
+
+    def _set_entry(self, relative_path, size, last_access, access_count):
+        previous = self._entries.get(relative_path)
+        if previous is not None:
+            self._total_bytes -= previous[0]
+        self._entries[relative_path] = [size, last_access, access_count]
+        self._saved_paths.discard(relative_path)
+        self._total_bytes += size
+        self._dirty = True
+
+    def _remove_entry(self, relative_path):
+        entry = self._entries.pop(relative_path, None)
+        if entry is not None:
+            self._total_bytes -= entry[0]
+            self._dirty = True
+
+    def _add_existing_file(self, relative_path):
+        """
+        Indexes a file that was cached before it was indexed
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        """
+        try:
+            stat = os.stat(os.path.join(self.cache_path, relative_path))
+        except OSError:
+            return
+        self._set_entry(relative_path, stat.st_size, stat.st_mtime, 1)
+
+    def _is_over_budget(self):
+        return (self.max_bytes is not None and self._total_bytes > self.max_bytes) or \
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+
+    def _eviction_key(self, relative_path):
+        _, last_access, access_count = self._entries[relative_path]
+        if self.eviction_policy == EvictionPolicy.LFU:
+            return access_count, last_access
+        return last_access
+
+    def _lock_shared(self, relative_path):
+        """
+        Takes a shared advisory lock of a cached file, which other processes check before evicting it
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        :return: Descriptor that holds the lock, or None if the file could not be locked
+        :rtype: int
+        """
+        if fcntl is None:
+            return None
+        try:
+            fd = os.open(os.path.join(self.cache_path, relative_path), os.O_RDONLY)
+        except OSError as ex:
+            logger.info(u'Failed pinning cached file {} - {}'.format(relative_path, ex))
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        except (IOError, OSError) as ex:
+            os.close(fd)
+            logger.info(u'Failed pinning cached file {} - {}'.format(relative_path, ex))
+            return None
+        return fd
+
+    def _remove_file(self, relative_path):
+        """
+        Removes a cached file unless another process pinned it
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        :return: Whether the file was removed or did not exist
+        :rtype: bool
+        """
+        path = os.path.join(self.cache_path, relative_path)
+        fd = None
+        try:
+            if fcntl is not None:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as ex:
+                    if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    logger.info(u'Not evicting cached file {}, it is in use by another process'.format(relative_path))
+                    return False
+            os.remove(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                logger.info(u'Failed evicting cached file {} - {}'.format(relative_path, ex))
+                return False
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return True
+
+    def _evict(self, excluded):
+        """
+        Removes cached files according to the eviction policy until the cache is within its budget, files that are
+        pinned, by this process or by others, are never removed
+        :param excluded: Path of a file that should not be removed, e.g. the newly cached file
+        :type excluded: str
+        """
+        if not self._is_over_budget():
+            return
+
+        candidates = sorted((path for path in self._entries if path not in self._pinned and path != excluded),
+                            key=self._eviction_key)
+        for relative_path in candidates:
+            if not self._is_over_budget():
+                break
+            if not self._remove_file(relative_path):
+                continue
+            logger.info(u'Evicted cached file {}'.format(relative_path))
+            self._remove_entry(relative_path)
+
+    def _continue_scan(self):
+        """
+        Indexes the next batch of files that exist in the cache directory and are not indexed yet
+        """
+        if self._scan is None:
+            return
+        for _ in range(self.SCAN_BATCH_SIZE):
+            relative_path = next(self._scan, None)
+            if relative_path is None:
+                self._scan = None
+                return
+            if relative_path not in self._entries:
+                self._add_existing_file(relative_path)
+
+    def _iter_unindexed_files(self):
+        """
+        :return: Iterator of the paths relative to the cache path of the files in the cache directories
+        :rtype: Iterator[str]
+        """
+        scandir = getattr(os, 'scandir', None)
+        for sub_dir in self.sub_dirs:
+            dir_path = os.path.join(self.cache_path, sub_dir)
+            try:
+                if scandir is not None:
+                    names = (entry.name for entry in scandir(dir_path) if entry.is_file())
+                else:
+                    names = (name for name in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, name)))
+                for name in names:
+                    relative_path = os.path.join(sub_dir, name) if sub_dir else name
+                    if not self._is_internal_file(relative_path, name):
+                        yield relative_path
+            except OSError:
+                continue
+
+    def _is_internal_file(self, relative_path, name):
+        """
+        :return: Whether the file is not a cached file, but the index, its lock or a temporary file that is being
+            written, e.g. by tempfile.mkstemp
+        :rtype: bool
+        """
+        return relative_path in (self.INDEX_FILE_NAME, self.INDEX_FILE_NAME + '.lock') or name.endswith('.index') or \
+            name.startswith(tempfile.gettempprefix())
+
+    def _read_saved_entries(self):
+        """
+        :return: Entries of the persisted index, or None if it is missing or corrupted
+        :rtype: dict[str, list]
+        """
+        try:
+            with io.open(self.index_path, 'r', encoding='utf-8') as fid:
+                entries = json.load(fid)
+            return {relative_path: [size, last_access, access_count]
+                    for relative_path, (size, last_access, access_count) in entries.items()}
+        except (IOError, OSError, ValueError, TypeError) as ex:
+            if os.path.exists(self.index_path):
+                logger.info(u'Failed loading disk cache index {} - {}'.format(self.index_path, ex))
+            return None
+
+    def _load(self):
+        """
+        Loads the persisted index, a missing or corrupted index is rebuilt incrementally
+        """
+        entries = self._read_saved_entries()
+        if entries is None:
+            return
+        for relative_path, (size, last_access, access_count) in entries.items():
+            self._set_entry(relative_path, size, last_access, access_count)
+        self._saved_paths = set(entries)
+        self._dirty = False
+
+    def _merge_saved_index(self):
+        """
+        Merges the persisted index, which may have been updated by other processes, into this index. Files that
+        were added to the persisted index since it was last loaded or saved by this process are indexed, files that
+        were removed from it are no longer indexed, and the access of files indexed by both is combined
+        """
+        saved_entries = self._read_saved_entries()
+        if saved_entries is None:
+            return
+        for relative_path, (size, last_access, access_count) in saved_entries.items():
+            entry = self._entries.get(relative_path)
+            if entry is not None:
+                entry[1] = max(entry[1], last_access)
+                entry[2] = max(entry[2], access_count)
+            elif relative_path not in self._saved_paths:
+                self._set_entry(relative_path, size, last_access, access_count)
+        for relative_path in [path for path in self._entries
+                              if path in self._saved_paths and path not in saved_entries]:
+            self._remove_entry(relative_path)
+
+    def _save(self, force):
+        """
+        Merges the persisted index and saves the result
+        :param force: Save even if the last save was in the last SAVE_INTERVAL seconds
+        :type force: bool
+        """
+        if not force and time() - self._last_save < self.SAVE_INTERVAL:
+            return
+        with FileLock(self.index_path + '.lock', timeout=self.LOCK_TIMEOUT):
+            self._merge_saved_index()
+            self._write()
+
+    def _write(self):
+        """
+        Atomically saves the index, failures are logged and ignored
+        """
+        now = time()
+        try:
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_path, suffix='.index')
+            try:
+                with os.fdopen(tmp_fd, 'w') as fid:
+                    json.dump(self._entries, fid)
+                os.rename(tmp_path, self.index_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._saved_paths = set(self._entries)
+            self._last_save = now
+            self._dirty = False
+        # We want a cache fail proof mechanism hence we catch any exception report it and ignore the failure.
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.info(u'Failed saving disk cache index {} - {}'.format(self.index_path, ex))
+
+
+class PinnedFileReader(io.BufferedReader):
+    """
+    Buffered reader of a cached file that protects the file from eviction until the reader is closed
+    """
+    def __init__(self, path, index, relative_path):
+        """
+        :param path: Path of the cached file
+        :type path: str
+        :param index: Index of the cache
+        :type index: DiskCacheIndex
+        :param relative_path: Path of the cached file relative to the cache path
+        :type relative_path: str
+        """
+        self._index = index
+        self._relative_path = relative_path
+        index.pin(relative_path)
+        try:
+            super(PinnedFileReader, self).__init__(io.FileIO(path, 'rb'))
+        except BaseException:
+            index.unpin(relative_path)
+            raise
+
+    def close(self):
+        if not self.closed:
+            try:
+                super(PinnedFileReader, self).close()
+            finally:
+                self._index.unpin(self._relative_path)
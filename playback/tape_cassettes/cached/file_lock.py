@@ -0,0 +1,103 @@
+import errno
+import logging
+import os
+from time import sleep, time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows, locking is skipped there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock(object):
+    """
+    Exclusive lock between processes (and threads) based on an advisory lock of a lock file. The lock is held by an
+    open file, so the operating system releases it when the holding process dies and a crashed holder never leaves
+    a stale lock behind. When the lock cannot be acquired within the timeout, or locking is not supported, the
+    protected code runs without the lock
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: Path of the lock file
+        :type path: str
+        :param timeout: Maximal time in seconds to wait for the lock
+        :type timeout: float
+        """
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+
+    @property
+    def is_locked(self):
+        """
+        :return: Whether the lock is held by this object
+        :rtype: bool
+        """
+        return self._fd is not None
+
+    def acquire(self):
+        """
+        Waits until the lock is acquired or the timeout has passed
+        :return: Whether the lock was acquired
+        :rtype: bool
+        """
+        if fcntl is None:
+            return False
+
+        deadline = time() + self.timeout
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as ex:
+                os.close(fd)
+                if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time() >= deadline:
+                    logger.info(u'Timed out waiting for lock {}'.format(self.path))
+                    return False
+                sleep(self.POLL_INTERVAL)
+                continue
+
+            # The previous holder removes the lock file on release, if it did so after this file was opened the lock
+            # is on a removed file and has to be acquired again on the current one
+            if self._is_current_file(fd):
+                self._fd = fd
+                return True
+            os.close(fd)
+
+    def release(self):
+        """
+        Releases the lock if it is held
+        """
+        if self._fd is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        fd, self._fd = self._fd, None
+        # Closing the file releases the lock
+        os.close(fd)
+
+    def _is_current_file(self, fd):
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(self.path))
+        except OSError:
+            return False
+
+    def __enter__(self):
+        try:
+            self.acquire()
+        # Locking is an optimization, failing to lock should not fail the protected code
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.info(u'Failed acquiring lock {} - {}'.format(self.path, ex))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
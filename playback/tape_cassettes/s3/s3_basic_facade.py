@@ -1,22 +1,262 @@
 import io
 import logging
+import sys
+from collections import Counter, deque
 from functools import reduce
 from random import shuffle
+from threading import Lock, Thread
+from time import sleep, time
 
 import boto3
 import pytz
+import six
+from botocore.config import Config
+from six.moves import queue
+
+_logger = logging.getLogger(__name__)
+
+# S3 clients are thread safe and expensive to create, so they are shared by all facades with the same settings
+_shared_clients = {}
+_shared_clients_lock = Lock()
+
+# Maximal number of keys that can be deleted by a single delete request
+_DELETE_BATCH_SIZE = 1000
+
+
+def get_shared_client(region=None, max_pool_connections=None):
+    """
+    Gets the S3 client shared by all facades with the given settings, creating it on first use
+    :param region: Optional aws region
+    :type region: str
+    :param max_pool_connections: Optional maximal number of connections kept in the client connection pool,
+    None means boto default (10)
+    :type max_pool_connections: int
+    :return: Shared S3 client
+    :rtype: botocore.client.BaseClient
+    """
+    client_key = (region, max_pool_connections)
+    with _shared_clients_lock:
+        client = _shared_clients.get(client_key)
+        if client is None:
+            if not _shared_clients:
+                _silence_aws_loggers()
+            config = Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
+            client = boto3.session.Session().client('s3', region_name=region, config=config)
+            _shared_clients[client_key] = client
+        return client
+
+
+def clear_shared_clients():
+    """
+    Drops the shared S3 clients, new ones are created on next use
+    """
+    with _shared_clients_lock:
+        _shared_clients.clear()
+
+
+def _silence_aws_loggers():
+    """
+    Silences the verbose logging of the aws libraries
+    """
+    for logger_name in ('botocore', 'boto3', 'urllib3', 's3transfer', 'requests'):
+        logging.getLogger(logger_name).setLevel(logging.CRITICAL)
 
 
 class S3BasicFacade(object):
-    def __init__(self, bucket, region=None):
+    def __init__(self, bucket, region=None, retry_policy=None, hedging_policy=None, max_pool_connections=None):
+        """
+        :param bucket: S3 bucket
+        :type bucket: str
+        :param region: Optional aws region
+        :type region: str
+        :param retry_policy: Optional retry policy of get, put and list requests, None means no retries on top of the
+        ones done by boto
+        :type retry_policy: playback.tape_cassettes.s3.s3_request_policies.RetryPolicy
+        :param hedging_policy: Optional hedging policy of get requests, None means requests are not hedged
+        :type hedging_policy: playback.tape_cassettes.s3.s3_request_policies.HedgingPolicy
+        :param max_pool_connections: Optional maximal number of connections kept in the client connection pool,
+        None means boto default (10)
+        :type max_pool_connections: int
+        """
         self.bucket = bucket
-        self._bucket = boto3.resource('s3').Bucket(bucket)
-        self.client = boto3.client('s3', region_name=region)
-        logging.getLogger('botocore').setLevel(logging.CRITICAL)
-        logging.getLogger('boto3').setLevel(logging.CRITICAL)
-        logging.getLogger('urllib3').setLevel(logging.CRITICAL)
-        logging.getLogger('s3transfer').setLevel(logging.CRITICAL)
-        logging.getLogger('requests').setLevel(logging.CRITICAL)
+        self.region = region
+        self.max_pool_connections = max_pool_connections
+        self._client = None
+        self.retry_policy = retry_policy
+        self.hedging_policy = hedging_policy
+        self._metrics = Counter()
+        self._get_latencies = deque(maxlen=hedging_policy.samples_window if hedging_policy else 1000)
+        self._metrics_lock = Lock()
+
+    @property
+    def client(self):
+        """
+        :return: S3 client of this facade, created on first use and shared with facades that have the same settings
+        :rtype: botocore.client.BaseClient
+        """
+        if self._client is None:
+            self._client = get_shared_client(self.region, self.max_pool_connections)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def get_metrics(self):
+        """
+        :return: Request metrics of this facade: counters of retries ('<operation>_retries'), hedged requests
+        ('hedged_gets') and hedged requests that completed first ('hedged_wins'), and get latency percentiles in
+        seconds ('get_latency_p50', 'get_latency_p99')
+        :rtype: dict
+        """
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics['get_latency_p50'] = self._get_latency_percentile(50)
+        metrics['get_latency_p99'] = self._get_latency_percentile(99)
+        return metrics
+
+    def _increase_metric(self, name):
+        """
+        :param name: Name of the metric counter to increase
+        :type name: str
+        """
+        with self._metrics_lock:
+            self._metrics[name] += 1
+
+    def _get_latency_percentile(self, percentile):
+        """
+        :param percentile: Percentile to calculate (0-100)
+        :type percentile: float
+        :return: Latency percentile of recent get requests, None if there are no samples
+        :rtype: float
+        """
+        with self._metrics_lock:
+            latencies = sorted(self._get_latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+    def _call_with_retries(self, operation, func, *args, **kwargs):
+        """
+        Calls the given request function, retrying it according to the retry policy
+        :param operation: Operation name (get, put, list or delete) used for metrics
+        :type operation: str
+        :param func: Request function
+        :type func: function
+        :return: Result of the request function
+        :rtype: Any
+        """
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:  # pylint: disable=broad-except
+                if self.retry_policy is None or attempt >= self.retry_policy.max_attempts or \
+                        not self.retry_policy.is_retryable(ex):
+                    raise
+                delay = self.retry_policy.backoff_delay(attempt)
+                _logger.info(u'Retrying S3 {} request in {:.3f} seconds after attempt {} failed - {}'.format(
+                    operation, delay, attempt, ex))
+                self._increase_metric(operation + '_retries')
+                attempt += 1
+                sleep(delay)
+
+    def _hedged_get(self, get_func):
+        """
+        Runs the given get request function, according to the hedging policy a second identical request is sent
+        if the first one is slower than usual, and the result of the one that completes first is returned
+        :param get_func: Get request function
+        :type get_func: function
+        :return: Result of the request function
+        :rtype: Any
+        """
+        hedging_delay = self._get_hedging_delay()
+        if hedging_delay is None:
+            return self._timed_get(get_func)
+
+        outcomes = queue.Queue()
+        state = {'completed': False}
+        state_lock = Lock()
+
+        def attempt(attempt_number):
+            try:
+                outcome = (attempt_number, self._timed_get(get_func), None)
+            except Exception:  # pylint: disable=broad-except
+                outcome = (attempt_number, None, sys.exc_info())
+            with state_lock:
+                if not state['completed']:
+                    outcomes.put(outcome)
+                    return
+            # The other request already won, release the resources held by this one
+            self._close_quietly(outcome[1])
+
+        def start_attempt(attempt_number):
+            thread = Thread(target=attempt, args=(attempt_number,), name='S3 hedged get Thread')
+            thread.daemon = True
+            thread.start()
+
+        start_attempt(1)
+        pending = 1
+        try:
+            outcome = outcomes.get(True, hedging_delay)
+            pending -= 1
+        except queue.Empty:
+            self._increase_metric('hedged_gets')
+            start_attempt(2)
+            pending += 1
+            outcome = outcomes.get()
+            pending -= 1
+
+        # When one of the requests failed, the other one still has a chance of succeeding
+        if outcome[2] is not None and pending:
+            outcome = outcomes.get()
+
+        with state_lock:
+            state['completed'] = True
+            while not outcomes.empty():
+                self._close_quietly(outcomes.get_nowait()[1])
+
+        attempt_number, result, exc_info = outcome
+        if exc_info is not None:
+            six.reraise(*exc_info)
+        if attempt_number == 2:
+            self._increase_metric('hedged_wins')
+        return result
+
+    def _get_hedging_delay(self):
+        """
+        :return: How much time to wait for a get request before sending a hedged one, None if it should not be hedged
+        :rtype: float
+        """
+        if self.hedging_policy is None or len(self._get_latencies) < self.hedging_policy.min_samples:
+            return None
+        return max(self.hedging_policy.min_delay, self._get_latency_percentile(self.hedging_policy.latency_percentile))
+
+    def _timed_get(self, get_func):
+        """
+        Runs the given get request function and samples its latency
+        :param get_func: Get request function
+        :type get_func: function
+        :return: Result of the request function
+        :rtype: Any
+        """
+        start = time()
+        result = get_func()
+        with self._metrics_lock:
+            self._get_latencies.append(time() - start)
+        return result
+
+    @staticmethod
+    def _close_quietly(result):
+        """
+        :param result: Result of a discarded request
+        :type result: Any
+        """
+        if hasattr(result, 'close'):
+            try:
+                result.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
 
     def get_buffered_reader(self, key):
         """
@@ -24,10 +264,11 @@ class S3BasicFacade(object):
 
         :param key: S3 key
         :type key: str
-        :return: buffered reader
+        :return: buffered reader, its content_length attribute holds the size of the object
         :rtype: io.BufferedReader
         """
-        streaming_body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        streaming_body = self._call_with_retries('get', self._hedged_get, lambda: self._get_object_body(key))
+        content_length = streaming_body.content_length
 
         # The proper implementation of the RawIOBase for StreamingBody was introduced in boto3@1.23.46,
         # but the last version available for Python 2.7 is 1.17.112. To support Python 2 we need to access
@@ -35,7 +276,9 @@ class S3BasicFacade(object):
         if not hasattr(streaming_body, 'readable'):
             streaming_body = streaming_body._raw_stream  # pylint: disable=protected-access
 
-        return io.BufferedReader(streaming_body)
+        buffered_reader = io.BufferedReader(streaming_body)
+        buffered_reader.content_length = content_length
+        return buffered_reader
 
     def put_buffered_reader(self, key, buffered_reader, **kwargs):
         """
@@ -55,7 +298,31 @@ class S3BasicFacade(object):
         )
         if kwargs:
             params.update(kwargs)
-        return self.client.put_object(**params)
+
+        # A failed attempt may have consumed the reader, so it can only be retried if it can be rewound
+        start_position = buffered_reader.tell() if self._is_seekable(buffered_reader) else None
+
+        def put():
+            if start_position is not None:
+                buffered_reader.seek(start_position)
+            return self.client.put_object(**params)
+
+        if start_position is None:
+            return put()
+        return self._call_with_retries('put', put)
+
+    @staticmethod
+    def _is_seekable(reader):
+        """
+        :param reader: Reader to check
+        :type reader: io.IOBase
+        :return: Whether the given reader can be rewound
+        :rtype: bool
+        """
+        try:
+            return reader.seekable()
+        except (AttributeError, ValueError):
+            return False
 
     def put_string(self, key, string, **kwargs):
         """
@@ -77,7 +344,7 @@ class S3BasicFacade(object):
         if kwargs:
             params.update(kwargs)
 
-        return self.client.put_object(**params)
+        return self._call_with_retries('put', self.client.put_object, **params)
 
     def get_string(self, key):
         """
@@ -88,10 +355,23 @@ class S3BasicFacade(object):
         :return: The string from S3
         :rtype: bytes
         """
-        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        return self._call_with_retries('get', self._hedged_get, lambda: self._get_object_body(key).read())
+
+    def _get_object_body(self, key):
+        """
+        :param key: S3 key
+        :type key: str
+        :return: Streaming body of the object under the given key, its content_length attribute holds the size of
+        the object
+        :rtype: botocore.response.StreamingBody
+        """
+        response = self.client.get_object(Bucket=self.bucket, Key=key)
+        body = response['Body']
+        body.content_length = response.get('ContentLength')
+        return body
 
     def iter_keys(self, prefix=None, start_date=None, end_date=None, content_filter=None, limit=None,
-                  random_results=False):
+                  random_results=False, start_after=None, delimiter=None):
         """
         yields the keys that exist in the S3 store.
         :param prefix: if not None, yields only objects with keys that start with the given prefix.
@@ -106,6 +386,11 @@ class S3BasicFacade(object):
         :type limit: int
         :param random_results: True to return result in random order
         :type random_results: bool
+        :param start_after: Optional key to start listing after (exclusive), used to resume a previous listing
+        :type start_after: str
+        :param delimiter: Optional delimiter, when given only the keys that do not contain it after the prefix are
+        yielded (i.e. keys directly under the prefix)
+        :type delimiter: str
         :rtype: Iterator[str]
         """
 
@@ -115,18 +400,18 @@ class S3BasicFacade(object):
             start_date = pytz.utc.localize(start_date) if start_date else None
             end_date = pytz.utc.localize(end_date) if end_date else None
 
-            predicates.append(lambda o: ((start_date is None or start_date <= o.last_modified) and
-                                         (end_date is None or o.last_modified <= end_date)))
+            predicates.append(lambda o: ((start_date is None or start_date <= o['LastModified']) and
+                                         (end_date is None or o['LastModified'] <= end_date)))
 
         if content_filter:
-            predicates.append(lambda o: content_filter(o.get()["Body"].read()))
+            predicates.append(lambda o: content_filter(self.get_string(o['Key'])))
 
         if random_results:
-            s3_objects = list(self._bucket.objects.filter(Prefix=prefix))
+            s3_objects = list(self._iter_objects(prefix, start_after, delimiter))
             shuffle(s3_objects)
             s3_objects_iter = iter(s3_objects)
         else:
-            s3_objects_iter = self._bucket.objects.filter(Prefix=prefix)
+            s3_objects_iter = self._iter_objects(prefix, start_after, delimiter)
 
         count = 0
         for s3_object in s3_objects_iter:
@@ -136,12 +421,61 @@ class S3BasicFacade(object):
             is_relevant = reduce(lambda carry, current: carry and current(s3_object), predicates, True)
             if is_relevant:
                 count += 1
-                yield s3_object.key
+                yield s3_object['Key']
+
+    def _iter_objects(self, prefix=None, start_after=None, delimiter=None):
+        """
+        Lists the objects under the given prefix page by page
+        :param prefix: Optional prefix of listed keys
+        :type prefix: str
+        :param start_after: Optional key to start listing after (exclusive)
+        :type start_after: str
+        :param delimiter: Optional delimiter, when given only the objects directly under the prefix are listed
+        :type delimiter: str
+        :return: Iterator of listed objects description (containing 'Key' and 'LastModified')
+        :rtype: Iterator[dict]
+        """
+        params = dict(Bucket=self.bucket, Prefix=prefix or '')
+        if start_after:
+            params['StartAfter'] = start_after
+        if delimiter:
+            params['Delimiter'] = delimiter
+
+        while True:
+            response = self._call_with_retries('list', self.client.list_objects_v2, **params)
+            for s3_object in response.get('Contents', []):
+                yield s3_object
+
+            if not response.get('IsTruncated'):
+                break
+            params.pop('StartAfter', None)
+            params['ContinuationToken'] = response['NextContinuationToken']
 
     def delete_by_prefix(self, prefix):
         """
         Deletes all the keys that start with the given prefix in the S3 store.
 
         :type prefix: str
+        :return: Responses of the delete requests
+        :rtype: list[dict]
+        """
+        responses = []
+        keys = []
+        for s3_object in self._iter_objects(prefix):
+            keys.append(s3_object['Key'])
+            if len(keys) == _DELETE_BATCH_SIZE:
+                responses.append(self._delete_keys(keys))
+                keys = []
+        if keys:
+            responses.append(self._delete_keys(keys))
+        return responses
+
+    def _delete_keys(self, keys):
+        """
+        :param keys: S3 keys to delete (up to 1000)
+        :type keys: list[str]
+        :return: Response of the delete request
+        :rtype: dict
         """
-        return self._bucket.objects.filter(Prefix=prefix).delete()
+        return self._call_with_retries('delete', self.client.delete_objects, Bucket=self.bucket,
+                                       Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
@@ -0,0 +1,74 @@
+import random
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+
+class RetryPolicy(object):
+    """
+    Retry policy of S3 requests using exponential backoff with full jitter
+    """
+    RETRYABLE_ERROR_CODES = frozenset([
+        'InternalError', 'ServiceUnavailable', 'SlowDown', 'RequestTimeout', 'RequestTimeTooSkewed', 'Throttling',
+        'ThrottlingException', 'RequestLimitExceeded', 'BandwidthLimitExceeded',
+    ])
+
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=5.0):
+        """
+        :param max_attempts: Maximal number of attempts of a single request (including the first one)
+        :type max_attempts: int
+        :param base_delay: Base delay in seconds of the exponential backoff
+        :type base_delay: float
+        :param max_delay: Maximal delay in seconds between attempts
+        :type max_delay: float
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, exception):
+        """
+        :param exception: Exception raised by a request
+        :type exception: Exception
+        :return: Whether the request that raised the given exception should be retried
+        :rtype: bool
+        """
+        if isinstance(exception, (BotoConnectionError, HTTPClientError)):
+            return True
+
+        if isinstance(exception, ClientError):
+            error = exception.response.get('Error', {})
+            status_code = exception.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+            return error.get('Code') in self.RETRYABLE_ERROR_CODES or status_code >= 500
+
+        return False
+
+    def backoff_delay(self, attempt):
+        """
+        :param attempt: Number of the attempt that failed (starting from 1)
+        :type attempt: int
+        :return: Delay in seconds before the next attempt
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class HedgingPolicy(object):
+    """
+    Policy of hedged GET requests, when a request takes longer than a latency percentile of previous requests a second
+    identical request is sent and whichever completes first is used
+    """
+    def __init__(self, latency_percentile=95, min_samples=20, min_delay=0.05, samples_window=1000):
+        """
+        :param latency_percentile: Latency percentile of previous requests after which a hedged request is sent
+        :type latency_percentile: float
+        :param min_samples: Minimal number of latency samples before requests are hedged
+        :type min_samples: int
+        :param min_delay: Minimal delay in seconds before sending a hedged request
+        :type min_delay: float
+        :param samples_window: Number of most recent latency samples to calculate the percentile from
+        :type samples_window: int
+        """
+        self.latency_percentile = latency_percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.samples_window = samples_window
@@ -8,26 +8,37 @@ import uuid
 from datetime import datetime, timedelta
 import json
 from jsonpickle import encode, decode
+import six
 from parse import compile  # pylint: disable=redefined-builtin
+from six.moves.urllib.parse import quote  # pylint: disable=import-error
 
 from playback.exceptions import NoSuchRecording
-from playback.recordings.factory import get_recording_class
+from playback.recordings.factory import detect_recording_class
 from playback.tape_cassette import TapeCassette
 from playback.recordings.memory.memory_recording import MemoryRecording
 from playback.tape_cassettes.s3.s3_basic_facade import S3BasicFacade
+from playback.utils.concurrency import BackgroundCall
 
 _logger = logging.getLogger(__name__)
 
+_MISSING = object()
+
 
 class S3TapeCassette(TapeCassette):
+    # pylint: disable=too-many-instance-attributes
 
     FULL_KEY = 'tape_recorder_recordings/{key_prefix}full/{id}'
     METADATA_KEY = 'tape_recorder_recordings/{key_prefix}metadata/{id}'
     RECORDING_ID = '{category}/{day}/{id}'
     DAY_FORMAT = '%Y%m%d'
-
-    def __init__(self, bucket, key_prefix='', region=None, transient=False, read_only=True,
-                 infrequent_access_kb_threshold=None, sampling_calculator=None, recording_type=MemoryRecording):
+    HOUR_FORMAT = '%H'
+    INDEXED_FIELD_SEGMENT = '{field}={value}'
+
+    def __init__(self, bucket, key_prefix='', region=None, transient=False,  # pylint: disable=too-many-arguments
+                 read_only=True, infrequent_access_kb_threshold=None, sampling_calculator=None,
+                 recording_type=MemoryRecording, estimate_sampling_size=False, indexed_metadata_fields=None,
+                 partition_by_hour=False, retry_policy=None, hedging_policy=None,
+                 max_pool_connections=None):
         """
         :param bucket: Cassette s3 storage bucket
         :type bucket: str
@@ -48,6 +59,29 @@ class S3TapeCassette(TapeCassette):
         function will be triggered with (category, recording_size, recording),
         and the function should return a number between 0 and 1 which specify its sampling rate
         :type sampling_calculator: function
+        :param recording_type: Recording class used to create new recordings
+        :type recording_type: type
+        :param estimate_sampling_size: If True, the sampling calculator is given a cheap estimate of the uncompressed
+        recording size (when the recording type supports it) instead of the exact compressed size, this spares the
+        encoding and compression of recordings that are discarded by the sampling
+        :type estimate_sampling_size: bool
+        :param indexed_metadata_fields: Optional ordered metadata fields that become part of the recording id
+        (e.g 'category/20261017/tenant=acme/...'), the id is finalized when the recording is saved (see
+        TapeCassette.save_recording which returns the final id). Equality and list
+        filters on these fields are served by listing only the matching key prefixes instead of filtering the content
+        of every recording of the day
+        :type indexed_metadata_fields: list of str
+        :param partition_by_hour: If True, the (UTC) hour the recording was created at becomes part of its id after
+        the day (e.g 'category/20261017/14/...'), allowing searches to skip hours outside the searched dates.
+        Recordings saved directly under the day before the layout was configured are still found by these searches
+        :type partition_by_hour: bool
+        :param retry_policy: Optional retry policy of S3 requests
+        :type retry_policy: playback.tape_cassettes.s3.s3_request_policies.RetryPolicy
+        :param hedging_policy: Optional hedging policy of S3 get requests
+        :type hedging_policy: playback.tape_cassettes.s3.s3_request_policies.HedgingPolicy
+        :param max_pool_connections: Optional maximal number of connections kept in the S3 client connection pool,
+        None means boto default (10)
+        :type max_pool_connections: int
         """
         _logger.info(u'Creating S3TapeCassette using bucket {}'.format(bucket))
         self.bucket = bucket
@@ -60,8 +94,12 @@ class S3TapeCassette(TapeCassette):
         self._random = Random(110613)
         self._metadata_key_parser = compile(self.METADATA_KEY)
         self._recording_id_parser = compile(self.RECORDING_ID)
-        self._s3_facade = S3BasicFacade(self.bucket, region=region)
+        self._s3_facade = S3BasicFacade(self.bucket, region=region, retry_policy=retry_policy,
+                                        hedging_policy=hedging_policy, max_pool_connections=max_pool_connections)
         self._recording_type = recording_type
+        self.estimate_sampling_size = estimate_sampling_size
+        self.indexed_metadata_fields = list(indexed_metadata_fields or [])
+        self.partition_by_hour = partition_by_hour
 
     def get_recording(self, recording_id):
         """
@@ -72,12 +110,20 @@ class S3TapeCassette(TapeCassette):
         :rtype: playback.recording.Recording
         """
         full_key = self.FULL_KEY.format(key_prefix=self.key_prefix, id=recording_id)
-        metadata = self.get_recording_metadata(recording_id)
 
-        recording_class = get_recording_class(metadata)
+        # Recordings that embed their metadata are restored from the full recording data in a single round trip,
+        # otherwise the metadata is fetched concurrently with the full recording data
+        metadata_call = None
+        if not self._recording_type.EMBEDS_METADATA:
+            metadata_call = BackgroundCall(self.get_recording_metadata, recording_id)
 
         try:
             with self._s3_facade.get_buffered_reader(full_key) as buffered_reader:
+                recording_class = detect_recording_class(buffered_reader)
+                metadata = None
+                if not recording_class.EMBEDS_METADATA:
+                    metadata = metadata_call.result() if metadata_call is not None \
+                        else self.get_recording_metadata(recording_id)
                 return recording_class.from_buffered_reader(recording_id, buffered_reader, metadata)
         except Exception as ex:
             if 'NoSuchKey' in type(ex).__name__:
@@ -113,10 +159,18 @@ class S3TapeCassette(TapeCassette):
         """
         self._assert_not_read_only()
 
+        if self.partition_by_hour:
+            # The partitioned layout is always in UTC so it can be pruned by the (UTC) searched dates
+            now = datetime.utcnow()
+            unique_id = '{}/{}'.format(now.strftime(self.HOUR_FORMAT), uuid.uuid1().hex)
+        else:
+            now = datetime.today()
+            unique_id = uuid.uuid1().hex
+
         _id = self.RECORDING_ID.format(
             category=category,
-            day=datetime.today().strftime(self.DAY_FORMAT),
-            id=uuid.uuid1().hex
+            day=now.strftime(self.DAY_FORMAT),
+            id=unique_id
         )
         logging.info(u'Creating a new recording with id {}'.format(_id))
         return self._recording_type.new(_id)
@@ -138,25 +192,37 @@ class S3TapeCassette(TapeCassette):
         full_key = self.FULL_KEY.format(key_prefix=self.key_prefix, id=recording.id)
         metadata_key = self.METADATA_KEY.format(key_prefix=self.key_prefix, id=recording.id)
 
-        # We break into two keys so we can do faster and cheap filtering based on metadata not requiring to fetch the
-        # entire recording data
-        _logger.debug(u"Saving recording metadata at bucket {} under key {}".format(self.bucket, metadata_key))
-        self._s3_facade.put_string(metadata_key, encode(recording.recording_metadata, unpicklable=True))
+        # Sampling is decided before anything is written, when possible using a cheap size estimation in order not to
+        # encode and compress recordings that are going to be discarded
+        sampled = None
+        if self.estimate_sampling_size and self.sampling_calculator is not None:
+            estimated_size = recording.estimate_size()
+            if estimated_size is not None:
+                sampled = self._should_sample(recording, estimated_size)
+                if not sampled:
+                    self._log_discarded_recording(recording)
+                    return
 
         with recording.as_buffered_reader() as (buffered_reader, recording_size):
-            if not self._should_sample(recording, recording_size):
-                logging.info(u'Recording with id {} is not chosen to be sampled and is being discarded'.format(
-                    recording.id))
+            if sampled is None and not self._should_sample(recording, recording_size):
+                self._log_discarded_recording(recording)
                 return
 
             storage_class = self._calculate_storage_class(recording_size)
 
+            # We break into two keys so we can do faster and cheap filtering based on metadata not requiring to fetch
+            # the entire recording data, both are uploaded concurrently
+            _logger.debug(u"Saving recording metadata at bucket {} under key {}".format(self.bucket, metadata_key))
+            metadata_upload = BackgroundCall(
+                self._s3_facade.put_string, metadata_key, encode(recording.recording_metadata, unpicklable=True))
+
             _logger.debug(u"Saving recording full data at bucket {} under key {}".format(self.bucket, full_key))
             self._s3_facade.put_buffered_reader(
                 full_key,
                 buffered_reader,
                 StorageClass=storage_class
             )
+            metadata_upload.result()
 
             _logger.info(
                 u"Recording saved at bucket {} under key {} "
@@ -165,6 +231,46 @@ class S3TapeCassette(TapeCassette):
                 )
             )
 
+    def get_final_recording_id(self, recording):
+        """
+        :param recording: Recording that is about to be saved
+        :type recording: playback.recording.Recording
+        :return: Recording id with the indexed metadata fields values placed right before its unique part
+        :rtype: str
+        """
+        if not self.indexed_metadata_fields:
+            return recording.id
+
+        metadata = recording.get_metadata()
+        id_prefix, _, unique_id = recording.id.rpartition('/')
+        segments = [self._format_indexed_field_segment(field, metadata.get(field))
+                    for field in self.indexed_metadata_fields]
+        if id_prefix.split('/')[-len(segments):] == segments:
+            # The id was already finalized (e.g by a wrapping cassette)
+            return recording.id
+        return '/'.join([id_prefix] + segments + [unique_id])
+
+    def _format_indexed_field_segment(self, field, value):
+        """
+        :param field: Indexed metadata field
+        :type field: str
+        :param value: Metadata value of the field
+        :type value: Any
+        :return: Recording id segment representing the given field value
+        :rtype: str
+        """
+        if not isinstance(value, six.string_types):
+            value = json.dumps(value, sort_keys=True)
+        return self.INDEXED_FIELD_SEGMENT.format(field=quote(field, safe=''), value=quote(value, safe=''))
+
+    @staticmethod
+    def _log_discarded_recording(recording):
+        """
+        :param recording: Recording that was not chosen to be sampled
+        :type recording: playback.recording.Recording
+        """
+        _logger.info(u'Recording with id {} is not chosen to be sampled and is being discarded'.format(recording.id))
+
     def _calculate_storage_class(self, recording_size):
         """
         :param recording_size: Length of compressed recording full data
@@ -198,8 +304,9 @@ class S3TapeCassette(TapeCassette):
 
         return self._random.random() <= ratio
 
-    def create_id_prefix_iterators(self, id_prefixes, start_date=None, end_date=None, content_filter=None, limit=None,
-                                   random_results=False):
+    def create_id_prefix_iterators(  # pylint: disable=too-many-arguments
+            self, id_prefixes, start_date=None, end_date=None, content_filter=None, limit=None, random_results=False,
+            start_after_keys=None, delimiter=None):
         """
         Creates a list of iterators for every day in case of using dates or for category otherwise.
         :param id_prefixes: list of prefixes to use
@@ -214,9 +321,16 @@ class S3TapeCassette(TapeCassette):
         :type limit: int
         :param random_results: True to return result in random order
         :type random_results: bool
+        :param start_after_keys: Optional key to start listing after for each of the prefixes (None to list from the
+        start of the prefix)
+        :type start_after_keys: list of basestring
+        :param delimiter: Optional delimiter to list all the prefixes with (e.g. '/' to list only the keys directly
+        under them), None means each prefix is listed according to the layout
+        :type delimiter: str
         :return: list of Iterator of keys matching the given parameters
         :rtype: list of collections.Iterator[basestring]
         """
+        start_after_keys = start_after_keys or [None] * len(id_prefixes)
         return [self._s3_facade.iter_keys(
             prefix=self.METADATA_KEY.format(
                 key_prefix=self.key_prefix, id=id_prefix
@@ -225,7 +339,27 @@ class S3TapeCassette(TapeCassette):
             end_date=end_date,
             content_filter=content_filter,
             limit=copy(limit),
-            random_results=random_results) for id_prefix in id_prefixes]
+            random_results=random_results,
+            start_after=start_after,
+            delimiter=delimiter or self._get_listing_delimiter(id_prefix))
+            for id_prefix, start_after in zip(id_prefixes, start_after_keys)]
+
+    def _get_listing_delimiter(self, id_prefix):
+        """
+        With the partitioned layout the recordings of a day are listed by hour, and the day prefix itself is listed
+        only for the recordings that were saved directly under the day before the layout was configured
+        :param id_prefix: Listed id prefix
+        :type id_prefix: str
+        :return: Delimiter to list the given prefix with, None to list all the keys under it
+        :rtype: str
+        """
+        if not self.partition_by_hour:
+            return None
+        try:
+            datetime.strptime(id_prefix.rstrip('/').rsplit('/', 1)[-1], self.DAY_FORMAT)
+        except ValueError:
+            return None
+        return '/'
 
     @staticmethod
     def _create_content_filter_func(metadata):
@@ -258,13 +392,91 @@ class S3TapeCassette(TapeCassette):
         # and when a start date is given we can look for specific folders until today (or end_time)
         if start_date:
             end_date = end_date or datetime.utcnow()
-            days = [(start_date + timedelta(days=i)) for i in range((end_date - start_date).days + 1)]
+            days = [(start_date + timedelta(days=i)) for i in range((end_date.date() - start_date.date()).days + 1)]
             id_prefixes = ['{}/{}/'.format(category, day.strftime(self.DAY_FORMAT)) for day in days]
         else:
             id_prefixes = ['{}/'.format(category)]
 
         return id_prefixes
 
+    def _expand_partitioned_id_prefixes(self, day_prefixes, start_date, end_date, metadata):
+        """
+        Narrows down the given day prefixes using the partitioned layout, adding the hours within the searched dates
+        and the values of indexed metadata fields that are filtered by exact values. With hour partitioning the day
+        prefix is kept as well, for recordings saved directly under the day before the layout was configured.
+        When narrowed down by indexed fields, the day (and hour) prefixes are kept as well, after the narrowed ones, for
+        recordings saved directly under them before the indexed fields were configured. These unindexed prefixes
+        should only be listed for the keys directly under them, filtered by all the metadata values.
+        :param day_prefixes: Id prefix of each searched day
+        :type day_prefixes: list of str
+        :param start_date: Recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :return: Narrowed down id prefixes, the remaining metadata values that are not covered by the prefixes and the
+        unindexed prefixes among them
+        :rtype: (list of str, dict, list of str)
+        """
+        id_prefixes = day_prefixes
+        if self.partition_by_hour:
+            end_date = end_date or datetime.utcnow()
+            id_prefixes = []
+            for day_prefix in day_prefixes:
+                id_prefixes.append(day_prefix)
+                day = datetime.strptime(day_prefix.rstrip('/').rsplit('/', 1)[-1], self.DAY_FORMAT)
+                for hour in range(24):
+                    hour_start = day + timedelta(hours=hour)
+                    if hour_start + timedelta(hours=1) <= start_date or hour_start > end_date:
+                        continue
+                    id_prefixes.append('{}{}/'.format(day_prefix, hour_start.strftime(self.HOUR_FORMAT)))
+
+        if not self.indexed_metadata_fields or not metadata:
+            return id_prefixes, metadata, []
+
+        unindexed_prefixes = id_prefixes
+        remaining_metadata = dict(metadata)
+        for field in self.indexed_metadata_fields:
+            segments = self._get_indexed_field_filter_segments(field, metadata.get(field, _MISSING))
+            if segments is None:
+                # Fields are nested by their order, a field that cannot be used as a prefix blocks all following ones
+                break
+            id_prefixes = ['{}{}/'.format(id_prefix, segment) for id_prefix in id_prefixes for segment in segments]
+            remaining_metadata.pop(field)
+
+        if len(remaining_metadata) == len(metadata):
+            return id_prefixes, metadata, []
+        return id_prefixes + unindexed_prefixes, remaining_metadata, unindexed_prefixes
+
+    def _get_indexed_field_filter_segments(self, field, match_value):
+        """
+        :param field: Indexed metadata field
+        :type field: str
+        :param match_value: Metadata filter value of the field
+        :type match_value: Any
+        :return: All recording id segments matching the filter value, None if the filter cannot be expressed by
+        exact segments (e.g wildcards and range operators)
+        :rtype: list of str
+        """
+        if match_value is _MISSING:
+            return None
+
+        segments = []
+        for value in match_value if isinstance(match_value, list) else [match_value]:
+            if isinstance(value, dict):
+                if value.get('operator') != '=' or 'value' not in value:
+                    return None
+                value = value['value']
+            if isinstance(value, six.string_types):
+                if any(wildcard in value for wildcard in '*?['):
+                    return None
+            elif value is not None and not isinstance(value, (bool, float) + six.integer_types):
+                return None
+            segments.append(self._format_indexed_field_segment(field, value))
+
+        return segments
+
     def _get_days_iterators(self, category, start_date=None, end_date=None, metadata=None, limit=None,
                             random_results=False):
         """
@@ -284,11 +496,88 @@ class S3TapeCassette(TapeCassette):
         :return: List of days iterators
         :rtype: list
         """
-        content_filter = self._create_content_filter_func(metadata) if metadata else None
+        id_prefixes, remaining_metadata, unindexed_prefixes = self._get_search_id_prefixes(
+            category, start_date, end_date, metadata)
+        return self._create_search_iterators([[id_prefix, None] for id_prefix in id_prefixes], start_date, end_date,
+                                             metadata, remaining_metadata, unindexed_prefixes, limit, random_results)
 
+    def _create_search_iterators(self, positions, start_date, end_date,  # pylint: disable=too-many-arguments
+                                 metadata, remaining_metadata, unindexed_prefixes, limit=None, random_results=False):
+        """
+        :param positions: Listing position (id prefix and last listed key, None to list from its start) of each
+        searched prefix
+        :type positions: list of list
+        :param start_date: Optional recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :param remaining_metadata: The metadata values that are not covered by the narrowed down prefixes
+        :type remaining_metadata: dict
+        :param unindexed_prefixes: Prefixes that are not narrowed down by indexed fields, of which only the keys
+        directly under them are listed, filtered by all the metadata values
+        :type unindexed_prefixes: list of str
+        :param limit: Optional limit on number of ids to fetch
+        :type limit: int
+        :param random_results: True to return result in random order
+        :type random_results: bool
+        :return: Iterator of keys of each of the given positions
+        :rtype: list of collections.Iterator[basestring]
+        """
+        iterators = []
+        for id_prefix, start_after in positions:
+            unindexed = id_prefix in unindexed_prefixes
+            filter_metadata = metadata if unindexed else remaining_metadata
+            iterators.extend(self.create_id_prefix_iterators(
+                [id_prefix], start_date, end_date,
+                self._create_content_filter_func(filter_metadata) if filter_metadata else None, limit, random_results,
+                start_after_keys=[start_after], delimiter='/' if unindexed else None))
+        return iterators
+
+    def _get_search_id_prefixes(self, category, start_date=None, end_date=None, metadata=None):
+        """
+        :param category: Recordings category
+        :type category: basestring
+        :param start_date: Optional recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :return: Id prefixes to list, the remaining metadata values that are not covered by the prefixes and the
+        unindexed prefixes among them, see _expand_partitioned_id_prefixes
+        :rtype: (list of str, dict, list of str)
+        """
         id_prefixes = self._get_id_prefixes(category, start_date, end_date)
+        if start_date:
+            return self._expand_partitioned_id_prefixes(id_prefixes, start_date, end_date, metadata)
+        return id_prefixes, metadata, []
 
-        return self.create_id_prefix_iterators(id_prefixes, start_date, end_date, content_filter, limit, random_results)
+    @staticmethod
+    def _round_robin_keys(iterators, random_results=False, iter_index=0):
+        """
+        Interleaves the keys of the given iterators, exhausted iterators are removed from the given list
+        :param iterators: Key iterators to interleave
+        :type iterators: list of collections.Iterator[basestring]
+        :param random_results: True to pick the iterator of each key randomly
+        :type random_results: bool
+        :param iter_index: Round robin position to start from
+        :type iter_index: int
+        :return: Iterator of the iterator each key was taken from, the key and the next round robin position
+        :rtype: collections.Iterator[(collections.Iterator[basestring], basestring, int)]
+        """
+        while iterators:
+            if random_results:
+                current_iterator = random.choice(iterators)
+            else:
+                current_iterator = iterators[iter_index % len(iterators)]
+                iter_index += 1
+            key = next(current_iterator, None)
+            if key:
+                yield current_iterator, key, iter_index
+            else:
+                iterators.remove(current_iterator)
 
     def iter_recording_ids(self, category, start_date=None, end_date=None, metadata=None, limit=None,
                            random_results=False):
@@ -310,25 +599,114 @@ class S3TapeCassette(TapeCassette):
         :rtype: collections.Iterator[basestring]
         """
 
+        if limit == 0:
+            return
+
         days_iterators = self._get_days_iterators(category, start_date, end_date, metadata, limit, random_results)
 
         count = 0
-        iter_index = 0
-        while count != limit and days_iterators:
-            if random_results:
-                random_day_iterator = random.choice(days_iterators)
-            else:
-                random_day_iterator = days_iterators[iter_index % len(days_iterators)]
-                iter_index += 1
-            key = next(random_day_iterator, None)
-            if key:
-                result = self._metadata_key_parser.parse(key)
-                recording_id = result.named['id']
-                _logger.info(u'Found filtered recording id {}'.format(recording_id))
-                yield recording_id
-                count += 1
-            else:
-                days_iterators.remove(random_day_iterator)
+        for _, key, _ in self._round_robin_keys(days_iterators, random_results):
+            yield self._parse_found_recording_id(key)
+            count += 1
+            if count == limit:
+                break
+
+    def get_recording_ids_page(self, category, start_date=None, end_date=None, metadata=None, page_size=100,
+                               cursor=None):
+        """
+        Fetches a page of recording ids matching the given search parameters, the search can be continued from the
+        returned cursor, which holds the listing position of each searched day
+        :param category: Recordings category
+        :type category: basestring
+        :param start_date: Optional recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :param page_size: Maximal number of ids in the page
+        :type page_size: int
+        :param cursor: Cursor returned by the previous page of the same search, None to start the search
+        :type cursor: str
+        :return: Page of recording ids and the cursor of the next page, None if there are no more results
+        :rtype: (list of str, str)
+        """
+        iterators, iterator_positions, iter_index = self._create_page_iterators(
+            category, start_date, end_date, metadata, cursor)
+
+        recording_ids = []
+        if page_size > 0:
+            for iterator, key, iter_index in self._round_robin_keys(iterators, iter_index=iter_index):
+                iterator_positions[iterator][1] = key
+                recording_ids.append(self._parse_found_recording_id(key))
+                if len(recording_ids) == page_size:
+                    break
+
+        # Exhausted iterators were removed by the round robin
+        return recording_ids, self._encode_search_cursor(
+            [iterator_positions[iterator] for iterator in iterators], iter_index)
+
+    def _create_page_iterators(self, category, start_date, end_date, metadata, cursor):
+        """
+        :param category: Recordings category
+        :type category: basestring
+        :param start_date: Optional recording start date (need to be given in utc time)
+        :type start_date: datetime.datetime
+        :param end_date: Optional recording end date (need to be given in utc time)
+        :type end_date: datetime.datetime
+        :param metadata: Optional metadata values to filter by
+        :type metadata: dict
+        :param cursor: Cursor returned by the previous page of the search, None to start the search
+        :type cursor: str
+        :return: Key iterator of each searched prefix that is not exhausted, the listing position of each iterator and
+        the round robin position
+        :rtype: (list of collections.Iterator[basestring], dict, int)
+        """
+        id_prefixes, remaining_metadata, unindexed_prefixes = self._get_search_id_prefixes(
+            category, start_date, end_date, metadata)
+        positions, iter_index = self._decode_search_cursor(cursor, id_prefixes)
+        iterators = self._create_search_iterators(positions, start_date, end_date, metadata, remaining_metadata,
+                                                  unindexed_prefixes)
+        return iterators, dict(zip(iterators, positions)), iter_index
+
+    def _decode_search_cursor(self, cursor, id_prefixes):
+        """
+        :param cursor: Cursor returned by the previous page of the search, None to start the search
+        :type cursor: str
+        :param id_prefixes: Id prefixes of the search, used when starting the search
+        :type id_prefixes: list of str
+        :return: Listing position (id prefix and last listed key) of each searched prefix and the round robin position
+        :rtype: (list of list, int)
+        """
+        if not cursor:
+            return [[id_prefix, None] for id_prefix in id_prefixes], 0
+        state = self._decode_cursor(cursor)
+        # The searched prefixes are taken from the cursor, so days ending with "now" stay stable across pages
+        return state['positions'], state['index']
+
+    def _encode_search_cursor(self, positions, iter_index):
+        """
+        :param positions: Listing position (id prefix and last listed key) of each prefix that is not exhausted
+        :type positions: list of list
+        :param iter_index: Round robin position
+        :type iter_index: int
+        :return: Cursor of the next page, None if all prefixes are exhausted
+        :rtype: str
+        """
+        if not positions:
+            return None
+        return self._encode_cursor({'positions': positions, 'index': iter_index})
+
+    def _parse_found_recording_id(self, key):
+        """
+        :param key: Found metadata key
+        :type key: basestring
+        :return: Recording id of the metadata key
+        :rtype: basestring
+        """
+        recording_id = self._metadata_key_parser.parse(key).named['id']
+        _logger.info(u'Found filtered recording id {}'.format(recording_id))
+        return recording_id
 
     def extract_recording_category(self, recording_id):
         """
@@ -0,0 +1,45 @@
+import sys
+from threading import Thread
+
+import six
+
+
+class BackgroundCall(object):
+    """
+    Runs a function in a dedicated daemon thread and gives access to its outcome once completed
+    """
+    def __init__(self, func, *args, **kwargs):
+        """
+        :param func: Function to run in the background
+        :type func: function
+        """
+        self._result = None
+        self._exc_info = None
+        self._thread = Thread(target=self._run, args=(func, args, kwargs), name='BackgroundCall Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException:  # pylint: disable=broad-except
+            self._exc_info = sys.exc_info()
+
+    def done(self):
+        """
+        :return: Whether the call has completed
+        :rtype: bool
+        """
+        return not self._thread.is_alive()
+
+    def result(self):
+        """
+        Blocks until the call is completed
+        :return: The value returned by the called function
+        :rtype: Any
+        :raises: Any exception raised by the called function
+        """
+        self._thread.join()
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._result
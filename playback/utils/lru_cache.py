@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class SizeBoundedLRUCache(object):
+    """
+    Thread safe in memory cache bounded by the total size of its values, evicting the least recently used values first
+    """
+    def __init__(self, max_bytes, max_entries=None):
+        """
+        :param max_bytes: Maximal total size in bytes of the cached values
+        :type max_bytes: int
+        :param max_entries: Optional maximal number of cached values
+        :type max_entries: int
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._total_bytes = 0
+        self._lock = Lock()
+
+    @property
+    def total_bytes(self):
+        """
+        :return: Total size in bytes of the cached values
+        :rtype: int
+        """
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        :param key: Cache key
+        :type key: collections.Hashable
+        :param default: Value to return when the key is not cached
+        :type default: Any
+        :return: The cached value of the given key, default if it is not cached
+        :rtype: Any
+        """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            # Reinsert to mark as most recently used
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        """
+        Caches a value, evicting least recently used values if the cache exceeds its budget. A value that is larger
+        than the whole cache budget is not cached
+        :param key: Cache key
+        :type key: collections.Hashable
+        :param value: Value to cache
+        :type value: Any
+        :param size: Size of the value in bytes
+        :type size: int
+        :return: Whether the value was cached
+        :rtype: bool
+        """
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return False
+
+            self._items[key] = (value, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes or \
+                    (self.max_entries is not None and len(self._items) > self.max_entries):
+                self._remove(next(iter(self._items)))
+            return True
+
+    def remove(self, key):
+        """
+        :param key: Cache key to remove from the cache
+        :type key: collections.Hashable
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """
+        Removes all the cached values
+        """
+        with self._lock:
+            self._items.clear()
+            self._total_bytes = 0
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._total_bytes -= item[1]
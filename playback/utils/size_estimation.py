@@ -0,0 +1,48 @@
+import six
+
+# Rough per item overhead of the serialized form (delimiters, quotes, type hints)
+_ITEM_OVERHEAD = 2
+_SCALAR_SIZE = 8
+
+
+def estimate_size(value):
+    """
+    Cheaply estimates the serialized size of a value by walking it, without actually serializing it.
+    The estimate is of the uncompressed size and is meant for decisions that do not require an exact size.
+    :param value: Value to estimate
+    :type value: Any
+    :return: Estimated size in bytes
+    :rtype: int
+    """
+    size = 0
+    visited = set()
+    pending = [value]
+    while pending:
+        current = pending.pop()
+        if current is None or isinstance(current, (bool, float) + six.integer_types):
+            size += _SCALAR_SIZE
+            continue
+
+        if isinstance(current, (six.binary_type, six.text_type)):
+            size += len(current) + _ITEM_OVERHEAD
+            continue
+
+        # Protect against cycles and count shared objects once
+        if id(current) in visited:
+            continue
+        visited.add(id(current))
+
+        if isinstance(current, dict):
+            size += _ITEM_OVERHEAD * (len(current) + 1)
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            size += _ITEM_OVERHEAD * (len(current) + 1)
+            pending.extend(current)
+        elif hasattr(current, '__dict__'):
+            size += len(type(current).__name__) + _ITEM_OVERHEAD
+            pending.append(vars(current))
+        else:
+            size += _SCALAR_SIZE
+
+    return size
@@ -72,4 +72,9 @@ setuptools.setup(
     package_data={
         "playback": ["py.typed"]
     },
+    entry_points={
+        'console_scripts': [
+            'playback-warm-up-cache=playback.studio.cache_warmup:main',
+        ],
+    },
 )
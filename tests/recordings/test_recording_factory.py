@@ -1,6 +1,9 @@
 import unittest
 
-from playback.recordings.factory import get_recording_class
+import io
+from zlib import compress
+
+from playback.recordings.factory import get_recording_class, detect_recording_class
 from playback.recordings.memory.memory_recording import MemoryRecording
 from playback.recordings.sqlite.sqlite_recording import SqliteRecording
 
@@ -15,3 +18,15 @@ class TestSqliteRecording(unittest.TestCase):
             self.fail("An exception should be raised")
         except Exception as e:
             self.assertEqual(str(e), "Unsupported recording type unknown")
+
+    def test_detect_recording_class(self):
+        recording = SqliteRecording.new()
+        with recording.as_buffered_reader() as (buffered_reader, _):
+            self.assertEqual(detect_recording_class(buffered_reader), SqliteRecording)
+            # Detection must not consume the reader
+            self.assertEqual(buffered_reader.read(len(SqliteRecording.FILE_HEADER)), SqliteRecording.FILE_HEADER)
+
+        with MemoryRecording.new().as_buffered_reader() as (buffered_reader, _):
+            self.assertEqual(detect_recording_class(buffered_reader), MemoryRecording)
+
+        self.assertEqual(detect_recording_class(io.BufferedReader(io.BytesIO(compress(b'{}')))), MemoryRecording)
@@ -25,6 +25,16 @@ class TestSqliteRecording(unittest.TestCase):
         for k, v in payloads.items():
             self.assertEqual(rec.get_data(k), v)
 
+    def test_set_many(self):
+        rec = SqliteRecording.new()
+        rec.set_data('a', 0)
+        rec.set_many([('a', 1), ('b', [2, 3]), ('c', {'d': 4})])
+
+        self.assertEqual(rec.get_data('a'), 1)
+        self.assertEqual(rec.get_data('b'), [2, 3])
+        self.assertEqual(rec.get_data('c'), {'d': 4})
+        self.assertEqual(sorted(rec.get_all_keys()), ['a', 'b', 'c'])
+
     def test_get_returns_fresh_copy_each_time(self):
         rec = SqliteRecording.new()
         rec.set_data('obj', {'counter': 0})
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import boto3
+from mock import patch
+from moto import mock_s3
+from six import StringIO
+
+from playback.studio.cache_warmup import warm_up_cache, main
+from playback.studio.recordings_lookup import RecordingLookupProperties
+from playback.tape_cassettes.cached.cached_facade import CachedReadOnlyS3TapeCassette, CachedS3BasicFacade
+from playback.tape_cassettes.s3.s3_basic_facade import S3BasicFacade
+from playback.tape_cassettes.s3.s3_tape_cassette import S3TapeCassette
+
+TEST_BUCKET = 'test_bucket'
+
+
+@mock_s3
+class TestCacheWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket=TEST_BUCKET)
+        self.cache_path = tempfile.mkdtemp()
+        writer = S3TapeCassette(TEST_BUCKET, key_prefix='test', read_only=False)
+        self.recording_ids = []
+        for i in range(5):
+            recording = writer.create_new_recording('operation')
+            recording.set_data('key', i)
+            writer.save_recording(recording)
+            self.recording_ids.append(recording.id)
+        self.lookup_properties = RecordingLookupProperties(start_date=datetime.utcnow() - timedelta(days=1))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def create_cassette(self, **kwargs):
+        return CachedReadOnlyS3TapeCassette(TEST_BUCKET, key_prefix='test', local_path=self.cache_path, **kwargs)
+
+    def test_warm_up_cache(self):
+        progress_calls = []
+        progress = warm_up_cache(self.create_cassette(), 'operation', self.lookup_properties, concurrency=3,
+                                 progress_callback=lambda p: progress_calls.append(p.completed))
+
+        self.assertEqual(5, progress.total)
+        self.assertEqual(5, progress.completed)
+        self.assertEqual(0, progress.failed)
+        self.assertEqual(10, progress.cached_files)
+        self.assertGreater(progress.cached_bytes, 0)
+        self.assertEqual([1, 2, 3, 4, 5], sorted(progress_calls))
+
+        # Playback runs from the local cache without accessing S3
+        cassette = self.create_cassette()
+        with patch.object(S3BasicFacade, 'get_string', side_effect=AssertionError), \
+                patch.object(S3BasicFacade, 'get_buffered_reader', side_effect=AssertionError):
+            for i, recording_id in enumerate(self.recording_ids):
+                self.assertEqual(i, cassette.get_recording(recording_id).get_data('key'))
+                cassette.get_recording_metadata(recording_id)
+
+    def test_warm_up_decoded_cache(self):
+        progress = warm_up_cache(self.create_cassette(decoded_cache=True), 'operation', self.lookup_properties)
+        self.assertEqual(15, progress.cached_files)
+        self.assertEqual(5, len(os.listdir(os.path.join(self.cache_path, CachedS3BasicFacade.DECODED_DIR))))
+
+    def test_warm_up_stops_at_cache_budget(self):
+        progress = warm_up_cache(self.create_cassette(max_cache_entries=4), 'operation', self.lookup_properties,
+                                 concurrency=1)
+        self.assertTrue(progress.budget_reached)
+        self.assertEqual(2, progress.completed)
+
+    def test_warm_up_failures_are_reported(self):
+        cassette = self.create_cassette()
+        with patch.object(CachedReadOnlyS3TapeCassette, 'warm_up_recording', side_effect=IOError):
+            progress = warm_up_cache(cassette, 'operation', self.lookup_properties)
+        self.assertEqual(5, progress.failed)
+        self.assertEqual(0, progress.completed)
+
+    def test_main(self):
+        with patch('sys.stdout', new=StringIO()) as stdout:
+            exit_code = main([TEST_BUCKET, 'operation', '--key-prefix', 'test', '--cache-path', self.cache_path,
+                              '--start-date', (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d'),
+                              '--limit', '3', '--concurrency', '2'])
+        self.assertEqual(0, exit_code)
+        self.assertIn('Done: 3/3 recordings cached (0 failed)', stdout.getvalue())
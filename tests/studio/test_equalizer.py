@@ -965,3 +965,134 @@ class TestEqualizer(unittest.TestCase):
         del comparison[2]
         for c in comparison:
             self.assertEqual(EqualityStatus.Equal, c.comparator_status.equality_status)
+
+    def _record_pooled_operations(self, count, stuck_value=None, exit_value=None):
+        class Operation(object):
+            def __init__(self, value=None, playback=False):
+                self._value = value
+                self._playback = playback
+
+            @property
+            @self.tape_recorder.intercept_input('input')
+            def input(self):
+                return self._value
+
+            @self.tape_recorder.operation()
+            def execute(self):
+                res = self.input
+                if self._playback and res == stuck_value:
+                    sleep(30)
+                if self._playback and res == exit_value:
+                    exit(1)
+                if self._playback:
+                    # Have processes complete out of order
+                    sleep(0.05 * (res % 3))
+                return res
+
+        for i in range(count):
+            Operation(i).execute()
+
+        def playback_function(recording):
+            return Operation(playback=True).execute()
+
+        def player(recording_id):
+            return self.tape_recorder.play(recording_id, playback_function)
+
+        start_date = datetime.utcnow() - timedelta(hours=1)
+        end_date = datetime.utcnow() + timedelta(hours=1)
+        playable_recordings = list(find_matching_recording_ids(
+            self.tape_recorder,
+            category=Operation.__name__,
+            lookup_properties=RecordingLookupProperties(start_date=start_date, end_date=end_date),
+        ))
+        return playable_recordings, player
+
+    @parameterized.expand([("in_order", True),
+                           ("completion_order", False),
+                           ])
+    def test_equalizer_process_pool(self, name, compare_results_in_order):
+        playable_recordings, player = self._record_pooled_operations(20)
+
+        runner = Equalizer(playable_recordings, player, result_extractor=return_value_result_extractor,
+                           comparator=exact_comparator,
+                           compare_execution_config=CompareExecutionConfig(
+                               keep_results_in_comparison=True,
+                               compare_in_dedicated_process=True,
+                               compare_process_recycle_rate=4,
+                               compare_processes=3,
+                               compare_chunk_size=2,
+                               compare_results_in_order=compare_results_in_order,
+                           ))
+
+        with patch.object(Equalizer, '_create_pool_worker', wraps=runner._create_pool_worker) as wrapped:
+            comparison = list(runner.run_comparison())
+
+        # Every process plays up to 4 recordings before it is recycled
+        self.assertGreaterEqual(wrapped.call_count, 5)
+        self.assertEqual(20, len(comparison))
+        if compare_results_in_order:
+            self.assertEqual(playable_recordings, [c.recording_id for c in comparison])
+            self.assertEqual(list(range(20)), [c.expected for c in comparison])
+        else:
+            self.assertEqual(sorted(playable_recordings), sorted(c.recording_id for c in comparison))
+        for c in comparison:
+            self.assertEqual(EqualityStatus.Equal, c.comparator_status.equality_status)
+            self.assertEqual(c.playback.original_recording.id, c.recording_id)
+
+    @parameterized.expand([("timeout", {'stuck_value': 2}),
+                           ("died", {'exit_value': 2}),
+                           ])
+    def test_equalizer_process_pool_failure(self, expected_message, failure):
+        playable_recordings, player = self._record_pooled_operations(10, **failure)
+
+        runner = Equalizer(playable_recordings, player, result_extractor=return_value_result_extractor,
+                           comparator=exact_comparator,
+                           compare_execution_config=CompareExecutionConfig(
+                               keep_results_in_comparison=True,
+                               compare_in_dedicated_process=True,
+                               compare_process_timeout=1,
+                               compare_processes=2,
+                               compare_chunk_size=3,
+                           ))
+
+        start_time = time()
+        comparison = list(runner.run_comparison())
+        duration = time() - start_time
+
+        self.assertLessEqual(duration, 5)
+        self.assertEqual(10, len(comparison))
+        self.assertEqual(playable_recordings, [c.recording_id for c in comparison])
+        self.assertEqual(EqualityStatus.EqualizerFailure, comparison[2].comparator_status.equality_status)
+        self.assertIn(expected_message, comparison[2].comparator_status.message.lower())
+        # The rest of the chunk of the failed process is played by another process
+        del comparison[2]
+        for c in comparison:
+            self.assertEqual(EqualityStatus.Equal, c.comparator_status.equality_status)
+
+    @parameterized.expand([("wait", False),
+                           ("poll", True),
+                           ])
+    def test_equalizer_process_result_wait(self, name, poll):
+        playable_recordings, player = self._record_pooled_operations(6, exit_value=4)
+
+        runner = Equalizer(playable_recordings, player, result_extractor=return_value_result_extractor,
+                           comparator=exact_comparator,
+                           compare_execution_config=CompareExecutionConfig(
+                               keep_results_in_comparison=True,
+                               compare_in_dedicated_process=True,
+                               compare_process_timeout=1,
+                           ))
+
+        if poll:
+            # Python 2 cannot wait on processes and polls them instead
+            with patch('playback.studio.equalizer._wait_for_ready', None):
+                comparison = list(runner.run_comparison())
+        else:
+            comparison = list(runner.run_comparison())
+
+        self.assertEqual(playable_recordings, [c.recording_id for c in comparison])
+        self.assertEqual(EqualityStatus.EqualizerFailure, comparison[4].comparator_status.equality_status)
+        self.assertIn('died', comparison[4].comparator_status.message.lower())
+        del comparison[4]
+        for c in comparison:
+            self.assertEqual(EqualityStatus.Equal, c.comparator_status.equality_status)
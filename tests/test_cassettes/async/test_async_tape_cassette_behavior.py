@@ -1,6 +1,17 @@
+import os
+import shutil
 import unittest
+from tempfile import mkdtemp
+from threading import Event
+from time import sleep, time
 
+from mock import patch
+from six.moves import queue
+
+from playback.tape_cassettes.asynchronous import async_record_only_tape_cassette
 from playback.tape_cassettes.asynchronous.async_record_only_tape_cassette import AsyncRecordOnlyTapeCassette
+from playback.tape_cassettes.asynchronous.operations_queue import OperationsQueue, QueueFullPolicy
+from playback.tape_cassettes.file_based.file_based_tape_cassette import FileBasedTapeCassette
 from tests.mocks.delayed_in_memory_tape_cassette import DelayedInMemoryTapeCassette
 from playback.utils.timing_utils import Timed
 
@@ -72,3 +83,324 @@ class TestAsyncTapeCassette(unittest.TestCase):
         in_memory_cassette = DelayedInMemoryTapeCassette(delay=0.1)
         tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5)
         tape_cassette.close()
+
+    @staticmethod
+    def _create_paused_cassette(in_memory_cassette, **kwargs):
+        """
+        Creates a cassette that accepts recordings while its recording thread is not running yet, so operations pile
+        up in the queue until it is started
+        """
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, **kwargs)
+        tape_cassette._started = True
+        return tape_cassette
+
+    def test_queue_full_drop_newest(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = self._create_paused_cassette(in_memory_cassette, max_queue_items=3,
+                                                     queue_full_policy=QueueFullPolicy.DROP_NEWEST)
+        first_recording = tape_cassette.create_new_recording('category')
+        first_recording.set_data('a', 1)
+        first_recording.set_data('b', 2)
+        tape_cassette.save_recording(first_recording)
+
+        second_recording = tape_cassette.create_new_recording('category')
+        second_recording.set_data('a', 3)
+        second_recording.set_data('b', 4)
+        tape_cassette.save_recording(second_recording)
+
+        tape_cassette.start()
+        tape_cassette.close()
+        self.assertEqual([first_recording.id], in_memory_cassette.get_all_recording_ids())
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+        self.assertEqual(3, tape_cassette.dropped_operations)
+
+    def test_queue_full_drop_oldest(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = self._create_paused_cassette(in_memory_cassette, max_queue_items=2,
+                                                     queue_full_policy=QueueFullPolicy.DROP_OLDEST)
+        first_recording = tape_cassette.create_new_recording('category')
+        first_recording.set_data('a', 1)
+        first_recording.set_data('b', 2)
+
+        second_recording = tape_cassette.create_new_recording('category')
+        second_recording.set_data('a', 3)
+        tape_cassette.save_recording(first_recording)
+        tape_cassette.save_recording(second_recording)
+
+        tape_cassette.start()
+        tape_cassette.close()
+        self.assertEqual([second_recording.id], in_memory_cassette.get_all_recording_ids())
+        self.assertEqual(3, in_memory_cassette.get_recording(second_recording.id).get_data('a'))
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+        self.assertEqual(3, tape_cassette.dropped_operations)
+
+    def test_queue_full_by_bytes_drop_newest(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = self._create_paused_cassette(in_memory_cassette, max_queue_bytes=1000,
+                                                     queue_full_policy=QueueFullPolicy.DROP_NEWEST)
+        first_recording = tape_cassette.create_new_recording('category')
+        first_recording.set_data('a', 'a' * 800)
+        tape_cassette.save_recording(first_recording)
+
+        second_recording = tape_cassette.create_new_recording('category')
+        second_recording.set_data('a', 'a' * 300)
+        tape_cassette.save_recording(second_recording)
+
+        tape_cassette.start()
+        tape_cassette.close()
+        self.assertEqual([first_recording.id], in_memory_cassette.get_all_recording_ids())
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+
+    def test_size_is_not_estimated_without_byte_bounds(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, max_queue_items=100,
+                                                    batch_max_items=10)
+        tape_cassette.start()
+        with patch.object(async_record_only_tape_cassette, 'estimate_size', return_value=0) as estimate_size_mock:
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', 'a' * 800)
+            recording.add_metadata({'b': 1})
+            tape_cassette.save_recording(recording)
+            tape_cassette.close()
+        self.assertEqual(0, estimate_size_mock.call_count)
+        self.assertEqual('a' * 800, in_memory_cassette.get_recording(recording.id).get_data('a'))
+
+        for bounds in ({'max_queue_bytes': 1000}, {'batch_max_bytes': 1000}):
+            tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, **bounds)
+            tape_cassette.start()
+            with patch.object(async_record_only_tape_cassette, 'estimate_size', return_value=0) as estimate_size_mock:
+                recording = tape_cassette.create_new_recording('category')
+                recording.set_data('a', 'a' * 800)
+                tape_cassette.save_recording(recording)
+                tape_cassette.close()
+            self.assertEqual(1, estimate_size_mock.call_count)
+
+    def test_queue_full_drop_oldest_forgets_recordings_that_were_dropped_with_their_save(self):
+        aborted_recordings = []
+        operations_queue = OperationsQueue(aborted_recordings.append, max_items=2,
+                                           full_policy=QueueFullPolicy.DROP_OLDEST)
+        recordings = [object() for _ in range(5)]
+        for recording in recordings:
+            operations_queue.put(lambda: None, recording=recording)
+            operations_queue.put(lambda: None, recording=recording, last=True)
+        while True:
+            try:
+                operation = operations_queue.get_nowait()
+            except queue.Empty:
+                break
+            operation()
+            operations_queue.task_done(operation)
+
+        self.assertEqual(recordings[:4], aborted_recordings)
+        self.assertEqual(set(), operations_queue._dropped_recordings)
+        self.assertEqual(set(), operations_queue._started_recordings)
+        self.assertEqual({}, operations_queue._pending_by_recording)
+
+    def test_queue_full_block_timeout_drops_recording(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = self._create_paused_cassette(in_memory_cassette, max_queue_items=1, queue_block_timeout=0.1)
+        recording = tape_cassette.create_new_recording('category')
+        recording.set_data('a', 1)
+        with Timed() as timed:
+            recording.set_data('b', 2)
+        self.assertGreaterEqual(timed.duration, 0.1)
+        tape_cassette.save_recording(recording)
+
+        tape_cassette.start()
+        tape_cassette.close()
+        self.assertEqual([], in_memory_cassette.get_all_recording_ids())
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+
+    def test_queue_full_block_waits_for_room(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0.05)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, flush_interval=0.01, timeout_on_close=5,
+                                                    max_queue_items=1)
+        tape_cassette.start()
+        recording = tape_cassette.create_new_recording('category')
+        for i in range(3):
+            recording.set_data(str(i), i)
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+
+        saved_recording = in_memory_cassette.get_recording(recording.id)
+        self.assertEqual(2, saved_recording.get_data('2'))
+        self.assertEqual(0, tape_cassette.dropped_recordings)
+
+    def _record_and_measure(self, flush_workers, recordings_count=8):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0.05)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, flush_interval=0.01, timeout_on_close=10,
+                                                    flush_workers=flush_workers)
+        tape_cassette.start()
+        recordings = []
+        with Timed() as timed:
+            for i in range(recordings_count):
+                recording = tape_cassette.create_new_recording('category')
+                recording.set_data('a', i)
+                recording.add_metadata({'b': i})
+                recording.set_data('c', i)
+                tape_cassette.save_recording(recording)
+                recordings.append(recording)
+            tape_cassette.close()
+
+        for i, recording in enumerate(recordings):
+            saved_recording = in_memory_cassette.get_recording(recording.id)
+            self.assertEqual(i, saved_recording.get_data('a'))
+            self.assertEqual(i, saved_recording.get_data('c'))
+            self.assertEqual(i, saved_recording.get_metadata()['b'])
+        return timed.duration
+
+    def test_multiple_flush_workers_throughput(self):
+        # Each recording takes 4 delayed operations (0.2s), a single worker flushes them one after the other
+        single_worker_duration = self._record_and_measure(flush_workers=1)
+        four_workers_duration = self._record_and_measure(flush_workers=4)
+        self.assertGreater(single_worker_duration, 1.6)
+        self.assertLess(four_workers_duration, single_worker_duration / 2.5)
+
+    def test_multiple_flush_workers_keep_recording_operations_order(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0.01)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, flush_interval=0.01, timeout_on_close=10,
+                                                    flush_workers=4)
+        tape_cassette.start()
+        recording = tape_cassette.create_new_recording('category')
+        for i in range(10):
+            recording.set_data('a', i)
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+        self.assertEqual(9, in_memory_cassette.get_recording(recording.id).get_data('a'))
+
+    def test_operations_are_flushed_as_soon_as_added(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5)
+        tape_cassette.start()
+        try:
+            # Let the recording thread wait for operations
+            sleep(0.1)
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', 1)
+            start = time()
+            tape_cassette.save_recording(recording)
+            while in_memory_cassette.get_last_recording_id() is None and time() - start < 5:
+                sleep(0.001)
+            self.assertEqual(recording.id, in_memory_cassette.get_last_recording_id())
+            self.assertLess(time() - start, 0.05)
+        finally:
+            tape_cassette.close()
+
+    def test_close_flushes_pending_operations(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0.01)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5)
+        tape_cassette.start()
+        recordings = []
+        for i in range(5):
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', i)
+            tape_cassette.save_recording(recording)
+            recordings.append(recording)
+        with Timed() as timed:
+            tape_cassette.close()
+        self.assertLess(timed.duration, 5)
+        self.assertEqual(sorted(r.id for r in recordings), in_memory_cassette.get_all_recording_ids())
+
+    def test_get_data_waits_only_for_own_recording_operations(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, flush_workers=2)
+        tape_cassette.start()
+        release_event = Event()
+        try:
+            slow_recording = tape_cassette.create_new_recording('category')
+            slow_recording.set_data('a', 1)
+            tape_cassette._add_async_operation(lambda: release_event.wait(5), recording=slow_recording)
+
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', 2)
+            with Timed() as timed:
+                self.assertEqual(2, recording.get_data('a'))
+                self.assertEqual(2, recording.get_data_direct('a'))
+            self.assertLess(timed.duration, 1)
+            self.assertFalse(release_event.is_set())
+        finally:
+            release_event.set()
+            tape_cassette.close()
+
+    def test_batched_recording_changes(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, batch_max_items=100)
+        tape_cassette.start()
+        operations_queue = tape_cassette._operations_queue
+        with patch.object(operations_queue, 'put', wraps=operations_queue.put) as put_mock:
+            recording = tape_cassette.create_new_recording('category')
+            for i in range(150):
+                recording.set_data(str(i), i)
+            recording.add_metadata({'a': 1})
+            recording.set_data('0', 'overridden')
+            for i in range(150, 250):
+                recording.set_data(str(i), i)
+            # 3 batches of changes and the save operation
+            tape_cassette.save_recording(recording)
+            tape_cassette.close()
+        self.assertEqual(4, put_mock.call_count)
+
+        saved_recording = in_memory_cassette.get_recording(recording.id)
+        self.assertEqual('overridden', saved_recording.get_data('0'))
+        self.assertEqual(249, saved_recording.get_data('249'))
+        self.assertEqual(1, saved_recording.get_metadata()['a'])
+
+    def test_batched_recording_changes_read_your_writes(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, batch_max_items=100,
+                                                    batch_max_bytes=1000)
+        tape_cassette.start()
+        try:
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', 1)
+            self.assertEqual(1, recording.get_data('a'))
+            # Reaching the bytes threshold adds the batch without waiting for the recording to be saved
+            recording.set_data('b', 'b' * 1000)
+            tape_cassette._wait_for_flush(recording)
+            self.assertEqual('b' * 1000, recording.wrapped_recording.get_data('b'))
+        finally:
+            tape_cassette.close()
+
+    def test_lazy_start(self):
+        in_memory_cassette = DelayedInMemoryTapeCassette(delay=0)
+        tape_cassette = AsyncRecordOnlyTapeCassette(in_memory_cassette, timeout_on_close=5, lazy_start=True)
+        recording = tape_cassette.create_new_recording('category')
+        recording.set_data('a', 1)
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+        self.assertEqual(1, in_memory_cassette.get_recording(recording.id).get_data('a'))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'Fork handlers are not supported')
+    def test_recording_in_forked_child(self):
+        directory = mkdtemp()
+        try:
+            file_cassette = FileBasedTapeCassette(directory)
+            tape_cassette = AsyncRecordOnlyTapeCassette(file_cassette, timeout_on_close=5)
+            tape_cassette.start()
+            parent_recording = tape_cassette.create_new_recording('parent')
+            parent_recording.set_data('a', 1)
+
+            pid = os.fork()
+            if pid == 0:
+                # Child process, it must never return into the test runner
+                exit_code = 1
+                try:
+                    child_recording = tape_cassette.create_new_recording('child')
+                    child_recording.set_data('a', 2)
+                    tape_cassette.save_recording(child_recording)
+                    tape_cassette.close()
+                    exit_code = 0
+                finally:
+                    os._exit(exit_code)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, status)
+            tape_cassette.save_recording(parent_recording)
+            tape_cassette.close()
+
+            child_ids = list(file_cassette.iter_recording_ids('child'))
+            self.assertEqual(1, len(child_ids))
+            self.assertEqual(2, file_cassette.get_recording(child_ids[0]).get_data('a'))
+            self.assertEqual(1, file_cassette.get_recording(parent_recording.id).get_data('a'))
+        finally:
+            shutil.rmtree(directory)
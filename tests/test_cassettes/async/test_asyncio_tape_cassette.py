@@ -0,0 +1,112 @@
+import unittest
+from threading import Lock
+from time import sleep
+
+import six
+
+from playback.tape_cassettes.in_memory.in_memory_tape_cassette import InMemoryTapeCassette
+from playback.utils.timing_utils import Timed
+
+if six.PY3:
+    import asyncio
+    from playback.tape_cassettes.asynchronous.asyncio_record_only_tape_cassette import \
+        AsyncioRecordOnlyTapeCassette
+
+
+class ConcurrencyTrackingTapeCassette(InMemoryTapeCassette):
+    """
+    In memory cassette with slow saves that tracks how many recordings are saved concurrently
+    """
+    def __init__(self, delay, fail=False):
+        super(ConcurrencyTrackingTapeCassette, self).__init__()
+        self.delay = delay
+        self.fail = fail
+        self.concurrent_saves = 0
+        self.max_concurrent_saves = 0
+        self._lock = Lock()
+
+    def _save_recording(self, recording):
+        with self._lock:
+            self.concurrent_saves += 1
+            self.max_concurrent_saves = max(self.max_concurrent_saves, self.concurrent_saves)
+        try:
+            sleep(self.delay)
+            if self.fail:
+                raise IOError('unavailable')
+            super(ConcurrencyTrackingTapeCassette, self)._save_recording(recording)
+        finally:
+            with self._lock:
+                self.concurrent_saves -= 1
+
+
+@unittest.skipIf(six.PY2, 'asyncio is only available on Python 3')
+class TestAsyncioTapeCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _call_in_loop(self, func):
+        """
+        Calls the given function while the event loop is running, as the cassette schedules saves on the running loop.
+        The tests do not use async syntax, so this module can still be collected by Python 2
+        """
+        future = self.loop.create_future()
+
+        def call():
+            try:
+                future.set_result(func())
+            except Exception as ex:  # pylint: disable=broad-except
+                future.set_exception(ex)
+
+        self.loop.call_soon(call)
+        return self.loop.run_until_complete(future)
+
+    def _record(self, tape_cassette, count):
+        recording_ids = []
+        for i in range(count):
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', i)
+            tape_cassette.save_recording(recording)
+            recording_ids.append(recording.id)
+        return recording_ids
+
+    def test_saves_are_bounded_and_drained_on_aclose(self):
+        wrapped_cassette = ConcurrencyTrackingTapeCassette(delay=0.05)
+        tape_cassette = AsyncioRecordOnlyTapeCassette(wrapped_cassette, max_concurrency=3)
+
+        def record():
+            with Timed() as timed:
+                recording_ids = self._record(tape_cassette, 10)
+            self.assertLess(timed.duration, 0.05)
+            self.assertEqual(10, tape_cassette.pending_recordings)
+            return recording_ids
+
+        recording_ids = self._call_in_loop(record)
+        self.loop.run_until_complete(tape_cassette.aclose())
+        self.assertEqual(sorted(recording_ids), wrapped_cassette.get_all_recording_ids())
+        self.assertEqual(10, tape_cassette.saved_recordings)
+        self.assertEqual(0, tape_cassette.pending_recordings)
+        self.assertEqual(3, wrapped_cassette.max_concurrent_saves)
+
+    def test_failed_and_dropped_recordings_are_counted(self):
+        wrapped_cassette = ConcurrencyTrackingTapeCassette(delay=0.01, fail=True)
+        tape_cassette = AsyncioRecordOnlyTapeCassette(wrapped_cassette, max_pending_recordings=2)
+
+        self.assertIs(tape_cassette, self.loop.run_until_complete(tape_cassette.__aenter__()))
+        self._call_in_loop(lambda: self._record(tape_cassette, 3))
+        self.loop.run_until_complete(tape_cassette.__aexit__(None, None, None))
+        self.assertEqual(2, tape_cassette.failed_recordings)
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+        self.assertEqual([], wrapped_cassette.get_all_recording_ids())
+
+    def test_playback_operations_raise_errors(self):
+        tape_cassette = AsyncioRecordOnlyTapeCassette(InMemoryTapeCassette())
+        with self.assertRaises(TypeError):
+            tape_cassette.get_recording('a')
+        with self.assertRaises(TypeError):
+            tape_cassette.iter_recording_ids('a')
+        with self.assertRaises(TypeError):
+            tape_cassette.extract_recording_category('a')
@@ -0,0 +1,133 @@
+import os
+import shutil
+import unittest
+from functools import partial
+from tempfile import mkdtemp
+from threading import current_thread
+from time import sleep
+
+import six
+from mock import patch
+
+from playback.tape_cassettes.asynchronous import process_pool_record_only_tape_cassette
+from playback.tape_cassettes.asynchronous.process_pool_record_only_tape_cassette import \
+    ProcessPoolRecordOnlyTapeCassette
+from playback.tape_cassettes.file_based.file_based_tape_cassette import FileBasedTapeCassette
+
+
+class UnpicklableValue(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        raise TypeError('Not picklable')
+
+
+class CrashingTapeCassette(FileBasedTapeCassette):
+    def _save_recording(self, recording):
+        if recording.get_data('crash'):
+            os._exit(1)
+        super(CrashingTapeCassette, self)._save_recording(recording)
+
+
+class TestProcessPoolTapeCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.file_cassette = FileBasedTapeCassette(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create_cassette(self, **kwargs):
+        return ProcessPoolRecordOnlyTapeCassette(partial(FileBasedTapeCassette, self.directory), **kwargs)
+
+    def test_recordings_are_saved_by_serializer_processes(self):
+        tape_cassette = self._create_cassette(processes=2)
+        tape_cassette.start()
+        recording_ids = []
+        for i in range(5):
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', i)
+            recording.set_data('b', UnpicklableValue(i) if i == 0 else [i])
+            recording.add_metadata({'c': i})
+            tape_cassette.save_recording(recording)
+            recording_ids.append(recording.id)
+        tape_cassette.close()
+
+        self.assertEqual(5, tape_cassette.saved_recordings)
+        self.assertEqual(0, tape_cassette.failed_recordings)
+        for i, recording_id in enumerate(recording_ids):
+            recording = self.file_cassette.get_recording(recording_id)
+            self.assertEqual(i, recording.get_data('a'))
+            self.assertEqual(i, recording.get_metadata()['c'])
+        self.assertEqual(0, self.file_cassette.get_recording(recording_ids[0]).get_data('b').value)
+
+    def test_unpicklable_recordings_are_encoded_off_the_recording_thread(self):
+        tape_cassette = self._create_cassette(processes=1)
+        tape_cassette.start()
+        encoding_threads = []
+        original_encode = process_pool_record_only_tape_cassette.encode
+
+        def encode(*args, **kwargs):
+            encoding_threads.append(current_thread())
+            return original_encode(*args, **kwargs)
+
+        with patch.object(process_pool_record_only_tape_cassette, 'encode', new=encode):
+            recording = tape_cassette.create_new_recording('category')
+            recording.set_data('a', UnpicklableValue(1))
+            tape_cassette.save_recording(recording)
+            tape_cassette.close()
+
+        self.assertEqual(1, tape_cassette.saved_recordings)
+        self.assertEqual(1, len(encoding_threads))
+        self.assertNotEqual(current_thread(), encoding_threads[0])
+        self.assertEqual(1, self.file_cassette.get_recording(recording.id).get_data('a').value)
+
+    @unittest.skipIf(six.PY2, 'Start methods are not supported in python 2')
+    def test_serializer_processes_are_not_forked(self):
+        tape_cassette = self._create_cassette(processes=1)
+        self.assertIn(tape_cassette._context.get_start_method(), ('forkserver', 'spawn'))
+        tape_cassette = self._create_cassette(processes=1, start_method='spawn')
+        self.assertEqual('spawn', tape_cassette._context.get_start_method())
+
+    def test_recording_of_crashed_serializer_process_expires(self):
+        tape_cassette = ProcessPoolRecordOnlyTapeCassette(partial(CrashingTapeCassette, self.directory), processes=1,
+                                                          max_pending_recordings=1, save_timeout=1)
+        tape_cassette.start()
+        crashing_recording = tape_cassette.create_new_recording('category')
+        crashing_recording.set_data('crash', True)
+        tape_cassette.save_recording(crashing_recording)
+        sleep(1.5)
+
+        recording = tape_cassette.create_new_recording('category')
+        recording.set_data('crash', False)
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+
+        self.assertEqual(0, tape_cassette.dropped_recordings)
+        self.assertEqual(1, tape_cassette.failed_recordings)
+        self.assertEqual(1, tape_cassette.saved_recordings)
+        self.assertEqual([recording.id], list(self.file_cassette.iter_recording_ids('category')))
+
+    def test_max_pending_recordings_drops_recordings(self):
+        tape_cassette = self._create_cassette(processes=1, max_pending_recordings=0)
+        tape_cassette.start()
+        recording = tape_cassette.create_new_recording('category')
+        recording.set_data('a', 1)
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+
+        self.assertEqual(1, tape_cassette.dropped_recordings)
+        self.assertEqual(0, tape_cassette.saved_recordings)
+        self.assertEqual([], list(self.file_cassette.iter_recording_ids('category')))
+
+    def test_playback_operations_raise_errors(self):
+        tape_cassette = self._create_cassette(processes=1)
+        with self.assertRaises(TypeError):
+            tape_cassette.get_recording('a')
+        with self.assertRaises(TypeError):
+            tape_cassette.iter_recording_ids('a')
+        with self.assertRaises(TypeError):
+            tape_cassette.extract_recording_category('a')
+        tape_cassette.close()
@@ -0,0 +1,164 @@
+import io
+import os
+import shutil
+import signal
+import unittest
+from tempfile import mkdtemp
+from time import sleep, time
+
+from mock import patch
+
+from playback.recordings.memory.memory_recording import MemoryRecording
+from playback.tape_cassettes.asynchronous.async_record_only_tape_cassette import AsyncRecordOnlyTapeCassette
+from playback.tape_cassettes.asynchronous.recording_spool import RecordingSpool
+from playback.tape_cassettes.file_based.file_based_tape_cassette import FileBasedTapeCassette
+from playback.tape_cassettes.in_memory.in_memory_tape_cassette import InMemoryTapeCassette
+
+
+class TestRecordingSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_path = os.path.join(mkdtemp(), 'spool')
+        self.tape_cassette = InMemoryTapeCassette()
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.spool_path))
+
+    def _create_recording(self, value):
+        recording = self.tape_cassette.create_new_recording('category')
+        recording.set_data('a', value)
+        recording.add_metadata({'b': value})
+        return recording
+
+    def _assert_saved(self, recordings):
+        self.assertEqual(sorted(r.id for r in recordings), self.tape_cassette.get_all_recording_ids())
+        for recording in recordings:
+            saved_recording = self.tape_cassette.get_recording(recording.id)
+            self.assertEqual(recording.get_data('a'), saved_recording.get_data('a'))
+            self.assertEqual(recording.get_metadata()['b'], saved_recording.get_metadata()['b'])
+
+    def test_spooled_recordings_are_saved(self):
+        spool = RecordingSpool(self.spool_path, self.tape_cassette, segment_max_bytes=200)
+        spool.start()
+        recordings = [self._create_recording(i) for i in range(10)]
+        for recording in recordings:
+            spool.append(recording)
+        spool.close(5)
+
+        self._assert_saved(recordings)
+        self.assertEqual(10, spool.saved_recordings)
+        self.assertEqual([], os.listdir(self.spool_path))
+
+    def test_failed_saves_are_retried(self):
+        spool = RecordingSpool(self.spool_path, self.tape_cassette, retry_base_delay=0.01)
+        original_save = self.tape_cassette.save_recording
+        attempts = []
+
+        def save_recording(saved_recording):
+            attempts.append(saved_recording.id)
+            if len(attempts) < 3:
+                raise IOError('unavailable')
+            original_save(saved_recording)
+
+        recording = self._create_recording(1)
+        with patch.object(self.tape_cassette, 'save_recording', side_effect=save_recording):
+            spool.start()
+            spool.append(recording)
+            spool.close(5)
+
+        self.assertEqual(3, len(attempts))
+        self._assert_saved([recording])
+
+    def test_max_save_attempts_discards_recording(self):
+        spool = RecordingSpool(self.spool_path, self.tape_cassette, retry_base_delay=0.01, max_save_attempts=2)
+        with patch.object(self.tape_cassette, 'save_recording', side_effect=IOError('unavailable')):
+            spool.start()
+            spool.append(self._create_recording(1))
+            spool.close(5)
+
+        self.assertEqual(1, spool.failed_recordings)
+        self.assertEqual([], os.listdir(self.spool_path))
+
+    def test_leftover_segments_are_recovered(self):
+        spool = RecordingSpool(self.spool_path, self.tape_cassette, segment_max_bytes=200)
+        recordings = [self._create_recording(i) for i in range(5)]
+        for recording in recordings:
+            spool.append(recording)
+        # The process stopped before the spooled recordings were saved, a partially written record is left behind
+        spool.close(0)
+        segments = sorted(os.listdir(self.spool_path))
+        with io.open(os.path.join(self.spool_path, segments[-1]), 'ab') as fid:
+            fid.write(b'\x00\x00\x10\x00partial')
+
+        recovered_spool = RecordingSpool(self.spool_path, self.tape_cassette)
+        self.assertEqual(len(segments), recovered_spool.pending_segments)
+        recovered_spool.start()
+        new_recording = self._create_recording(5)
+        recovered_spool.append(new_recording)
+        recovered_spool.close(5)
+
+        self._assert_saved(recordings + [new_recording])
+        self.assertEqual(1, recovered_spool.corrupted_recordings)
+        self.assertEqual([], os.listdir(self.spool_path))
+
+    def test_close_timeout_keeps_recordings_in_spool(self):
+        spool = RecordingSpool(self.spool_path, self.tape_cassette, retry_base_delay=10)
+        with patch.object(self.tape_cassette, 'save_recording', side_effect=IOError('unavailable')):
+            spool.start()
+            spool.append(self._create_recording(1))
+            spool.close(0.2)
+        self.assertEqual(1, len(os.listdir(self.spool_path)))
+
+    def test_async_cassette_with_spool(self):
+        tape_cassette = AsyncRecordOnlyTapeCassette(self.tape_cassette, timeout_on_close=5, spool_path=self.spool_path)
+        tape_cassette.start()
+        recording = tape_cassette.create_new_recording('category')
+        recording.set_data('a', 1)
+        recording.add_metadata({'b': 1})
+        tape_cassette.save_recording(recording)
+        tape_cassette.close()
+
+        self._assert_saved([MemoryRecording(recording.id, recording_data={'a': 1}, recording_metadata={'b': 1})])
+        self.assertEqual([], os.listdir(self.spool_path))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'Fork handlers are not supported')
+    def test_segments_of_killed_worker_are_adopted(self):
+        file_cassette = FileBasedTapeCassette(os.path.join(os.path.dirname(self.spool_path), 'recordings'))
+        tape_cassette = AsyncRecordOnlyTapeCassette(file_cassette, timeout_on_close=5, spool_path=self.spool_path)
+        tape_cassette.start()
+
+        pid = os.fork()
+        if pid == 0:
+            # Child process, it must never return into the test runner, it is killed with its recording pending
+            try:
+                with patch.object(file_cassette, 'save_recording', side_effect=IOError('unavailable')):
+                    recording = tape_cassette.create_new_recording('child')
+                    recording.set_data('a', 1)
+                    tape_cassette.save_recording(recording)
+                    while True:
+                        sleep(1)
+            finally:
+                os._exit(1)
+
+        worker_path = os.path.join(self.spool_path, RecordingSpool.WORKER_DIR_PREFIX + str(pid))
+
+        def is_spooled():
+            return os.path.isdir(worker_path) and \
+                any(os.path.getsize(os.path.join(worker_path, name)) for name in os.listdir(worker_path))
+
+        deadline = time() + 10
+        while not is_spooled() and time() < deadline:
+            sleep(0.05)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        tape_cassette.close()
+        self.assertEqual([], list(file_cassette.iter_recording_ids('child')))
+
+        tape_cassette = AsyncRecordOnlyTapeCassette(file_cassette, timeout_on_close=5, spool_path=self.spool_path)
+        tape_cassette.start()
+        tape_cassette.close()
+
+        child_ids = list(file_cassette.iter_recording_ids('child'))
+        self.assertEqual(1, len(child_ids))
+        self.assertEqual(1, file_cassette.get_recording(child_ids[0]).get_data('a'))
+        self.assertEqual([], os.listdir(self.spool_path))
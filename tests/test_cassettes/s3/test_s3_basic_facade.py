@@ -0,0 +1,171 @@
+from __future__ import absolute_import
+
+import io
+import unittest
+from threading import Lock
+from time import sleep
+
+import boto3
+from botocore.exceptions import ClientError
+from mock import patch
+from moto import mock_s3
+
+from playback.tape_cassettes.s3.s3_basic_facade import S3BasicFacade, clear_shared_clients
+from playback.tape_cassettes.s3.s3_request_policies import RetryPolicy, HedgingPolicy
+from playback.utils.timing_utils import Timed
+
+TEST_BUCKET = 'test_bucket'
+
+
+def client_error(code, status_code):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'GetObject')
+
+
+@mock_s3
+class TestS3BasicFacade(unittest.TestCase):
+
+    def setUp(self):
+        conn = boto3.resource('s3', region_name='us-east-1')
+        conn.create_bucket(Bucket=TEST_BUCKET)
+        clear_shared_clients()
+
+    def _wrap_client_method(self, facade, method_name, behaviours):
+        """
+        Wraps a client method so each call first runs the next behaviour in the given list (if any)
+        """
+        original = getattr(facade.client, method_name)
+        lock = Lock()
+        calls = []
+
+        def wrapped(*args, **kwargs):
+            with lock:
+                behaviour = behaviours[len(calls)] if len(calls) < len(behaviours) else None
+                calls.append(kwargs)
+            if behaviour is not None:
+                behaviour()
+            return original(*args, **kwargs)
+
+        patcher = patch.object(facade.client, method_name, wrapped)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_retry_retryable_errors(self):
+        facade = S3BasicFacade(TEST_BUCKET, retry_policy=RetryPolicy(max_attempts=3, base_delay=0))
+        facade.put_string('key', b'data')
+
+        def slow_down():
+            raise client_error('SlowDown', 503)
+
+        calls = self._wrap_client_method(facade, 'get_object', [slow_down, slow_down])
+        self.assertEqual(b'data', facade.get_string('key'))
+        self.assertEqual(3, len(calls))
+        self.assertEqual(2, facade.get_metrics()['get_retries'])
+
+        calls = self._wrap_client_method(facade, 'get_object', [slow_down, slow_down, slow_down])
+        with self.assertRaises(ClientError):
+            facade.get_string('key')
+        self.assertEqual(3, len(calls))
+
+    def test_no_retry_on_non_retryable_errors(self):
+        facade = S3BasicFacade(TEST_BUCKET, retry_policy=RetryPolicy(max_attempts=3, base_delay=0))
+        calls = self._wrap_client_method(facade, 'get_object', [])
+        with self.assertRaises(Exception) as cm:
+            facade.get_string('missing key')
+        self.assertIn('NoSuchKey', type(cm.exception).__name__)
+        self.assertEqual(1, len(calls))
+        self.assertNotIn('get_retries', facade.get_metrics())
+
+    def test_no_retry_without_policy(self):
+        facade = S3BasicFacade(TEST_BUCKET)
+
+        def internal_error():
+            raise client_error('InternalError', 500)
+
+        calls = self._wrap_client_method(facade, 'list_objects_v2', [internal_error])
+        with self.assertRaises(ClientError):
+            list(facade.iter_keys('prefix'))
+        self.assertEqual(1, len(calls))
+
+    def test_retry_put_rewinds_reader(self):
+        facade = S3BasicFacade(TEST_BUCKET, retry_policy=RetryPolicy(max_attempts=2, base_delay=0))
+
+        def internal_error():
+            raise client_error('InternalError', 500)
+
+        self._wrap_client_method(facade, 'put_object', [internal_error])
+        reader = io.BufferedReader(io.BytesIO(b'some data'))
+        reader.read(2)
+        facade.put_buffered_reader('key', reader)
+        self.assertEqual(b'me data', facade.get_string('key'))
+        self.assertEqual(1, facade.get_metrics()['put_retries'])
+
+    def test_retry_policy_backoff_delay(self):
+        policy = RetryPolicy(base_delay=1, max_delay=3)
+        for _ in range(20):
+            self.assertLessEqual(policy.backoff_delay(1), 1)
+            self.assertLessEqual(policy.backoff_delay(5), 3)
+        self.assertTrue(policy.is_retryable(client_error('Whatever', 502)))
+        self.assertFalse(policy.is_retryable(client_error('AccessDenied', 403)))
+        self.assertFalse(policy.is_retryable(ValueError()))
+
+    def test_hedged_get_of_slow_request(self):
+        facade = S3BasicFacade(TEST_BUCKET, hedging_policy=HedgingPolicy(min_samples=3, min_delay=0.05))
+        facade.put_string('key', b'data')
+
+        # Latency samples are needed before requests are hedged
+        for _ in range(3):
+            self.assertEqual(b'data', facade.get_string('key'))
+        self.assertNotIn('hedged_gets', facade.get_metrics())
+
+        calls = self._wrap_client_method(facade, 'get_object', [lambda: sleep(2)])
+        with Timed() as timed:
+            self.assertEqual(b'data', facade.get_string('key'))
+            with facade.get_buffered_reader('key') as reader:
+                self.assertEqual(b'data', reader.read())
+        self.assertLess(timed.duration, 1.5)
+        self.assertEqual(3, len(calls))
+
+        metrics = facade.get_metrics()
+        self.assertEqual(1, metrics['hedged_gets'])
+        self.assertEqual(1, metrics['hedged_wins'])
+        self.assertIsNotNone(metrics['get_latency_p99'])
+
+    def test_hedged_get_falls_back_to_other_request_on_failure(self):
+        facade = S3BasicFacade(TEST_BUCKET, hedging_policy=HedgingPolicy(min_samples=1, min_delay=0.05))
+        facade.put_string('key', b'data')
+        facade.get_string('key')
+
+        def slow_failure():
+            sleep(0.2)
+            raise client_error('InternalError', 500)
+
+        self._wrap_client_method(facade, 'get_object', [slow_failure])
+        self.assertEqual(b'data', facade.get_string('key'))
+        self.assertEqual(1, facade.get_metrics()['hedged_wins'])
+
+    def test_clients_are_lazy_and_shared(self):
+        facade = S3BasicFacade(TEST_BUCKET)
+        other_facade = S3BasicFacade('other_bucket')
+        pooled_facade = S3BasicFacade(TEST_BUCKET, max_pool_connections=50)
+        self.assertIsNone(facade._client)
+
+        self.assertIs(facade.client, other_facade.client)
+        self.assertIsNot(facade.client, pooled_facade.client)
+        self.assertEqual(50, pooled_facade.client.meta.config.max_pool_connections)
+        self.assertIs(pooled_facade.client, S3BasicFacade('other_bucket', max_pool_connections=50).client)
+
+        clear_shared_clients()
+        self.assertIsNot(facade.client, S3BasicFacade(TEST_BUCKET).client)
+
+    def test_delete_by_prefix_in_batches(self):
+        facade = S3BasicFacade(TEST_BUCKET)
+        for i in range(5):
+            facade.put_string('prefix/{}'.format(i), b'data')
+        facade.put_string('other/key', b'data')
+
+        with patch('playback.tape_cassettes.s3.s3_basic_facade._DELETE_BATCH_SIZE', 2):
+            responses = facade.delete_by_prefix('prefix/')
+        self.assertEqual(3, len(responses))
+        self.assertEqual(['other/key'], list(facade.iter_keys()))
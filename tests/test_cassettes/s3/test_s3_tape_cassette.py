@@ -15,7 +15,9 @@ from playback.studio.recordings_lookup import find_matching_recording_ids, Recor
 
 from playback.exceptions import NoSuchRecording
 from playback.recording import Recording
+from playback.recordings.sqlite.sqlite_recording import SqliteRecording
 import six
+from playback.tape_cassettes.asynchronous.async_record_only_tape_cassette import AsyncRecordOnlyTapeCassette
 from playback.tape_cassettes.s3.s3_tape_cassette import S3TapeCassette
 from six.moves import range
 TEST_BUCKET = 'test_bucket'
@@ -108,7 +110,9 @@ class TestS3TapeCassette(unittest.TestCase):
             raise ValueError('some error')
 
         with patch('playback.tape_cassettes.s3.s3_basic_facade.S3BasicFacade.get_string',
-                   side_affect):
+                   side_affect), \
+                patch('playback.tape_cassettes.s3.s3_basic_facade.S3BasicFacade.get_buffered_reader',
+                      side_affect):
             with self.assertRaises(ValueError) as cm:
                 self.cassette.get_recording('some id')
             self.assertEqual('some error', str(cm.exception))
@@ -131,6 +135,38 @@ class TestS3TapeCassette(unittest.TestCase):
         fetched_recording_metadata = self.cassette.get_recording_metadata(recording.id)
         self.assertLessEqual(metadata.items(), fetched_recording_metadata.items())
 
+    def test_fetch_recording_with_embedded_metadata_in_single_round_trip(self):
+        recording = self.cassette.create_new_recording('test_operation')
+        recording.set_data('key1', 5)
+        recording.add_metadata({'key1': 5})
+        self.cassette.save_recording(recording)
+
+        with patch.object(self.cassette._s3_facade, 'get_string',
+                          wraps=self.cassette._s3_facade.get_string) as patched:
+            fetched_recording = self.cassette.get_recording(recording.id)
+
+        patched.assert_not_called()
+        self.assertEqual(5, fetched_recording.get_data('key1'))
+        self.assertEqual(recording.get_metadata(), fetched_recording.get_metadata())
+
+    def test_create_save_and_fetch_sqlite_recording(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
+                            recording_type=SqliteRecording) as new_cassette:
+            recording = new_cassette.create_new_recording('test_operation')
+            recording.set_data('key1', 5)
+            recording.add_metadata({'key1': 5})
+            new_cassette.save_recording(recording)
+
+            fetched_recording = new_cassette.get_recording(recording.id)
+            self.assertIsInstance(fetched_recording, SqliteRecording)
+            self.assertEqual(5, fetched_recording.get_data('key1'))
+            self.assertLessEqual({'key1': 5, '_recording_type': 'sqlite'}.items(),
+                                 fetched_recording.get_metadata().items())
+
+            with self.assertRaises(NoSuchRecording):
+                new_cassette.get_recording('non existing id')
+
     def test_close_transient_true(self):
         prefix = 'tests_' + uuid.uuid1().hex
         with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False) as new_cassette:
@@ -356,6 +392,185 @@ class TestS3TapeCassette(unittest.TestCase):
         self.assertEqual(1, len(list(self.cassette.iter_recording_ids(
             category='test_operation1', limit=1, start_date=datetime.utcnow() - timedelta(days=7)))))
 
+    def test_partitioned_layout_with_indexed_metadata_fields(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
+                            indexed_metadata_fields=['tenant', 'flag'], partition_by_hour=True) as new_cassette:
+            recordings = []
+            for tenant, flag in [('acme', True), ('acme', False), ('other/tenant', True)]:
+                recording = new_cassette.create_new_recording('test_operation')
+                recording.add_metadata({'tenant': tenant, 'flag': flag, 'property': tenant + str(flag)})
+                new_cassette.save_recording(recording)
+                recordings.append(recording)
+
+            now = datetime.utcnow()
+            self.assertEqual('test_operation/{}/{}/tenant=acme/flag=true'.format(
+                now.strftime('%Y%m%d'), now.strftime('%H')), recordings[0].id.rsplit('/', 1)[0])
+            self.assertIn('/tenant=other%2Ftenant/', recordings[2].id)
+            self.assertEqual('test_operation', new_cassette.extract_recording_category(recordings[2].id))
+            self.assertEqual(recordings[2].get_metadata(), new_cassette.get_recording(recordings[2].id).get_metadata())
+
+            start_date = now - timedelta(hours=1)
+            with patch.object(new_cassette, 'create_id_prefix_iterators',
+                              wraps=new_cassette.create_id_prefix_iterators) as patched:
+                assert_items_equal(self, [recordings[0].id, recordings[1].id],
+                                   list(new_cassette.iter_recording_ids(
+                                       'test_operation', start_date=start_date, metadata={'tenant': 'acme'})))
+                narrowed_calls = [call for call in patched.call_args_list if call[1]['delimiter'] is None]
+                narrowed_prefixes = [call[0][0][0] for call in narrowed_calls]
+                self.assertTrue(all(id_prefix.endswith('/tenant=acme/') for id_prefix in narrowed_prefixes))
+                # Hour prefixes, and the day prefixes of recordings saved before the hours partitioning
+                prefix_depths = [id_prefix.count('/') for id_prefix in narrowed_prefixes]
+                self.assertLessEqual(prefix_depths.count(4), 3)
+                self.assertLessEqual(prefix_depths.count(3), 2)
+                # The day and hour prefixes are listed only for recordings saved directly under them before the
+                # indexed fields were configured
+                unindexed_prefixes = [call[0][0][0] for call in patched.call_args_list if call[1]['delimiter'] == '/']
+                self.assertEqual(len(narrowed_prefixes), len(unindexed_prefixes))
+                self.assertTrue(all(id_prefix.count('/') in (2, 3) for id_prefix in unindexed_prefixes))
+
+                patched.reset_mock()
+                assert_items_equal(self, [recordings[0].id, recordings[2].id],
+                                   list(new_cassette.iter_recording_ids(
+                                       'test_operation', start_date=start_date,
+                                       metadata={'tenant': ['acme', 'other/tenant'], 'flag': True})))
+                narrowed_calls = [call for call in patched.call_args_list if call[1]['delimiter'] is None]
+                self.assertTrue(all(call[0][0][0].endswith('/flag=true/') for call in narrowed_calls))
+                # All filters are covered by prefixes, no content filtering is needed
+                self.assertTrue(all(call[0][3] is None for call in narrowed_calls))
+
+                # Wildcard filters cannot be used as prefixes and fall back to content filtering
+                assert_items_equal(self, [recordings[0].id, recordings[1].id],
+                                   list(new_cassette.iter_recording_ids(
+                                       'test_operation', start_date=start_date, metadata={'tenant': 'ac*'})))
+                assert_items_equal(self, [recordings[1].id],
+                                   list(new_cassette.iter_recording_ids(
+                                       'test_operation', start_date=start_date,
+                                       metadata={'tenant': 'acme', 'property': 'acmeFalse'})))
+
+            assert_items_equal(self, [],
+                               list(new_cassette.iter_recording_ids(
+                                   'test_operation', start_date=now + timedelta(hours=2), metadata={'tenant': 'acme'})))
+
+    def test_partitioned_layout_reads_existing_layout(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=False, read_only=False) as new_cassette:
+            legacy_recording = new_cassette.create_new_recording('test_operation')
+            legacy_recording.add_metadata({'tenant': 'acme'})
+            new_cassette.save_recording(legacy_recording)
+
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
+                            indexed_metadata_fields=['tenant']) as new_cassette:
+            recording = new_cassette.create_new_recording('test_operation')
+            recording.add_metadata({'tenant': 'acme'})
+            new_cassette.save_recording(recording)
+
+            self.assertEqual(legacy_recording.get_metadata(),
+                             new_cassette.get_recording(legacy_recording.id).get_metadata())
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids('test_operation')))
+            start_date = datetime.utcnow() - timedelta(hours=1)
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids('test_operation', start_date=start_date)))
+
+            # Filtering by indexed fields finds the recordings saved before the fields were indexed as well
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids(
+                                   'test_operation', start_date=start_date, metadata={'tenant': 'acme'})))
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids(
+                                   'test_operation', start_date=start_date, metadata={'tenant': ['acme', 'other']})))
+            self.assertEqual([], list(new_cassette.iter_recording_ids(
+                'test_operation', start_date=start_date, metadata={'tenant': 'other'})))
+            page, cursor = new_cassette.get_recording_ids_page(
+                'test_operation', start_date=start_date, metadata={'tenant': 'acme'}, page_size=1)
+            next_page, _ = new_cassette.get_recording_ids_page(
+                'test_operation', start_date=start_date, metadata={'tenant': 'acme'}, page_size=1, cursor=cursor)
+            assert_items_equal(self, [legacy_recording.id, recording.id], page + next_page)
+
+    def test_hour_partitioned_layout_reads_existing_layout(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=False, read_only=False) as new_cassette:
+            legacy_recording = new_cassette.create_new_recording('test_operation')
+            legacy_recording.add_metadata({'tenant': 'acme'})
+            new_cassette.save_recording(legacy_recording)
+
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
+                            partition_by_hour=True) as new_cassette:
+            recording = new_cassette.create_new_recording('test_operation')
+            recording.add_metadata({'tenant': 'acme'})
+            new_cassette.save_recording(recording)
+
+            start_date = datetime.utcnow() - timedelta(hours=1)
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids('test_operation', start_date=start_date)))
+            assert_items_equal(self, [legacy_recording.id, recording.id],
+                               list(new_cassette.iter_recording_ids(
+                                   'test_operation', start_date=start_date, metadata={'tenant': 'acme'})))
+            page, cursor = new_cassette.get_recording_ids_page('test_operation', start_date=start_date, page_size=1)
+            next_page, _ = new_cassette.get_recording_ids_page('test_operation', start_date=start_date, page_size=1,
+                                                               cursor=cursor)
+            assert_items_equal(self, [legacy_recording.id, recording.id], page + next_page)
+
+    def test_indexed_recording_id_is_final_before_saved_asynchronously(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        # Closing the asynchronous cassette closes the underlying cassette as well, hence it is not transient
+        s3_cassette = S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=False, read_only=False,
+                                     indexed_metadata_fields=['tenant'])
+        async_cassette = AsyncRecordOnlyTapeCassette(s3_cassette)
+        async_cassette.start()
+        recording = async_cassette.create_new_recording('test_operation')
+        created_id = recording.id
+        recording.add_metadata({'tenant': 'acme'})
+
+        saved_id = async_cassette.save_recording(recording)
+        self.assertEqual(saved_id, recording.id)
+        self.assertIn('/tenant=acme/', saved_id)
+        self.assertEqual(created_id.rsplit('/', 1)[-1], saved_id.rsplit('/', 1)[-1])
+        async_cassette.close()
+
+        # The underlying cassette saved the recording with the same final id
+        self.assertEqual(saved_id, recording.wrapped_recording.id)
+        self.assertEqual('acme', s3_cassette.get_recording(saved_id).get_metadata()['tenant'])
+
+    def test_get_recording_ids_pages_resumed_by_another_cassette(self):
+        recording_ids = []
+        for i in range(7):
+            if i % 2:
+                with patch('playback.tape_cassettes.s3.s3_tape_cassette.datetime') as patched_datetime:
+                    patched_datetime.today.return_value = datetime.today() - timedelta(days=1)
+                    recording = self.cassette.create_new_recording('test_operation1')
+            else:
+                recording = self.cassette.create_new_recording('test_operation1')
+            recording.add_metadata({'property': i < 6})
+            self.cassette.save_recording(recording)
+            recording_ids.append(recording.id)
+
+        start_date = datetime.utcnow() - timedelta(days=3)
+        found_ids = []
+        page, cursor = self.cassette.get_recording_ids_page(
+            'test_operation1', start_date=start_date, metadata={'property': True}, page_size=4)
+        self.assertEqual(4, len(page))
+        found_ids.extend(page)
+
+        # Cursor is serializable and can be used by another cassette instance
+        other_cassette = S3TapeCassette(TEST_BUCKET, key_prefix=self.cassette.key_prefix.rstrip('/'))
+        page, cursor = other_cassette.get_recording_ids_page(
+            'test_operation1', start_date=start_date, metadata={'property': True}, page_size=4, cursor=str(cursor))
+        found_ids.extend(page)
+        if cursor is not None:
+            page, cursor = other_cassette.get_recording_ids_page(
+                'test_operation1', start_date=start_date, metadata={'property': True}, page_size=4, cursor=cursor)
+            self.assertEqual([], page)
+            self.assertIsNone(cursor)
+
+        self.assertEqual(len(found_ids), len(set(found_ids)))
+        assert_items_equal(self, recording_ids[:6], found_ids)
+
+        # The interleaving order is kept across pages
+        self.assertEqual(list(self.cassette.iter_recording_ids(
+            'test_operation1', start_date=start_date, metadata={'property': True})), found_ids)
+
     def test_big_recording_storage_type(self):
         prefix = 'tests_' + uuid.uuid1().hex
         with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
@@ -399,6 +614,36 @@ class TestS3TapeCassette(unittest.TestCase):
             new_cassette.save_recording(recording)
             with self.assertRaises(NoSuchRecording):
                 new_cassette.get_recording(recording.id)
+            # Discarded recording should not leave an orphan metadata behind
+            with self.assertRaises(NoSuchRecording):
+                new_cassette.get_recording_metadata(recording.id)
+
+    def test_save_with_sampling_ratio_using_estimated_size(self):
+        prefix = 'tests_' + uuid.uuid1().hex
+        sizes = []
+
+        def sampling_calculator(category, size, r):
+            sizes.append(size)
+            return 1 if size < 1000 else 0
+
+        with S3TapeCassette(TEST_BUCKET, key_prefix=prefix, transient=True, read_only=False,
+                            sampling_calculator=sampling_calculator, estimate_sampling_size=True) as new_cassette:
+            recording = new_cassette.create_new_recording('test_operation')
+            recording.set_data('key', 'value')
+            new_cassette.save_recording(recording)
+            self.assertIsNotNone(new_cassette.get_recording(recording.id))
+
+            recording = new_cassette.create_new_recording('test_operation')
+            recording.set_data('key', list(range(1000)))
+            with patch.object(recording, 'as_buffered_reader') as as_buffered_reader:
+                new_cassette.save_recording(recording)
+            # Discarded based on the estimation without encoding the recording
+            as_buffered_reader.assert_not_called()
+            with self.assertRaises(NoSuchRecording):
+                new_cassette.get_recording_metadata(recording.id)
+
+        self.assertEqual(2, len(sizes))
+        self.assertGreater(sizes[1], 1000)
 
     def test_without_random_sample(self):
 
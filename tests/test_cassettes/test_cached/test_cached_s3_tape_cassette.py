@@ -1,16 +1,26 @@
 import os
 import shutil
 import tempfile
+from datetime import datetime, timedelta
 from io import BufferedReader, BytesIO
+from threading import Event, Thread
+from time import sleep, time
 from zlib import compress
 
+import boto3
 import six
 from jsonpickle import encode
 from mock import patch
+from moto import mock_s3
 
 from playback.tape_cassettes.cached import cached_facade
-from playback.tape_cassettes.cached.cached_facade import CachedReadOnlyS3TapeCassette, CachedS3BasicFacade
+from playback.tape_cassettes.cached.disk_cache_index import DiskCacheIndex
+from playback.tape_cassettes.cached.cached_facade import CachedReadOnlyS3TapeCassette, CachedS3BasicFacade, \
+    CachedS3TapeCassette
+from playback.recordings.memory.memory_recording import MemoryRecording
+from playback.tape_cassettes.s3 import s3_basic_facade
 from playback.tape_cassettes.s3.s3_basic_facade import S3BasicFacade
+from playback.tape_cassettes.s3.s3_tape_cassette import S3TapeCassette
 import unittest
 
 
@@ -117,6 +127,8 @@ class TestCachedS3TapeCassetteUseCacheTrue(TestReadOnlyCachedS3TapeCassette):
 
         self._test_caching()
         self.assertFalse(os.path.exists(self.s3_file_path))
+        # Reading only from the cache does not require an S3 client
+        self.assertIsNone(self.tape_cassette._s3_facade._client)
 
 
 class TestCachedS3TapeCassetteWithUseCacheFalse(TestReadOnlyCachedS3TapeCassette):
@@ -249,6 +261,33 @@ class TestCacheDataAtomicWrite(TestReadOnlyCachedS3TapeCassette):
         with open(self.cache_file_path, "rb") as fid:
             self.assertEqual(fid.read(), data)
 
+    def test_cache_stream_in_chunks(self):
+        class ChunkedStream(object):
+            def __init__(self, content):
+                self._stream = BytesIO(content)
+                self.read_sizes = []
+
+            def read(self, amt=None):
+                self.read_sizes.append(amt)
+                return self._stream.read(amt)
+
+        data = b"0123456789" * 10
+        stream = ChunkedStream(data)
+        with patch.object(CachedS3BasicFacade, "CACHE_WRITE_CHUNK_SIZE", 16):
+            CachedS3BasicFacade.cache_data_in_local_path(self.cache_file_path, stream)
+        self.assertEqual([16] * 8, stream.read_sizes)
+        with open(self.cache_file_path, "rb") as fid:
+            self.assertEqual(fid.read(), data)
+
+    def test_no_file_on_size_mismatch(self):
+        reader = BufferedReader(BytesIO(b"Truncated data"))
+        reader.content_length = 100
+        with self.assertRaises(IOError):
+            CachedS3BasicFacade.cache_data_in_local_path(self.cache_file_path, reader)
+        self.assertFalse(os.path.exists(self.cache_file_path))
+        cache_dir = os.path.dirname(self.cache_file_path)
+        self.assertEqual([], [name for name in os.listdir(cache_dir) if os.path.isfile(os.path.join(cache_dir, name))])
+
     def test_no_zero_size_file_on_write_failure(self):
         """Test that a failed write does not leave a zero-size file."""
         class FailingReader(object):
@@ -288,7 +327,7 @@ class TestCachedS3TapeCassette(TestReadOnlyCachedS3TapeCassette):
         )
 
         obj = dict(a="a", b=1)
-        encoded_full = encode(obj, unpicklable=True)
+        encoded_full = encode(dict(obj, _metadata={"foo": "bar"}), unpicklable=True)
 
         if six.PY3 and isinstance(encoded_full, str):
             compressed_str = compress(encoded_full.encode('utf-8'))
@@ -311,3 +350,435 @@ class TestCachedS3TapeCassette(TestReadOnlyCachedS3TapeCassette):
         self.assertLessEqual({
             "foo": "bar",
         }.items(), recording.get_metadata().items())
+
+
+class TestCachedS3BasicFacadeBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def create_facade(self, **kwargs):
+        return CachedS3BasicFacade(bucket="some_bucket", cache_path=self.cache_path, **kwargs)
+
+    @staticmethod
+    def get_string_mock(_self, key):
+        return b"data of " + key.encode('utf-8')
+
+    @staticmethod
+    def get_buffered_reader_mock(_self, key):
+        return BufferedReader(BytesIO(b"data of " + key.encode('utf-8')))
+
+    def fetch(self, facade, *keys):
+        with patch.object(S3BasicFacade, "get_string", new=self.get_string_mock):
+            for key in keys:
+                self.assertEqual(b"data of " + key.encode('utf-8'), facade.get_string(key))
+
+    def is_cached(self, key):
+        return os.path.exists(os.path.join(self.cache_path, key))
+
+    def test_evict_least_recently_used(self):
+        facade = self.create_facade(max_cache_entries=2)
+        self.fetch(facade, "a", "b", "a", "c")
+
+        self.assertTrue(self.is_cached("a"))
+        self.assertFalse(self.is_cached("b"))
+        self.assertTrue(self.is_cached("c"))
+        self.assertEqual(2, len(facade.cache_index))
+
+    def test_evict_least_frequently_used(self):
+        facade = self.create_facade(max_cache_entries=2, cache_eviction_policy="lfu")
+        self.fetch(facade, "a", "a", "a", "b", "c")
+
+        self.assertTrue(self.is_cached("a"))
+        self.assertFalse(self.is_cached("b"))
+        self.assertTrue(self.is_cached("c"))
+
+    def test_never_evict_file_being_read(self):
+        facade = self.create_facade(max_cache_bytes=len(b"data of x") + 1)
+        with patch.object(S3BasicFacade, "get_buffered_reader", new=self.get_buffered_reader_mock):
+            reader = facade.get_buffered_reader("x")
+        self.fetch(facade, "y")
+        self.assertTrue(self.is_cached("x"))
+        self.assertEqual(b"data of x", reader.read())
+
+        reader.close()
+        self.fetch(facade, "z")
+        self.assertFalse(self.is_cached("x"))
+        self.assertTrue(self.is_cached("z"))
+        self.assertLessEqual(facade.cache_index.total_bytes, len(b"data of x") + 1)
+
+    def test_index_is_persisted_and_unindexed_files_are_discovered(self):
+        CachedS3BasicFacade(bucket="some_bucket", cache_path=self.cache_path)
+        for key in ("old1", "old2", "metadata/old3"):
+            CachedS3BasicFacade.cache_data_in_local_path(os.path.join(self.cache_path, key), b"old")
+
+        with patch.object(cached_facade.DiskCacheIndex, "SCAN_BATCH_SIZE", 1):
+            facade = self.create_facade(max_cache_entries=10)
+            self.assertEqual(0, len(facade.cache_index))
+            self.fetch(facade, "new1")
+            self.assertEqual(2, len(facade.cache_index))
+        self.fetch(facade, "new2")
+        self.assertEqual(5, len(facade.cache_index))
+
+        facade = self.create_facade(max_cache_entries=3)
+        self.assertEqual(5, len(facade.cache_index))
+        self.fetch(facade, "new3")
+        self.assertEqual(3, len(facade.cache_index))
+        self.assertFalse(self.is_cached("old1"))
+        self.assertFalse(self.is_cached("metadata/old3"))
+        self.assertTrue(self.is_cached("new1"))
+        self.assertTrue(self.is_cached("new3"))
+
+    def cache_file(self, index, key, data=b"data"):
+        CachedS3BasicFacade.cache_data_in_local_path(os.path.join(self.cache_path, key), data)
+        index.add(key, len(data))
+
+    def test_indexes_sharing_cache_path_share_budget(self):
+        first = DiskCacheIndex(self.cache_path, max_entries=2)
+        second = DiskCacheIndex(self.cache_path, max_entries=2)
+        self.cache_file(first, "a")
+        self.cache_file(second, "b")
+        self.cache_file(first, "c")
+
+        self.assertFalse(self.is_cached("a"))
+        self.assertTrue(self.is_cached("b"))
+        self.assertTrue(self.is_cached("c"))
+        self.assertEqual(2, len(first))
+
+        self.cache_file(second, "d")
+        self.assertFalse(self.is_cached("b"))
+        self.assertEqual({"c", "d"}, {key for key in "abcd" if key in second})
+        self.assertEqual({"c", "d"}, set(DiskCacheIndex(self.cache_path)._read_saved_entries()))
+
+    def test_never_evict_file_pinned_by_another_index(self):
+        first = DiskCacheIndex(self.cache_path, max_entries=1)
+        second = DiskCacheIndex(self.cache_path, max_entries=1)
+        self.cache_file(first, "a")
+        second.pin("a")
+        self.cache_file(first, "b")
+        self.assertTrue(self.is_cached("a"))
+
+        second.unpin("a")
+        self.cache_file(first, "c")
+        self.assertFalse(self.is_cached("a"))
+        self.assertFalse(self.is_cached("b"))
+        self.assertTrue(self.is_cached("c"))
+
+    def test_temporary_files_are_not_discovered(self):
+        tmp_fd, _ = tempfile.mkstemp(dir=self.cache_path)
+        os.close(tmp_fd)
+        CachedS3BasicFacade.cache_data_in_local_path(os.path.join(self.cache_path, "old"), b"old")
+
+        index = DiskCacheIndex(self.cache_path)
+        self.cache_file(index, "new")
+        self.assertEqual(2, len(index))
+        self.assertIn("old", index)
+
+
+@mock_s3
+class TestCachedS3BasicFacadeListings(unittest.TestCase):
+
+    def setUp(self):
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket="some_bucket")
+        self.cache_path = tempfile.mkdtemp()
+        self.past_day = (datetime.utcnow() - timedelta(days=3)).strftime('%Y%m%d')
+        self.today = datetime.utcnow().strftime('%Y%m%d')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def create_facade(self, bucket="some_bucket", **kwargs):
+        kwargs.setdefault('listing_cache_ttl', 60)
+        return CachedS3BasicFacade(bucket=bucket, cache_path=self.cache_path, **kwargs)
+
+    def list_keys(self, facade, prefix, **kwargs):
+        with patch.object(facade.client, 'list_objects_v2', wraps=facade.client.list_objects_v2) as list_mock:
+            keys = list(facade.iter_keys(prefix, **kwargs))
+        return keys, list_mock.call_count
+
+    def test_past_day_listing_is_cached(self):
+        facade = self.create_facade()
+        prefix = 'metadata/category/{}/'.format(self.past_day)
+        facade.put_string(prefix + 'id1', b'{}')
+        facade.put_string(prefix + 'id2', b'{}')
+
+        self.assertEqual(([prefix + 'id1', prefix + 'id2'], 1), self.list_keys(facade, prefix))
+        facade.put_string(prefix + 'id3', b'{}')
+        self.assertEqual(([prefix + 'id1', prefix + 'id2'], 0), self.list_keys(self.create_facade(), prefix))
+        self.assertEqual(([prefix + 'id2'], 0), self.list_keys(facade, prefix, start_after=prefix + 'id1'))
+        self.assertEqual(([prefix + 'id1'], 0),
+                         self.list_keys(facade, prefix, start_date=datetime.utcnow() - timedelta(hours=1), limit=1))
+
+        # Refreshing the cache is done by not using it
+        self.assertEqual(([prefix + 'id1', prefix + 'id2', prefix + 'id3'], 1),
+                         self.list_keys(self.create_facade(use_cache=False), prefix))
+
+    def test_current_day_listing_expires(self):
+        prefix = 'metadata/category/{}/'.format(self.today)
+        facade = self.create_facade(listing_cache_ttl=60)
+        facade.put_string(prefix + 'id1', b'{}')
+        self.assertEqual(([prefix + 'id1'], 1), self.list_keys(facade, prefix))
+        facade.put_string(prefix + 'id2', b'{}')
+        self.assertEqual(([prefix + 'id1'], 0), self.list_keys(facade, prefix))
+
+        facade = self.create_facade(listing_cache_ttl=0)
+        with patch.object(cached_facade, 'time', return_value=time() + 1):
+            self.assertEqual(([prefix + 'id1', prefix + 'id2'], 1), self.list_keys(facade, prefix))
+
+    def test_partially_consumed_listing_is_not_cached(self):
+        facade = self.create_facade()
+        prefix = 'metadata/category/{}/'.format(self.past_day)
+        facade.put_string(prefix + 'id1', b'{}')
+        facade.put_string(prefix + 'id2', b'{}')
+
+        self.assertEqual(([prefix + 'id1'], 1), self.list_keys(facade, prefix, limit=1))
+        self.assertEqual(([prefix + 'id1', prefix + 'id2'], 1), self.list_keys(facade, prefix))
+
+    def test_buffered_reader_is_cached_file(self):
+        facade = self.create_facade()
+        facade.put_string('full/id', b'x' * 1000)
+        with facade.get_buffered_reader('full/id') as reader:
+            self.assertEqual(os.path.join(self.cache_path, 'id'), reader.name)
+            self.assertEqual(b'x' * 1000, reader.read())
+
+    def test_listings_are_not_cached_without_ttl(self):
+        prefix = 'metadata/category/{}/'.format(self.past_day)
+        for facade in (self.create_facade(listing_cache_ttl=None),
+                       CachedS3BasicFacade(bucket="some_bucket", cache_path=self.cache_path)):
+            facade.put_string(prefix + 'id1', b'{}')
+            self.assertEqual(1, self.list_keys(facade, prefix)[1])
+            self.assertEqual(1, self.list_keys(facade, prefix)[1])
+
+    def test_cached_listing_is_served_without_creating_a_client(self):
+        prefix = 'metadata/category/{}/'.format(self.past_day)
+        facade = self.create_facade()
+        facade.put_string(prefix + 'id1', b'{}')
+        self.assertEqual([prefix + 'id1'], list(facade.iter_keys(prefix)))
+
+        with patch.object(s3_basic_facade, 'get_shared_client', side_effect=AssertionError('Client was created')):
+            facade = self.create_facade()
+            self.assertEqual([prefix + 'id1'], list(facade.iter_keys(prefix)))
+            self.assertIsNone(facade._client)
+
+    def test_listings_are_cached_per_bucket(self):
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket="other_bucket")
+        prefix = 'metadata/category/{}/'.format(self.past_day)
+        facade = self.create_facade()
+        other_facade = self.create_facade(bucket="other_bucket")
+        facade.put_string(prefix + 'id1', b'{}')
+        other_facade.put_string(prefix + 'id2', b'{}')
+
+        self.assertEqual(([prefix + 'id1'], 1), self.list_keys(facade, prefix))
+        self.assertEqual(([prefix + 'id2'], 1), self.list_keys(other_facade, prefix))
+        self.assertEqual(([prefix + 'id1'], 0), self.list_keys(facade, prefix))
+
+    def test_search_recordings_of_past_days_without_listing(self):
+        cassette = CachedReadOnlyS3TapeCassette(bucket="some_bucket", key_prefix="test", local_path=self.cache_path,
+                                                listing_cache_ttl=60)
+        prefix = 'tape_recorder_recordings/test/metadata/category/{}/'.format(self.past_day)
+        cassette._s3_facade.put_string(prefix + 'id1', b'{"key": "value"}')
+        start_date = datetime.utcnow() - timedelta(days=4)
+
+        with patch.object(cassette._s3_facade.client, 'list_objects_v2',
+                          wraps=cassette._s3_facade.client.list_objects_v2) as list_mock:
+            for _ in range(2):
+                self.assertEqual(['category/{}/id1'.format(self.past_day)], list(cassette.iter_recording_ids(
+                    'category', start_date=start_date, metadata={'key': 'value'})))
+        # A single listing of each of the searched days
+        self.assertEqual(5, list_mock.call_count)
+
+
+@mock_s3
+class TestCachedReadOnlyS3TapeCassetteMemoryCache(unittest.TestCase):
+
+    def setUp(self):
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket="some_bucket")
+        self.cache_path = tempfile.mkdtemp()
+        writer = S3TapeCassette("some_bucket", key_prefix="test", read_only=False)
+        recording = writer.create_new_recording('test_operation')
+        recording.set_data('key', {'nested': [1, 2, 3]})
+        recording.add_metadata({'meta': 'value'})
+        writer.save_recording(recording)
+        self.recording_id = recording.id
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def create_cassette(self, memory_cache_bytes=None, decoded_cache=False):
+        return CachedReadOnlyS3TapeCassette(bucket="some_bucket", key_prefix="test", local_path=self.cache_path,
+                                            memory_cache_bytes=memory_cache_bytes, decoded_cache=decoded_cache)
+
+    def test_decoded_recording_is_served_from_memory(self):
+        cassette = self.create_cassette(memory_cache_bytes=1024 * 1024)
+        with patch.object(MemoryRecording, 'from_buffered_reader',
+                          wraps=MemoryRecording.from_buffered_reader) as decode_mock:
+            first = cassette.get_recording(self.recording_id)
+            first.get_data('key')['nested'].append(4)
+            first.add_metadata({'meta': 'changed'})
+            first.set_data('other', 1)
+
+            second = cassette.get_recording(self.recording_id)
+        self.assertEqual(1, decode_mock.call_count)
+        self.assertIsNot(first, second)
+        self.assertEqual({'nested': [1, 2, 3]}, second.get_data('key'))
+        self.assertEqual('value', second.get_metadata()['meta'])
+        self.assertEqual(['key'], list(second.get_all_keys()))
+
+    def test_changing_data_of_served_recording_keeps_cached_recording_intact(self):
+        cassette = self.create_cassette(memory_cache_bytes=1024 * 1024)
+        first = cassette.get_recording(self.recording_id)
+        first.get_data_direct('key')['nested'].append(4)
+        first.recording_data['key']['added'] = True
+
+        second = cassette.get_recording(self.recording_id)
+        self.assertEqual({'nested': [1, 2, 3]}, second.get_data_direct('key'))
+        self.assertEqual({'nested': [1, 2, 3]}, second.get_data('key'))
+
+    def test_recording_larger_than_budget_is_not_cached(self):
+        cassette = self.create_cassette(memory_cache_bytes=10)
+        with patch.object(MemoryRecording, 'from_buffered_reader',
+                          wraps=MemoryRecording.from_buffered_reader) as decode_mock:
+            cassette.get_recording(self.recording_id)
+            cassette.get_recording(self.recording_id)
+        self.assertEqual(2, decode_mock.call_count)
+
+    def test_decoded_recording_is_loaded_from_local_cache(self):
+        with patch.object(MemoryRecording, 'from_buffered_reader',
+                          wraps=MemoryRecording.from_buffered_reader) as decode_mock:
+            first = self.create_cassette(decoded_cache=True).get_recording(self.recording_id)
+            decoded_files = os.listdir(os.path.join(self.cache_path, CachedS3BasicFacade.DECODED_DIR))
+            self.assertEqual(1, len(decoded_files))
+
+            # A new cassette, like a new process, loads the decoded recording without decoding it
+            second = self.create_cassette(decoded_cache=True).get_recording(self.recording_id)
+            self.assertEqual(1, decode_mock.call_count)
+
+            # A corrupted decoded recording is decoded again
+            with open(os.path.join(self.cache_path, CachedS3BasicFacade.DECODED_DIR, decoded_files[0]), 'wb') as fid:
+                fid.write(b'corrupted')
+            third = self.create_cassette(decoded_cache=True).get_recording(self.recording_id)
+            self.assertEqual(2, decode_mock.call_count)
+
+        for recording in (first, second, third):
+            self.assertEqual(self.recording_id, recording.id)
+            self.assertEqual({'nested': [1, 2, 3]}, recording.get_data('key'))
+            self.assertEqual('value', recording.get_metadata()['meta'])
+
+
+class TestCachedS3BasicFacadeSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def test_concurrent_misses_fetch_once(self):
+        fetched_keys = []
+
+        def slow_get_string(_self, key):
+            fetched_keys.append(key)
+            sleep(0.2)
+            return b"data of " + key.encode('utf-8')
+
+        def slow_get_buffered_reader(_self, key):
+            return BufferedReader(BytesIO(slow_get_string(_self, key)))
+
+        results = []
+
+        def fetch(key, as_reader):
+            # Separate facades, like separate processes sharing the cache path
+            facade = CachedS3BasicFacade(bucket="some_bucket", cache_path=self.cache_path)
+            if as_reader:
+                with facade.get_buffered_reader(key) as reader:
+                    results.append(reader.read())
+            else:
+                results.append(facade.get_string(key))
+
+        with patch.object(S3BasicFacade, "get_string", new=slow_get_string), \
+                patch.object(S3BasicFacade, "get_buffered_reader", new=slow_get_buffered_reader):
+            threads = [Thread(target=fetch, args=(key, as_reader))
+                       for key in ("a", "b") for as_reader in (False, True) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(["a", "b"], sorted(fetched_keys))
+        self.assertEqual(sorted([b"data of a"] * 6 + [b"data of b"] * 6), sorted(results))
+
+
+@mock_s3
+class TestCachedS3TapeCassetteWriteThrough(unittest.TestCase):
+
+    def setUp(self):
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket="some_bucket")
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def create_cassette(self, **kwargs):
+        return CachedS3TapeCassette(bucket="some_bucket", key_prefix="test", local_path=self.cache_path, **kwargs)
+
+    def save_recording(self, cassette):
+        recording = cassette.create_new_recording('test_operation')
+        recording.set_data('key', 'value')
+        recording.add_metadata({'meta': 'value'})
+        cassette.save_recording(recording)
+        return recording.id
+
+    def assert_replayed_locally(self, cassette, recording_id):
+        with patch.object(S3BasicFacade, 'get_string', side_effect=AssertionError), \
+                patch.object(S3BasicFacade, 'get_buffered_reader', side_effect=AssertionError):
+            self.assertEqual('value', cassette.get_recording(recording_id).get_data('key'))
+            self.assertEqual('value', cassette.get_recording_metadata(recording_id)['meta'])
+
+    def assert_uploaded(self, recording_id):
+        s3_cassette = S3TapeCassette("some_bucket", key_prefix="test")
+        self.assertEqual('value', s3_cassette.get_recording(recording_id).get_data('key'))
+        self.assertEqual('value', s3_cassette.get_recording_metadata(recording_id)['meta'])
+
+    def test_write_through(self):
+        cassette = self.create_cassette()
+        recording_id = self.save_recording(cassette)
+        self.assert_uploaded(recording_id)
+        self.assert_replayed_locally(cassette, recording_id)
+
+    def test_write_through_with_async_upload(self):
+        upload_allowed = Event()
+        original_put = S3BasicFacade.put_buffered_reader
+
+        def blocked_put(facade, *args, **kwargs):
+            upload_allowed.wait()
+            return original_put(facade, *args, **kwargs)
+
+        cassette = self.create_cassette(async_upload=True)
+        with patch.object(S3BasicFacade, 'put_buffered_reader', new=blocked_put):
+            recording_id = self.save_recording(cassette)
+            # Saved before it was uploaded, but can already be replayed
+            self.assert_replayed_locally(cassette, recording_id)
+            upload_allowed.set()
+            cassette.flush()
+        self.assert_uploaded(recording_id)
+        self.assertEqual(0, cassette._s3_facade.failed_uploads)
+
+    def test_saved_recording_is_found_by_search(self):
+        cassette = self.create_cassette()
+        start_date = datetime.utcnow() - timedelta(hours=1)
+        self.assertEqual([], list(cassette.iter_recording_ids('test_operation', start_date=start_date)))
+        recording_id = self.save_recording(cassette)
+        self.assertEqual([recording_id], list(cassette.iter_recording_ids('test_operation', start_date=start_date)))
+
+    def test_failed_upload_is_counted(self):
+        cassette = self.create_cassette(async_upload=True)
+        with patch.object(S3BasicFacade, 'put_buffered_reader', side_effect=IOError), \
+                patch.object(cached_facade.logger, 'error') as error_mock:
+            recording_id = self.save_recording(cassette)
+            cassette.flush()
+        self.assertEqual(1, cassette._s3_facade.failed_uploads)
+        self.assertEqual(1, error_mock.call_count)
+        self.assert_replayed_locally(cassette, recording_id)
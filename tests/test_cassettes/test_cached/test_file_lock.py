@@ -0,0 +1,45 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from playback.tape_cassettes.cached.file_lock import FileLock
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'File locks are not supported on Windows')
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.tmp_path, 'key.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def test_lock_is_exclusive(self):
+        with FileLock(self.lock_path) as lock:
+            self.assertTrue(lock.is_locked)
+            other_lock = FileLock(self.lock_path, timeout=0.1)
+            self.assertFalse(other_lock.acquire())
+        self.assertFalse(lock.is_locked)
+        self.assertFalse(os.path.exists(self.lock_path))
+
+        self.assertTrue(other_lock.acquire())
+        other_lock.release()
+
+    def test_lock_of_crashed_process_is_recovered(self):
+        code = "import os; from playback.tape_cassettes.cached.file_lock import FileLock; " \
+               "assert FileLock({!r}).acquire(); os._exit(1)".format(self.lock_path)
+        self.assertEqual(1, subprocess.call([sys.executable, '-c', code]))
+        # The crashed process left the lock file behind but not the lock
+        self.assertTrue(os.path.exists(self.lock_path))
+
+        lock = FileLock(self.lock_path, timeout=1)
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_lock_is_skipped_on_failure(self):
+        with FileLock(os.path.join(self.tmp_path, 'missing', 'key.lock')) as lock:
+            self.assertFalse(lock.is_locked)
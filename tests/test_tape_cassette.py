@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import unittest
 
 from playback.tape_cassette import TapeCassette
+from playback.tape_cassettes.in_memory.in_memory_tape_cassette import InMemoryTapeCassette
 
 
 class TestTapeCassette(unittest.TestCase):
@@ -103,3 +104,28 @@ class TestTapeCassette(unittest.TestCase):
         recording_metadata = {'key1': 5, 'key2': "bla", 'duration': 4.9}
         filter_metadata = {'duration': {'operator': '>=', 'value': 5}}
         self.assertFalse(TapeCassette.match_against_recorded_metadata(filter_metadata, recording_metadata))
+
+    def test_get_recording_ids_pages(self):
+        cassette = InMemoryTapeCassette()
+        recording_ids = []
+        for i in range(5):
+            recording = cassette.create_new_recording('category')
+            recording.add_metadata({'index': i})
+            cassette.save_recording(recording)
+            recording_ids.append(recording.id)
+
+        page, cursor = cassette.get_recording_ids_page('category', page_size=2)
+        self.assertEqual(recording_ids[:2], page)
+        page, cursor = cassette.get_recording_ids_page('category', page_size=2, cursor=cursor)
+        self.assertEqual(recording_ids[2:4], page)
+        page, cursor = cassette.get_recording_ids_page('category', page_size=2, cursor=cursor)
+        self.assertEqual(recording_ids[4:], page)
+        self.assertIsNone(cursor)
+
+        page, cursor = cassette.get_recording_ids_page('category', metadata={'index': [1, 3]}, page_size=10)
+        self.assertEqual([recording_ids[1], recording_ids[3]], page)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            InMemoryTapeCassette().get_recording_ids_page('category', cursor='not a cursor')